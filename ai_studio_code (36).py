@@ -1,19 +1,76 @@
 import streamlit as st
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
 import urllib.parse
 import time
+SCRIPT_START = time.perf_counter()
 import math
-import pandas as pd
+import os
+import sys
+import tempfile
+import numpy as np
 import random
+import importlib
+import importlib.util
 import json
-
-# --- 嘗試匯入雲端套件 (若無安裝則略過，避免報錯) ---
-try:
-    import gspread
-    from oauth2client.service_account import ServiceAccountCredentials
-    CLOUD_AVAILABLE = True
-except ImportError:
-    CLOUD_AVAILABLE = False
+import gzip
+import io
+import bisect
+from collections import OrderedDict, Counter
+from array import array
+import unicodedata
+import hashlib
+import re
+import threading
+import uuid
+import sqlite3
+import queue
+from contextlib import contextmanager, nullcontext
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+# --- 啟動剖析：各模組 import 與各初始化階段的耗時 (設定 startup_profile=1 或網址加 ?profile=startup 顯示) ---
+@st.cache_resource
+def get_startup_profile():
+    """全程序共用：延後載入模組的 import 耗時，以及冷啟動 (程序的第一次執行) 各階段耗時"""
+    return {"imports": {}, "cold_start": None}
+
+STARTUP_PROFILE = get_startup_profile()
+STARTUP_MARKS = []   # 本次執行的 [(階段, 毫秒)]
+_last_mark = [SCRIPT_START]
+
+def startup_mark(phase):
+    now = time.perf_counter()
+    STARTUP_MARKS.append((phase, (now - _last_mark[0]) * 1000))
+    _last_mark[0] = now
+
+class LazyModule:
+    """重量級套件延後到第一次存取屬性時才 import，避免拖慢冷啟動"""
+    def __init__(self, name, import_times):
+        self._name = name
+        self._import_times = import_times
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            t0 = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            self._import_times.setdefault(self._name, (time.perf_counter() - t0) * 1000)
+        return getattr(self._module, attr)
+
+pd = LazyModule("pandas", STARTUP_PROFILE["imports"])
+requests = LazyModule("requests", STARTUP_PROFILE["imports"])
+PIL_Image = LazyModule("PIL.Image", STARTUP_PROFILE["imports"])
+PIL_ImageOps = LazyModule("PIL.ImageOps", STARTUP_PROFILE["imports"])
+PIL_features = LazyModule("PIL.features", STARTUP_PROFILE["imports"])
+CROPPER_AVAILABLE = importlib.util.find_spec("streamlit_cropper") is not None
+streamlit_cropper = LazyModule("streamlit_cropper", STARTUP_PROFILE["imports"])
+
+# --- 雲端套件 (若無安裝則略過，避免報錯)：只檢查是否安裝，按下雲端功能時才載入 ---
+CLOUD_AVAILABLE = all(importlib.util.find_spec(name) is not None for name in ("gspread", "oauth2client"))
+gspread = LazyModule("gspread", STARTUP_PROFILE["imports"])
+service_account = LazyModule("oauth2client.service_account", STARTUP_PROFILE["imports"])
+startup_mark("import")
 
 # -------------------------------------
 # 1. 系統設定 & 主題定義
@@ -45,47 +102,1228 @@ THEMES = {
     }
 }
 
+startup_mark("page_config & 主題")
+
 # -------------------------------------
 # 2. 核心功能函數 & 模擬天氣服務
 # -------------------------------------
 
-# --- 雲端連線函數 ---
-def get_cloud_connection():
-    if not CLOUD_AVAILABLE: return None
-    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+# --- 行程資料結構：以 id 索引、每日依時間排序 (bisect 插入，不需重新排序) ---
+def parse_hhmm(text):
+    h, m = str(text).split(":")[:2]
+    return int(h) * 60 + int(m)
+
+def format_minute(minute):
+    return f"{minute // 60:02d}:{minute % 60:02d}"
+
+def with_expense_ids(expenses):
+    """舊資料的支出沒有 id：依序補上最小的未用編號 (各裝置補出來的結果相同)"""
+    used = {x["id"] for x in expenses if "id" in x}
+    free = (i for i in itertools.count() if i not in used)
+    return [x if "id" in x else {**x, "id": next(free)} for x in expenses]
+
+class TripItem:
+    __slots__ = ("id", "day", "minute", "seq", "title", "loc", "cost", "cat", "note", "expenses", "actual", "trans_mode", "trans_min")
+    FIELDS = ("title", "loc", "cost", "cat", "note", "trans_mode", "trans_min")
+
+    def __init__(self, id, day, minute, title="新行程", loc="", cost=0, cat="other", note="", expenses=None, trans_mode="📍 移動", trans_min=30):
+        self.id = id
+        self.day = day
+        self.minute = minute
+        self.seq = 0
+        self.title = title
+        self.loc = loc
+        self.cost = cost
+        self.cat = cat
+        self.note = note
+        self.expenses = expenses if expenses is not None else []
+        self.actual = sum(x['price'] for x in self.expenses)
+        self.trans_mode = trans_mode
+        self.trans_min = trans_min
+
+    @property
+    def time(self):
+        return format_minute(self.minute)
+
+    @classmethod
+    def from_dict(cls, d, day):
+        fields = {k: d[k] for k in cls.FIELDS if k in d}
+        return cls(d["id"], day, parse_hhmm(d.get("time", "09:00")), expenses=with_expense_ids(d.get("expenses", [])), **fields)
+
+    def to_dict(self):
+        out = {"id": self.id, "time": self.time}
+        out.update((k, getattr(self, k)) for k in self.FIELDS)
+        out["expenses"] = list(self.expenses)
+        return out
+
+class TripStore:
+    """整趟行程：id -> 項目索引，每天一個依 (分鐘, 加入順序) 排序的串列。
+    預算 (cost) 與實際支出 (expenses 合計) 在每次異動時累加到 每日 / 每類別 / 全程 的小計，讀取為 O(1)；
+    因此 cost、cat、時間、天數與支出都要透過 update / add_expense / remove_expense 修改，其餘欄位透過 edit。
+    version 在這些異動時遞增，可作為衍生資料 (例如記帳摘要) 的快取鍵。"""
+    def __init__(self):
+        self.version = 0
+        self._days = {}    # day -> [TripItem]
+        self._keys = {}    # day -> [(minute, seq)]，與 _days 平行，供 bisect 使用
+        self._index = {}   # id -> TripItem
+        self._seq = 0
+        self._trip_total = [0, 0]   # [預算, 實際]
+        self._day_totals = {}       # day -> [預算, 實際]
+        self._cat_totals = {}       # cat -> [預算, 實際]
+
+    @classmethod
+    def from_dict(cls, trip_data):
+        store = cls()
+        for day, items in trip_data.items():
+            store.ensure_day(int(day))
+            for d in items:
+                store.add(TripItem.from_dict(d, int(day)))
+        return store
+
+    def to_dict(self):
+        return {day: [item.to_dict() for item in self._days[day]] for day in self.days()}
+
+    def ensure_day(self, day):
+        if day not in self._days:
+            self._days[day] = []
+            self._keys[day] = []
+            self._day_totals[day] = [0, 0]
+
+    def days(self):
+        return sorted(self._days)
+
+    def day_items(self, day):
+        """依時間排序的當日項目 (唯讀，修改請透過 TripStore 方法)"""
+        return self._days.get(day, [])
+
+    def get(self, item_id):
+        return self._index.get(item_id)
+
+    def __len__(self):
+        return len(self._index)
+
+    def add(self, item):
+        self.ensure_day(item.day)
+        self._seq += 1
+        item.seq = self._seq
+        key = (item.minute, item.seq)
+        pos = bisect.bisect(self._keys[item.day], key)
+        self._keys[item.day].insert(pos, key)
+        self._days[item.day].insert(pos, item)
+        self._index[item.id] = item
+        self._account(item, 1)
+        self.version += 1
+        return item
+
+    def remove(self, item_id):
+        item = self._index.pop(item_id)
+        keys = self._keys[item.day]
+        pos = bisect.bisect_left(keys, (item.minute, item.seq))
+        del keys[pos]
+        del self._days[item.day][pos]
+        self._account(item, -1)
+        self.version += 1
+        return item
+
+    def edit(self, item_id, **fields):
+        """修改不影響排序與小計的欄位 (名稱、地點、備註、交通)：原地更新，有變動時遞增 version"""
+        item = self._index[item_id]
+        changed = {k: v for k, v in fields.items() if getattr(item, k) != v}
+        for k, v in changed.items(): setattr(item, k, v)
+        if changed: self.version += 1
+        return item
+
+    def edit_expense(self, item_id, exp_id, **fields):
+        """修改支出的非金額欄位 (例如收據附件)；值為 None 表示移除該欄位，有變動時遞增 version"""
+        exp = next(x for x in self._index[item_id].expenses if x.get("id") == exp_id)
+        changed = False
+        for k, v in fields.items():
+            if exp.get(k) == v: continue
+            if v is None: exp.pop(k)
+            else: exp[k] = v
+            changed = True
+        if changed: self.version += 1
+        return exp
+
+    def update(self, item_id, **fields):
+        """修改會影響排序或小計的欄位 (day / minute / cost / cat)：移除後重新插入"""
+        item = self.remove(item_id)
+        for k, v in fields.items(): setattr(item, k, v)
+        return self.add(item)
+
+    def add_expense(self, item_id, name, price, **fields):
+        """price 為行程幣別金額 (小計用)；fields 為幣別、原幣金額、時間、付款人等記帳欄位"""
+        item = self._index[item_id]
+        item.expenses.append({"name": name, "price": price, "id": new_item_id(), **fields})
+        self._adjust_actual(item, price)
+
+    def remove_expense(self, item_id, idx):
+        item = self._index[item_id]
+        exp = item.expenses.pop(idx)
+        self._adjust_actual(item, -exp["price"])
+
+    def _adjust_actual(self, item, delta):
+        self.version += 1
+        item.actual += delta
+        for bucket in (self._trip_total, self._day_totals[item.day], self._cat_totals[item.cat]):
+            bucket[1] += delta
+
+    def _account(self, item, sign):
+        for bucket in (self._trip_total, self._day_totals[item.day], self._cat_totals.setdefault(item.cat, [0, 0])):
+            bucket[0] += sign * item.cost
+            bucket[1] += sign * item.actual
+
+    # --- 小計 (預算, 實際) ---
+    def trip_totals(self):
+        return tuple(self._trip_total)
+
+    def day_totals(self, day):
+        return tuple(self._day_totals.get(day, (0, 0)))
+
+    def cat_totals(self):
+        return {cat: tuple(v) for cat, v in self._cat_totals.items() if v != [0, 0]}
+
+# --- 購物清單：欄位式資料，直接套用 data_editor 回報的逐列變更，小計隨變更增減 ---
+SHOP_COLUMNS = {"對象": str, "商品名稱": str, "預算(¥)": int, "已購買": bool}
+SHOP_ALIASES = {"商品": "商品名稱", "預算": "預算(¥)", "已買": "已購買"}   # 舊版欄位名稱
+
+def _shop_value(col, value):
+    kind = SHOP_COLUMNS[col]
+    if value is None or (isinstance(value, float) and math.isnan(value)): return kind()
+    try:
+        return kind(value)
+    except (TypeError, ValueError):
+        return kind()
+
+def _shop_column(values):
+    """一般為 list；舊版 A1 整包存檔是 DataFrame.to_dict() 的 {列索引: 值} (JSON 後索引變成字串)，依索引數值排序"""
+    if isinstance(values, dict):
+        return [values[k] for k in sorted(values, key=int)]
+    return list(values)
+
+class ShoppingList:
+    """base 欄位是交給 data_editor 的那一份 (同一代 generation 內不變)；
+    編輯器的 edited/deleted/added rows 是相對於 base 的累積變更，每次只重算與上次不同的列"""
+    def __init__(self, columns=None):
+        columns = {SHOP_ALIASES.get(c, c): _shop_column(v) for c, v in (columns or {}).items()}
+        n = max((len(v) for v in columns.values()), default=0)
+        self._base = {c: [_shop_value(c, v[i] if i < len(v) else None) for i in range(n)]
+                      for c, v in ((c, columns.get(c, [])) for c in SHOP_COLUMNS)}
+        self._size = n
+        self._edits = {}       # base 列位置 -> {欄位: 值}
+        self._deleted = set()  # 已刪除的 base 列位置
+        self._added = []       # 新增列 (tuple)
+        self._frame = None
+        self.generation = uuid.uuid4().hex[:8]
+        self.version = 0       # 每次套用編輯器狀態遞增；與 generation 一起可作為快取鍵
+        self.count = self.budget = self.bought = 0
+        for pos in range(n):
+            self._account(self._row(pos), 1)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data)
+
+    @property
+    def editor_key(self):
+        return f"shop_editor_{self.generation}"
+
+    @property
+    def dirty(self):
+        return bool(self._edits or self._deleted or self._added)
+
+    def _row(self, pos):
+        edits = self._edits.get(pos, {})
+        return tuple(_shop_value(c, edits[c]) if c in edits else self._base[c][pos] for c in SHOP_COLUMNS)
+
+    def _account(self, row, sign):
+        self.count += sign
+        self.budget += sign * row[2]
+        self.bought += sign * row[3]
+
+    def apply_editor_state(self, state):
+        self.version += 1
+        edited = {int(k): v for k, v in state.get("edited_rows", {}).items()}
+        for pos in set(edited) | set(self._edits):
+            if edited.get(pos) == self._edits.get(pos) or pos >= self._size: continue
+            live = pos not in self._deleted
+            if live: self._account(self._row(pos), -1)
+            if pos in edited: self._edits[pos] = dict(edited[pos])
+            else: del self._edits[pos]
+            if live: self._account(self._row(pos), 1)
+        deleted = {int(pos) for pos in state.get("deleted_rows", []) if int(pos) < self._size}
+        for pos in deleted - self._deleted: self._account(self._row(pos), -1)
+        for pos in self._deleted - deleted: self._account(self._row(pos), 1)
+        self._deleted = deleted
+        added = [tuple(_shop_value(c, row.get(c)) for c in SHOP_COLUMNS) for row in state.get("added_rows", [])]
+        for i in range(max(len(added), len(self._added))):
+            old = self._added[i] if i < len(self._added) else None
+            new = added[i] if i < len(added) else None
+            if old == new: continue
+            if old: self._account(old, -1)
+            if new: self._account(new, 1)
+        self._added = added
+
+    def rows(self):
+        yield from (self._row(pos) for pos in range(self._size) if pos not in self._deleted)
+        yield from self._added
+
+    def to_dict(self):
+        rows = list(self.rows())
+        return {c: [row[i] for row in rows] for i, c in enumerate(SHOP_COLUMNS)}
+
+    def frame(self):
+        """交給 data_editor 的 DataFrame (同一代內重複使用)"""
+        if self._frame is None:
+            self._frame = pd.DataFrame({c: pd.Series(v, dtype=SHOP_COLUMNS[c]) for c, v in self._base.items()})
+        return self._frame
+
+    def compact(self):
+        """把累積的變更併入 base 並換新一代 (編輯器狀態已不存在時使用)"""
+        self.__init__(self.to_dict())
+
+def apply_shop_edits(editor_key):
+    shop = st.session_state.shopping_list
+    if shop.editor_key == editor_key:
+        shop.apply_editor_state(st.session_state[editor_key])
+
+def get_setting(name, default=None):
+    """讀取設定：環境變數 (大寫) 優先，其次 Streamlit Secrets"""
+    env = os.environ.get(name.upper())
+    if env is not None: return env
     try:
+        return st.secrets.get(name, default)
+    except FileNotFoundError:
+        return default
+
+# --- 效能量測：計時器與計數器 (設定 perf_metrics=1 啟用，網址加 ?debug=perf 顯示面板)；未啟用時不包裝函數，幾乎沒有負擔 ---
+class PerfMetrics:
+    """全程序共用的計時 (次數、總耗時、最大值) 與計數 (執行緒安全)，可匯出 JSON 或 Prometheus 文字格式"""
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.started_at = time.time()
+        self._lock = threading.Lock()
+        self.timers = {}           # 名稱 -> [次數, 總毫秒, 最大毫秒]
+        self.counters = Counter()
+
+    def observe(self, name, ms):
+        with self._lock:
+            t = self.timers.get(name)
+            if t is None:
+                self.timers[name] = [1, ms, ms]
+            else:
+                t[0] += 1
+                t[1] += ms
+                if ms > t[2]: t[2] = ms
+
+    @contextmanager
+    def _timer(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.count(f"{name}.errors")
+            raise
+        finally:
+            self.observe(name, (time.perf_counter() - t0) * 1000)
+
+    def timer(self, name):
+        """with PERF.timer("名稱"): ... ；未啟用時回傳共用的空 context"""
+        return self._timer(name) if self.enabled else _NO_TIMER
+
+    def timed(self, name):
+        """裝飾器版本：未啟用時直接回傳原函數"""
+        def wrap(fn):
+            if not self.enabled: return fn
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                with self._timer(name):
+                    return fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    def count(self, name, n=1):
+        if not self.enabled: return
+        with self._lock:
+            self.counters[name] += n
+
+    def reset(self):
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+            self.started_at = time.time()
+
+    def snapshot(self, gauges=None, session=None):
+        with self._lock:
+            timers = {name: {"count": c, "total_ms": round(total, 3), "avg_ms": round(total / c, 3), "max_ms": round(peak, 3)}
+                      for name, (c, total, peak) in self.timers.items()}
+            counters = dict(self.counters)
+        return {"uptime_s": round(time.time() - self.started_at, 1), "timers": timers, "counters": counters,
+                "gauges": gauges or {}, "session": session or {}}
+
+    @staticmethod
+    def to_prometheus(snapshot, prefix="trip_app"):
+        """Prometheus 文字格式；名稱可含中文，因此放在 label 而不是指標名稱裡"""
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        lines = []
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.extend(f'{prefix}_{name}{{{key}="{label(k)}"}} {v:g}' for key, k, v in samples)
+
+        timers = snapshot["timers"]
+        metric("timer_calls_total", "counter", "Timed calls", [("name", k, t["count"]) for k, t in timers.items()])
+        metric("timer_seconds_total", "counter", "Total time spent", [("name", k, t["total_ms"] / 1000) for k, t in timers.items()])
+        metric("timer_max_seconds", "gauge", "Slowest call", [("name", k, t["max_ms"] / 1000) for k, t in timers.items()])
+        metric("events_total", "counter", "Event counters", [("name", k, v) for k, v in snapshot["counters"].items()])
+        metric("gauge", "gauge", "Cache and connection gauges", [("name", k, v) for k, v in snapshot["gauges"].items()])
+        session = snapshot["session"]
+        if session:
+            metric("session_reruns", "gauge", "Reruns of this session", [("session", session["id"], session["reruns"])])
+            metric("session_state_bytes", "gauge", "Estimated session_state size", [("key", k, v) for k, v in session["state_bytes"].items()])
+        lines.append(f"{prefix}_uptime_seconds {snapshot['uptime_s']:g}")
+        return "\n".join(lines) + "\n"
+
+_NO_TIMER = nullcontext()
+
+@st.cache_resource
+def get_perf_metrics():
+    return PerfMetrics(str(get_setting("perf_metrics", "")).lower() in ("1", "true", "yes"))
+
+PERF = get_perf_metrics()
+
+def estimate_size(obj, seen):
+    """遞迴估計物件佔用的位元組；seen 跨呼叫共用，同一物件只算一次。
+    自訂 __sizeof__ 的物件 (DataFrame、ndarray) 由本身回報，不再往下展開"""
+    total = 0
+    stack = [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen or isinstance(o, (type, type(sys), type(estimate_size))): continue
+        seen.add(id(o))
+        total += sys.getsizeof(o, 0)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif type(o).__sizeof__ is object.__sizeof__:
+            if hasattr(o, "__dict__"): stack.append(vars(o))
+            for slot in getattr(type(o), "__slots__", ()):
+                if hasattr(o, slot): stack.append(getattr(o, slot))
+    return total
+
+def session_state_sizes(state):
+    seen = set()
+    sizes = {str(key): estimate_size(state[key], seen) for key in list(state.keys())}
+    return dict(sorted(sizes.items(), key=lambda kv: -kv[1]))
+
+# --- 雲端連線函數 ---
+class CloudConnection:
+    """全程序共用的 Google Sheets 連線：只授權一次，快取 client 與 worksheet (以 spreadsheet id 為鍵)。
+    access token 由 gspread 內部的 AuthorizedSession 在到期或收到 401 時自行更新，這裡不另外計時"""
+    SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+    def __init__(self, spreadsheet_name="TripPlanDB"):
+        self.spreadsheet_name = spreadsheet_name
+        self.lock = threading.RLock()
+        self._creds = None
+        self._client = None
+        self._sheet_ids = {}     # 試算表名稱 -> spreadsheet id
+        self._worksheets = {}    # spreadsheet id -> worksheet handle
+        self.stats = {"hits": 0, "misses": 0, "api_calls": 0, "errors": 0, "api_ms": 0.0, "last_ms": 0.0}
+
+    def _load_credentials(self):
         # 優先嘗試從 Streamlit Secrets 讀取
         if "gcp_service_account" in st.secrets:
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], scope)
-        else:
-            # 本機測試用
-            creds = ServiceAccountCredentials.from_json_keyfile_name('secrets.json', scope)
-        
-        client = gspread.authorize(creds)
-        return client
-    except Exception:
-        return None
-
-def save_to_cloud(json_str):
-    client = get_cloud_connection()
-    if client:
+            return service_account.ServiceAccountCredentials.from_json_keyfile_dict(st.secrets["gcp_service_account"], self.SCOPE)
+        # 本機測試用
+        return service_account.ServiceAccountCredentials.from_json_keyfile_name('secrets.json', self.SCOPE)
+
+    def _authorize(self):
+        if self._creds is None:
+            self._creds = self._load_credentials()
+        self._client = self.timed(gspread.authorize, self._creds)
+        # 新的 client 需重新取得 worksheet handle
+        self._worksheets.clear()
+
+    def client(self):
+        with self.lock:
+            if self._client is None:
+                self.stats["misses"] += 1
+                self._authorize()
+            else:
+                self.stats["hits"] += 1
+            return self._client
+
+    def spreadsheet_id(self):
+        with self.lock:
+            if self.spreadsheet_name not in self._sheet_ids:
+                sheet_id = st.secrets.get("trip_spreadsheet_id")
+                if not sheet_id:
+                    sheet_id = self.timed(self.client().open, self.spreadsheet_name).id
+                self._sheet_ids[self.spreadsheet_name] = sheet_id
+            return self._sheet_ids[self.spreadsheet_name]
+
+    def worksheet(self, title=None):
+        """title 為 None 時回傳 sheet1 (舊版單格資料)，否則取得 (必要時建立) 指定分頁"""
+        with self.lock:
+            client = self.client()
+            key = (self.spreadsheet_id(), title)
+            if key not in self._worksheets:
+                self.stats["misses"] += 1
+                spreadsheet = self.timed(client.open_by_key, key[0])
+                if title is None:
+                    ws = spreadsheet.sheet1
+                else:
+                    try:
+                        ws = self.timed(spreadsheet.worksheet, title)
+                    except gspread.WorksheetNotFound:
+                        header = CLOUD_SHEET_HEADERS[title]
+                        ws = self.timed(spreadsheet.add_worksheet, title, rows=1000, cols=len(header))
+                        self.timed(ws.append_row, header)
+                self._worksheets[key] = ws
+            else:
+                self.stats["hits"] += 1
+            return self._worksheets[key]
+
+    def timed(self, fn, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            ms = (time.perf_counter() - t0) * 1000
+            with self.lock:
+                self.stats["api_calls"] += 1
+                self.stats["api_ms"] += ms
+                self.stats["last_ms"] = ms
+            if PERF.enabled: PERF.observe(f"gspread.{getattr(fn, '__name__', 'call')}", ms)
+
+    def invalidate(self):
+        """連線出錯時丟棄快取，下次呼叫重新授權"""
+        with self.lock:
+            self._client = None
+            self._worksheets.clear()
+
+    def describe(self):
+        s = self.stats
+        avg = s["api_ms"] / s["api_calls"] if s["api_calls"] else 0
+        return f"快取命中 {s['hits']} / 未命中 {s['misses']} ｜ API {s['api_calls']} 次 (平均 {avg:.0f} ms, 最近 {s['last_ms']:.0f} ms)"
+
+@st.cache_resource
+def get_cloud_connection():
+    if not CLOUD_AVAILABLE: return None
+    return CloudConnection()
+
+# --- 雲端分列儲存：每個行程/支出/願望/住宿各佔一列，只同步有變動的列 ---
+# trip_rows 為目前資料；trip_log 為只增不改的變更紀錄，列號即版本號 (revision)
+CLOUD_ROWS_SHEET = "trip_rows"
+CLOUD_LOG_SHEET = "trip_log"
+CLOUD_SHEET_HEADERS = {
+    CLOUD_ROWS_SHEET: ["key", "hash", "payload"],
+    CLOUD_LOG_SHEET: ["key", "op", "row", "payload", "client"],
+}
+DELETED_ROW = ["", "-", ""]   # 刪除的列保留非空白標記，避免 append 時誤判表格範圍
+
+def _dump_row(obj):
+    return json.dumps(obj, ensure_ascii=False, default=str, sort_keys=True, separators=(",", ":"))
+
+def _row_hash(payload):
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+def trip_to_rows(data):
+    """把整份行程拆成 {列鍵: JSON 字串}"""
+    rows = {}
+    for day, items in data.get("trip_data", {}).items():
+        rows[f"day:{int(day)}"] = "{}"   # 空白的天數也要保留
+        for pos, item in enumerate(items):
+            record = {k: v for k, v in item.items() if k != "expenses"}
+            record.update(day=int(day), pos=pos)
+            rows[f"item:{item['id']}"] = _dump_row(record)
+            # 支出以自己的 id 為鍵：刪除其中一筆不會讓後面的列換鍵
+            for i, exp in enumerate(with_expense_ids(item.get("expenses", []))):
+                rows[f"exp:{item['id']}:{exp['id']}"] = _dump_row({**exp, "pos": i})
+    for pos, wish in enumerate(data.get("wishlist", [])):
+        rows[f"wish:{wish['id']}"] = _dump_row({**wish, "pos": pos})
+    for pos, hotel in enumerate(data.get("hotel_info", [])):
+        rows[f"hotel:{hotel['id']}"] = _dump_row({**hotel, "pos": pos})
+    for name in ["trip_title", "checklist", "flight_info", "shopping_list", "members"]:
+        if name in data: rows[f"meta:{name}"] = _dump_row(data[name])
+    return rows
+
+def rows_to_trip(rows):
+    """trip_to_rows 的反向：還原成與 JSON 備份相同的結構"""
+    data = {"trip_data": {}, "wishlist": [], "hotel_info": []}
+    items, expenses = [], {}
+    for key, payload in rows.items():
+        if not payload: continue
+        kind, _, rest = key.partition(":")
+        record = json.loads(payload)
+        if kind == "day": data["trip_data"].setdefault(int(rest), [])
+        elif kind == "item": items.append(record)
+        elif kind == "exp":
+            item_id, exp_id = rest.rsplit(":", 1)
+            record.setdefault("id", int(exp_id))   # 舊格式的鍵是序號，沒有 id / pos 欄位
+            pos = record.pop("pos", int(exp_id))
+            expenses.setdefault(item_id, []).append((pos, record))
+        elif kind == "wish": data["wishlist"].append(record)
+        elif kind == "hotel": data["hotel_info"].append(record)
+        elif kind == "meta": data[rest] = record
+    for item in sorted(items, key=lambda x: (x["day"], x["pos"])):
+        day = item.pop("day"); item.pop("pos")
+        item["expenses"] = [exp for _, exp in sorted(expenses.get(str(item["id"]), []), key=lambda x: x[0])]
+        data["trip_data"].setdefault(day, []).append(item)
+    for name in ["wishlist", "hotel_info"]:
+        data[name].sort(key=lambda x: x.pop("pos", 0))
+    return data
+
+def get_cloud_sync_state():
+    """上次同步的快照：列位置、雜湊與內容 (存在 session，各使用者各自一份；依儲存後端與行程分開)"""
+    if "cloud_sync" not in st.session_state:
+        st.session_state.cloud_sync = {}
+    storage = get_storage()
+    scope = f"{storage.name if storage else '-'}:{st.session_state.trip_id}"
+    return st.session_state.cloud_sync.setdefault(scope, {})
+
+def _index_remote_rows(sync, listing):
+    """依雲端 A:B 欄 (key, hash) 重建列索引"""
+    remote = {}
+    for offset, row in enumerate(listing):
+        if row and row[0]: remote[row[0]] = (offset + 2, row[1] if len(row) > 1 else "")
+    sync["index"] = {k: r for k, (r, _) in remote.items()}
+    sync["hashes"] = {k: h for k, (_, h) in remote.items()}
+    sync["rows"] = {k: v for k, v in sync.get("rows", {}).items() if k in remote}
+    return remote
+
+def _appended_first_row(response):
+    """從 append 回應的 updatedRange (例如 trip_rows!A12:C14) 取出起始列號"""
+    updated = response["updates"]["updatedRange"]
+    return int(re.search(r"![A-Z]+(\d+)", updated).group(1))
+
+def push_rows(conn, rows, sync, client_id):
+    """把 trip_rows 的結果與快照比對：既有列以一次 batch_update 更新，新列用 append 取得列號，並寫入變更紀錄"""
+    with conn.lock:
         try:
-            sheet = client.open("TripPlanDB").sheet1 
-            sheet.update_cell(1, 1, json_str)
-            return True, "儲存成功！"
+            sheet = conn.worksheet(CLOUD_ROWS_SHEET)
+            if "index" not in sync:
+                _index_remote_rows(sync, conn.timed(sheet.get, "A2:B"))
+            updates, appended, log = [], [], []
+            for key in [k for k in sync["index"] if k not in rows]:
+                row = sync["index"].pop(key)
+                sync["hashes"].pop(key, None); sync["rows"].pop(key, None)
+                updates.append({"range": f"A{row}:C{row}", "values": [DELETED_ROW]})
+                log.append([key, "del", row, "", client_id])
+            for key, payload in rows.items():
+                h = _row_hash(payload)
+                if sync["hashes"].get(key) == h: continue
+                if key in sync["index"]:
+                    row = sync["index"][key]
+                    updates.append({"range": f"A{row}:C{row}", "values": [[key, h, payload]]})
+                    log.append([key, "put", row, payload, client_id])
+                else:
+                    appended.append((key, h, payload))
+                sync["hashes"][key] = h; sync["rows"][key] = payload
+            if appended:
+                # append 前重讀鍵欄：其他裝置可能剛新增同一列，已存在的改為原地更新，避免出現重複的鍵
+                current = {row[0]: offset + 2 for offset, row in enumerate(conn.timed(sheet.get, "A2:A")) if row and row[0]}
+                for key, h, payload in [x for x in appended if x[0] in current]:
+                    row = sync["index"][key] = current[key]
+                    updates.append({"range": f"A{row}:C{row}", "values": [[key, h, payload]]})
+                    log.append([key, "put", row, payload, client_id])
+                appended = [x for x in appended if x[0] not in current]
+            if appended:
+                resp = conn.timed(sheet.append_rows, [list(x) for x in appended], value_input_option="RAW")
+                first = _appended_first_row(resp)
+                for offset, (key, _, payload) in enumerate(appended):
+                    sync["index"][key] = first + offset
+                    log.append([key, "put", first + offset, payload, client_id])
+            if updates:
+                conn.timed(sheet.batch_update, updates)
+            if log:
+                conn.timed(conn.worksheet(CLOUD_LOG_SHEET).append_rows, log, value_input_option="RAW")
+            return True, f"儲存成功！(更新 {len(log)} 列)"
         except Exception as e:
+            sync.clear()
+            conn.invalidate()
             return False, f"寫入失敗: {e}"
-    return False, "連線失敗 (請檢查 Secrets 設定)"
 
-def load_from_cloud():
-    client = get_cloud_connection()
-    if client:
+def load_from_cloud(sync):
+    """完整下載：只抓雜湊與本機快照不同的列；雲端尚無分列資料時讀取舊版 A1 單格 JSON"""
+    conn = get_cloud_connection()
+    if conn:
+        with conn.lock:
+            try:
+                sheet = conn.worksheet(CLOUD_ROWS_SHEET)
+                # 先記下紀錄的最新版本，之後的變更交給 pull_from_cloud (重複套用 put 不影響結果)
+                sync["rev"] = len(conn.timed(conn.worksheet(CLOUD_LOG_SHEET).col_values, 1)) - 1
+                remote = _index_remote_rows(sync, conn.timed(sheet.get, "A2:B"))
+                if not remote:
+                    legacy = conn.timed(conn.worksheet().acell, "A1").value
+                    return json.loads(legacy) if legacy else None
+                stale = [k for k, (_, h) in remote.items() if k not in sync["rows"] or _row_hash(sync["rows"][k]) != h]
+                if stale:
+                    values = conn.timed(sheet.batch_get, [f"C{remote[k][0]}" for k in stale])
+                    for key, vr in zip(stale, values):
+                        sync["rows"][key] = vr[0][0] if vr and vr[0] else ""
+                return rows_to_trip(sync["rows"])
+            except Exception:
+                sync.clear()
+                conn.invalidate()
+                return None
+    return None
+
+def pull_from_cloud(sync, local_data, client_id):
+    """增量同步：只讀取上次版本之後的變更紀錄，逐項合併。
+    本機未改動的項目直接採用雲端版本；兩邊都改過的項目保留本機版本 (下次上傳時寫回) 並計為衝突。
+    回傳 (合併後資料, 套用筆數, 衝突筆數)，失敗時合併資料為 None。"""
+    conn = get_cloud_connection()
+    if not conn or "rev" not in sync: return None, 0, 0
+    with conn.lock:
         try:
-            sheet = client.open("TripPlanDB").sheet1
-            return sheet.cell(1, 1).value
+            entries = conn.timed(conn.worksheet(CLOUD_LOG_SHEET).get, f"A{sync['rev'] + 2}:E")
+            local = trip_to_rows(local_data)
+            applied = conflicts = 0
+            for entry in entries:
+                sync["rev"] += 1
+                key, op, row, payload, client = (list(entry) + [""] * 5)[:5]
+                if not key or client == client_id: continue
+                remote = payload if op == "put" else None
+                base_hash = sync["hashes"].get(key)
+                local_hash = _row_hash(local[key]) if key in local else None
+                remote_hash = _row_hash(remote) if remote is not None else None
+                if local_hash == base_hash:
+                    if remote is None: local.pop(key, None)
+                    else: local[key] = remote
+                    applied += 1
+                elif local_hash != remote_hash:
+                    conflicts += 1
+                if remote is None:
+                    sync.get("index", {}).pop(key, None); sync["hashes"].pop(key, None); sync["rows"].pop(key, None)
+                else:
+                    sync.setdefault("index", {})[key] = int(row)
+                    sync["hashes"][key] = remote_hash; sync["rows"][key] = remote
+            return rows_to_trip(local), applied, conflicts
         except Exception:
-            return None
-    return None
+            sync.clear()
+            conn.invalidate()
+            return None, 0, 0
+
+# --- 儲存後端：同一組介面 (list_trips / load / save_rows / pull)，預設為本機 SQLite，Google Sheets 為選用 ---
+class SheetsStorage:
+    """Google Sheets 後端：沿用上面的分列同步，一個試算表即一趟行程"""
+    name = "sheets"
+    label = "Google Sheets"
+    multi_trip = False   # 整份試算表只有一趟行程，不看 trip_id
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def list_trips(self):
+        return [{"id": "default", "title": self.conn.spreadsheet_name, "rev": None, "updated_at": None}]
+
+    @PERF.timed("sheets.load")
+    def load(self, trip_id, sync):
+        return load_from_cloud(sync)
+
+    @PERF.timed("sheets.save_rows")
+    def save_rows(self, trip_id, rows, sync, client_id):
+        return push_rows(self.conn, rows, sync, client_id)
+
+    @PERF.timed("sheets.pull")
+    def pull(self, trip_id, sync, local_data, client_id):
+        return pull_from_cloud(sync, local_data, client_id)
+
+    def describe(self):
+        return self.conn.describe() if self.conn.stats["api_calls"] else ""
+
+# 列鍵種類 -> (資料表, 鍵欄位, 值欄位, 同時是紀錄 id 的鍵欄位)；不在值欄位內的其他鍵存進 extra (JSON)
+SQLITE_TABLES = {
+    "day": ("days", ("day",), (), None),
+    "item": ("items", ("id",), ("day", "pos", "time", "title", "loc", "cost", "cat", "note", "trans_mode", "trans_min"), "id"),
+    "exp": ("expenses", ("item_id", "id"), ("pos", "name", "price"), "id"),
+    "wish": ("wishes", ("id",), ("pos", "title", "loc", "note"), "id"),
+    "hotel": ("hotels", ("id",), ("pos", "name", "range", "date", "addr", "link"), "id"),
+    "meta": ("trip_meta", ("name",), ("payload",), None),
+}
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trips (id TEXT PRIMARY KEY, title TEXT NOT NULL DEFAULT '', rev INTEGER NOT NULL DEFAULT 0, updated_at REAL);
+CREATE TABLE IF NOT EXISTS days (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, day INTEGER NOT NULL, extra TEXT, PRIMARY KEY (trip_id, day)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS items (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, id INTEGER NOT NULL, day INTEGER NOT NULL, pos INTEGER NOT NULL,
+    time TEXT, title TEXT, loc TEXT, cost INTEGER, cat TEXT, note TEXT, trans_mode TEXT, trans_min INTEGER, extra TEXT, PRIMARY KEY (trip_id, id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS items_by_day ON items (trip_id, day, pos);
+CREATE TABLE IF NOT EXISTS expenses (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, item_id INTEGER NOT NULL, id INTEGER NOT NULL, pos INTEGER,
+    name TEXT, price INTEGER, extra TEXT, PRIMARY KEY (trip_id, item_id, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS wishes (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, id INTEGER NOT NULL, pos INTEGER,
+    title TEXT, loc TEXT, note TEXT, extra TEXT, PRIMARY KEY (trip_id, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hotels (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, id INTEGER NOT NULL, pos INTEGER,
+    name TEXT, "range" TEXT, date TEXT, addr TEXT, link TEXT, extra TEXT, PRIMARY KEY (trip_id, id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS trip_meta (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, name TEXT NOT NULL, payload TEXT, extra TEXT, PRIMARY KEY (trip_id, name)) WITHOUT ROWID;
+"""
+
+class SQLiteStorage:
+    """本機 SQLite 後端 (WAL)：多趟行程以 trip id 區分，連線池共用；
+    每次儲存只寫入與上次同步快照不同的列，並在同一個交易內完成"""
+    name = "sqlite"
+    label = "SQLite (本機)"
+    multi_trip = True
+    POOL_SIZE = 8
+
+    def __init__(self, path):
+        self.path = path
+        self._pool = queue.LifoQueue(maxsize=self.POOL_SIZE)
+        self.stats = {"writes": 0, "rows": 0, "write_ms": 0.0, "last_ms": 0.0}
+        if os.path.dirname(path): os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connection() as db:
+            self._migrate(db)
+            db.executescript(SQLITE_SCHEMA)
+
+    @staticmethod
+    def _migrate(db):
+        """舊版 expenses 以 (item_id, pos) 為鍵：改以支出 id 為鍵，舊資料的 id 沿用原序號"""
+        cols = [r[1] for r in db.execute("PRAGMA table_info(expenses)")]
+        if not cols or "id" in cols: return
+        db.executescript("""
+            BEGIN;
+            ALTER TABLE expenses RENAME TO expenses_old;
+            CREATE TABLE expenses (trip_id TEXT NOT NULL REFERENCES trips(id) ON DELETE CASCADE, item_id INTEGER NOT NULL, id INTEGER NOT NULL, pos INTEGER,
+                name TEXT, price INTEGER, extra TEXT, PRIMARY KEY (trip_id, item_id, id)) WITHOUT ROWID;
+            INSERT INTO expenses SELECT trip_id, item_id, pos, pos, name, price, extra FROM expenses_old;
+            DROP TABLE expenses_old;
+            COMMIT;
+        """)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("PRAGMA foreign_keys=ON")
+        return db
+
+    @contextmanager
+    def connection(self):
+        try:
+            db = self._pool.get_nowait()
+        except queue.Empty:
+            db = self._connect()
+        try:
+            yield db
+        finally:
+            try:
+                self._pool.put_nowait(db)
+            except queue.Full:
+                db.close()
+
+    @contextmanager
+    def transaction(self):
+        with self.connection() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def list_trips(self):
+        with self.connection() as db:
+            rows = db.execute("SELECT id, title, rev, updated_at FROM trips ORDER BY updated_at DESC").fetchall()
+        return [{"id": r[0], "title": r[1], "rev": r[2], "updated_at": r[3]} for r in rows]
+
+    def delete_trip(self, trip_id):
+        with self.transaction() as db:
+            db.execute("DELETE FROM trips WHERE id = ?", (trip_id,))
+
+    def load_rows(self, trip_id):
+        """回傳 (版本, {列鍵: JSON 字串})；行程不存在時版本為 None"""
+        with self.connection() as db:
+            db.execute("BEGIN")   # 讀取快照一致
+            try:
+                found = db.execute("SELECT rev FROM trips WHERE id = ?", (trip_id,)).fetchone()
+                rows = {}
+                for kind, (table, key_cols, value_cols, id_col) in SQLITE_TABLES.items():
+                    cols = ", ".join(f'"{c}"' for c in key_cols + value_cols + ("extra",))
+                    for rec in db.execute(f"SELECT {cols} FROM {table} WHERE trip_id = ?", (trip_id,)):
+                        keys, values, extra = rec[:len(key_cols)], rec[len(key_cols):-1], rec[-1]
+                        key = f"{kind}:" + ":".join(str(k) for k in keys)
+                        if kind == "meta":
+                            rows[key] = values[0]
+                            continue
+                        record = dict(zip(value_cols, values))
+                        if extra: record.update(json.loads(extra))
+                        if id_col: record["id"] = keys[key_cols.index(id_col)]
+                        rows[key] = _dump_row(record)
+            finally:
+                db.execute("COMMIT")
+        return (found[0] if found else None), rows
+
+    def _write_row(self, db, trip_id, key, payload):
+        """payload 為 None 表示刪除"""
+        kind, _, rest = key.partition(":")
+        table, key_cols, value_cols, id_col = SQLITE_TABLES[kind]
+        keys = rest.split(":")
+        if payload is None:
+            where = " AND ".join(f'"{c}" = ?' for c in key_cols)
+            db.execute(f"DELETE FROM {table} WHERE trip_id = ? AND {where}", (trip_id, *keys))
+            return
+        if kind == "meta":
+            values, extra = [payload], None
+        else:
+            record = json.loads(payload)
+            if id_col: record.pop("id", None)
+            values = [record.pop(c, None) for c in value_cols]
+            extra = _dump_row(record) if record else None
+        cols = ", ".join(f'"{c}"' for c in ("trip_id",) + key_cols + value_cols + ("extra",))
+        marks = ", ".join("?" * (len(key_cols) + len(value_cols) + 2))
+        db.execute(f"INSERT OR REPLACE INTO {table} ({cols}) VALUES ({marks})", (trip_id, *keys, *values, extra))
+
+    @PERF.timed("sqlite.save_rows")
+    def save_rows(self, trip_id, rows, sync, client_id):
+        t0 = time.perf_counter()
+        hashes = sync.setdefault("hashes", {})
+        changed = [(k, v) for k, v in rows.items() if hashes.get(k) != _row_hash(v)]
+        deleted = [k for k in hashes if k not in rows]
+        try:
+            with self.transaction() as db:
+                found = db.execute("SELECT rev FROM trips WHERE id = ?", (trip_id,)).fetchone()
+                rev = (found[0] if found else 0) + 1
+                title = json.loads(rows["meta:trip_title"]) if "meta:trip_title" in rows else trip_id
+                db.execute("INSERT INTO trips (id, title, rev, updated_at) VALUES (?, ?, ?, ?) "
+                           "ON CONFLICT(id) DO UPDATE SET title = excluded.title, rev = excluded.rev, updated_at = excluded.updated_at",
+                           (trip_id, title, rev, time.time()))
+                for key in deleted:
+                    self._write_row(db, trip_id, key, None)
+                for key, payload in changed:
+                    self._write_row(db, trip_id, key, payload)
+        except sqlite3.Error as e:
+            return False, f"寫入失敗: {e}"
+        for key in deleted: hashes.pop(key)
+        for key, payload in changed: hashes[key] = _row_hash(payload)
+        # 中間沒有其他人寫入時才推進版本，否則留給「取得更新」合併
+        if sync.get("rev", 0) == rev - 1: sync["rev"] = rev
+        ms = (time.perf_counter() - t0) * 1000
+        self.stats["writes"] += 1; self.stats["rows"] += len(changed) + len(deleted)
+        self.stats["write_ms"] += ms; self.stats["last_ms"] = ms
+        return True, f"儲存成功！(更新 {len(changed) + len(deleted)} 列，{ms:.0f} ms)"
+
+    @PERF.timed("sqlite.load")
+    def load(self, trip_id, sync):
+        rev, rows = self.load_rows(trip_id)
+        if rev is None: return None
+        sync.clear()
+        sync["rev"] = rev
+        sync["hashes"] = {k: _row_hash(v) for k, v in rows.items()}
+        return rows_to_trip(rows)
+
+    @PERF.timed("sqlite.pull")
+    def pull(self, trip_id, sync, local_data, client_id):
+        """與上次同步的快照做三方合併：本機未改動的列採用資料庫版本，兩邊都改過的保留本機版本"""
+        rev, remote = self.load_rows(trip_id)
+        if rev is None: return None, 0, 0
+        if rev == sync.get("rev"): return local_data, 0, 0
+        base = sync.setdefault("hashes", {})
+        local = trip_to_rows(local_data)
+        applied = conflicts = 0
+        for key in set(remote) | set(base):
+            remote_hash = _row_hash(remote[key]) if key in remote else None
+            if remote_hash == base.get(key): continue
+            local_hash = _row_hash(local[key]) if key in local else None
+            if local_hash == base.get(key):
+                if key in remote: local[key] = remote[key]
+                else: local.pop(key, None)
+                applied += 1
+            elif local_hash != remote_hash:
+                conflicts += 1
+            if key in remote: base[key] = remote_hash
+            else: base.pop(key, None)
+        sync["rev"] = rev
+        return rows_to_trip(local), applied, conflicts
+
+    def describe(self):
+        s = self.stats
+        avg = s["write_ms"] / s["writes"] if s["writes"] else 0
+        return f"SQLite WAL ｜ 寫入 {s['writes']} 次 / {s['rows']} 列 (平均 {avg:.1f} ms, 最近 {s['last_ms']:.1f} ms)" if s["writes"] else ""
+
+@st.cache_resource
+def _sqlite_storage(path):
+    return SQLiteStorage(path)
+
+def get_storage():
+    """依設定 storage_backend 選擇後端 ("sqlite" 預設 / "sheets")；無法使用時回傳 None"""
+    if get_setting("storage_backend", "sqlite") == "sheets":
+        conn = get_cloud_connection()
+        return SheetsStorage(conn) if conn else None
+    return _sqlite_storage(get_setting("sqlite_path", "trip_data.db"))
+
+# 資料區塊 -> (session_state 鍵, 轉換函式)
+TRIP_PAYLOAD_SECTIONS = {
+    "trip_data": ("trip_store", TripStore.from_dict), "trip_title": ("trip_title", None),
+    "checklist": ("checklist", None), "wishlist": ("wishlist", None), "hotel_info": ("hotel_info", None),
+    "flight_info": ("flight_info", None), "shopping_list": ("shopping_list", ShoppingList.from_dict), "members": ("members", None),
+}
+
+def apply_trip_payload(data):
+    """將雲端/備份資料寫回 session_state；逐區塊套用，回傳 {區塊: 錯誤訊息} (失敗的區塊維持原本內容)"""
+    errors = {}
+    for name, (key, convert) in TRIP_PAYLOAD_SECTIONS.items():
+        if name not in data: continue
+        try:
+            st.session_state[key] = convert(data[name]) if convert else data[name]
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            errors[name] = str(e) or type(e).__name__
+            continue
+        # 天數跟著資料走，多出來的天數才有分頁
+        if name == "trip_data" and data[name]: st.session_state.trip_days_count = min(max(int(d) for d in data[name]), 30)
+    return errors
+
+# --- 背景自動同步：合併短時間內的多次編輯，於背景執行緒寫入雲端 ---
+class CloudAutosaver:
+    DEBOUNCE = 2.0       # 最後一次編輯後等待秒數
+    MAX_RETRIES = 5
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = {}   # session id -> 最新的待寫入快照 (新的覆蓋舊的)
+        self._status = {}    # session id -> 同步狀態
+        self._thread = threading.Thread(target=self._run, name="cloud-autosave", daemon=True)
+        self._thread.start()
+
+    def submit(self, session_id, storage, trip_id, rows, sync):
+        with self._cond:
+            self._pending[session_id] = {"storage": storage, "trip_id": trip_id, "rows": rows, "sync": sync, "due": time.monotonic() + self.DEBOUNCE, "attempts": 0}
+            self._set_status(session_id, "pending", "等待同步…")
+            self._cond.notify()
+        PERF.count("autosave.submitted")
+
+    def flush(self, session_id):
+        """立即寫入此 session 尚在等待的快照 (切換行程前呼叫，避免被新行程的快照覆蓋)"""
+        with self._cond:
+            job = self._pending.pop(session_id, None)
+        if job is None: return
+        ok, msg = job["storage"].save_rows(job["trip_id"], job["rows"], job["sync"], session_id)
+        with self._cond:
+            self._set_status(session_id, "ok" if ok else "error", msg)
+
+    def status(self, session_id):
+        with self._cond:
+            return dict(self._status.get(session_id, {"state": "idle", "msg": "尚未同步", "at": None}))
+
+    def _set_status(self, session_id, state, msg):
+        self._status[session_id] = {"state": state, "msg": msg, "at": datetime.now()}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                session_id, job = min(self._pending.items(), key=lambda kv: kv[1]["due"])
+                delay = job["due"] - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                del self._pending[session_id]
+                self._set_status(session_id, "saving", "同步中…")
+            ok, msg = job["storage"].save_rows(job["trip_id"], job["rows"], job["sync"], session_id)
+            with self._cond:
+                if ok:
+                    self._set_status(session_id, "ok", msg)
+                elif session_id in self._pending:
+                    pass  # 已有更新的快照排隊，直接以新的為準
+                elif job["attempts"] < self.MAX_RETRIES:
+                    job["attempts"] += 1
+                    job["due"] = time.monotonic() + 2 ** job["attempts"]
+                    self._pending[session_id] = job
+                    self._set_status(session_id, "retry", f"{msg} (第 {job['attempts']} 次重試)")
+                else:
+                    self._set_status(session_id, "error", msg)
+
+@st.cache_resource
+def get_cloud_autosaver():
+    return CloudAutosaver()
+
+TRIP_STATE_KEYS = ["trip_title", "trip_store", "checklist", "wishlist", "hotel_info", "flight_info", "shopping_list", "members"]
+
+def collect_trip_payload(state=None):
+    """state 預設為 st.session_state；也可傳入 {鍵: 物件} (例如背景執行時預先取好的參照)"""
+    state = st.session_state if state is None else state
+    return {
+        "trip_title": state["trip_title"],
+        "trip_data": state["trip_store"].to_dict(),
+        "checklist": state["checklist"],
+        "wishlist": state["wishlist"],
+        "hotel_info": state["hotel_info"],
+        "flight_info": state["flight_info"],
+        "shopping_list": state["shopping_list"].to_dict(),
+        "members": state["members"]
+    }
+
+# --- 本機檔案備份：點下載時才產生內容 (依資料版本快取)，可選 gzip 壓縮；匯入逐區塊驗證 ---
+BACKUP_SCHEMA_VERSION = 2        # 1 = 舊版 (無 schema_version，不含購物清單)
+BACKUP_MAX_BYTES = 64 * 2 ** 20  # 解壓後上限，避免異常檔案吃光記憶體
+
+@PERF.timed("backup.export")
+def export_backup(state, fmt, cache):
+    """fmt 為 "json" (縮排，方便閱讀) 或 "gz" (精簡 JSON + gzip)。
+    cache 只保留最新一個版本：版本由行程與購物清單的異動計數加上其餘小區塊的雜湊組成，
+    不必先組出整份資料；內容不變時重複下載不需重新編碼/壓縮"""
+    trip_store, shop = state["trip_store"], state["shopping_list"]
+    small = {k: state[k] for k in TRIP_STATE_KEYS if k not in ("trip_store", "shopping_list")}
+    rev = (id(trip_store), trip_store.version, shop.generation, shop.version, _row_hash(_dump_row(small)))
+    if cache.get("rev") != rev:
+        cache.clear()
+        cache["rev"] = rev
+    if fmt not in cache:
+        payload = {"schema_version": BACKUP_SCHEMA_VERSION, **collect_trip_payload(state)}
+        if fmt == "gz":
+            compact = json.dumps(payload, ensure_ascii=False, default=str, separators=(",", ":"))
+            cache[fmt] = gzip.compress(compact.encode("utf-8"), compresslevel=6, mtime=0)
+        else:
+            cache[fmt] = json.dumps(payload, ensure_ascii=False, default=str, indent=2).encode("utf-8")
+    return cache[fmt]
+
+def _read_backup_bytes(uploaded_file):
+    """分塊讀取 (gzip 依檔頭自動判斷並串流解壓)，超過上限即停止"""
+    raw = uploaded_file.read(2)
+    uploaded_file.seek(0)
+    stream = gzip.GzipFile(fileobj=uploaded_file) if raw == b"\x1f\x8b" else uploaded_file
+    buf = io.BytesIO()
+    while chunk := stream.read(1 << 16):
+        buf.write(chunk)
+        if buf.tell() > BACKUP_MAX_BYTES:
+            raise ValueError(f"檔案解壓後超過 {BACKUP_MAX_BYTES // 2 ** 20} MB")
+    return buf.getvalue()
+
+def _require(cond, msg):
+    if not cond: raise ValueError(msg)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def _check_backup_section(name, value):
+    """格式不符時丟出 ValueError (訊息會顯示給使用者)"""
+    if name == "trip_title":
+        _require(isinstance(value, str), "應為文字")
+    elif name == "trip_data":
+        _require(isinstance(value, dict), "應為 {天數: [行程...]}")
+        for day, items in value.items():
+            _require(str(day).isdigit(), f"天數「{day}」不是數字")
+            _require(isinstance(items, list), f"Day {day} 應為串列")
+            for item in items:
+                _require(isinstance(item, dict) and "id" in item, f"Day {day} 有缺少 id 的行程")
+                parse_hhmm(item.get("time", "09:00"))
+                label = item.get("title", item["id"])
+                for field in ("cost", "trans_min"):
+                    _require(_is_number(item.get(field, 0)), f"「{label}」的 {field} 不是數字")
+                _require(isinstance(item.get("expenses", []), list)
+                         and all(isinstance(x, dict) and _is_number(x.get("price")) for x in item.get("expenses", [])), f"「{label}」的支出格式錯誤")
+    elif name == "checklist":
+        _require(isinstance(value, dict) and all(isinstance(v, dict) for v in value.values()), "應為 {分類: {項目: 是否完成}}")
+    elif name in ("wishlist", "hotel_info"):
+        _require(isinstance(value, list) and all(isinstance(x, dict) and "id" in x for x in value), "應為含 id 的項目串列")
+    elif name == "flight_info":
+        _require(isinstance(value, dict), "應為 {去程/回程: 資訊}")
+    elif name == "shopping_list":
+        # dict 欄位為舊版 A1 整包存檔的 {列索引: 值}
+        _require(isinstance(value, dict) and all(isinstance(v, (list, dict)) for v in value.values()), "應為 {欄位: [值...]}")
+    elif name == "members":
+        _require(isinstance(value, list) and value and all(isinstance(x, str) and x for x in value), "應為成員名稱串列")
+
+@PERF.timed("backup.parse")
+def parse_backup(uploaded_file):
+    """回傳 (可套用的區塊, {區塊: 錯誤訊息})；整個檔案無法讀取時錯誤放在 "_file" """
+    try:
+        data = json.loads(_read_backup_bytes(uploaded_file))
+        _require(isinstance(data, dict), "最外層應為物件")
+        version = data.get("schema_version", 1)
+        _require(isinstance(version, int) and version <= BACKUP_SCHEMA_VERSION, f"不支援的備份版本 {version}，請更新 App")
+    except (ValueError, OSError, EOFError) as e:
+        return {}, {"_file": str(e)}
+    sections, errors = {}, {}
+    for name in ["trip_title", "trip_data", "checklist", "wishlist", "hotel_info", "flight_info", "shopping_list", "members"]:
+        if name not in data: continue
+        try:
+            _check_backup_section(name, data[name])
+            sections[name] = data[name]
+        except (ValueError, TypeError, AttributeError) as e:
+            errors[name] = str(e) or type(e).__name__
+    return sections, errors
+
+def queue_autosave():
+    """每次 rerun 結束時呼叫：資料有變才送進背景佇列，不等待網路"""
+    storage = get_storage()
+    if not storage: return
+    rows = trip_to_rows(collect_trip_payload())
+    fingerprint = _row_hash(_dump_row([storage.name, st.session_state.trip_id, rows]))
+    if st.session_state.get("autosave_fingerprint") != fingerprint:
+        st.session_state.autosave_fingerprint = fingerprint
+        get_cloud_autosaver().submit(st.session_state.session_uid, storage, st.session_state.trip_id, rows, get_cloud_sync_state())
+
+def switch_trip():
+    """行程選單的 on_change：先寫完上一趟待同步的變更，再載入選到的行程 (從未儲存過的行程沿用目前內容)"""
+    storage = get_storage()
+    if not storage: return
+    get_cloud_autosaver().flush(st.session_state.session_uid)
+    data = storage.load(st.session_state.trip_id, get_cloud_sync_state())
+    if data: apply_trip_payload(data)
+
+class LRUCache:
+    """跨 session 共用、有上限的 LRU (執行緒安全)。
+    compute 在鎖外執行 (可能是網路請求)，慢的未命中不會擋住其他使用者；同一鍵同時未命中時可能各算一次，先寫入的為準"""
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def _lookup(self, keys):
+        """回傳 ({已快取的鍵: 值}, [未命中的鍵 (不重複)])"""
+        found, missing = {}, []
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                if key in self._data:
+                    self._data.move_to_end(key)
+                    found[key] = self._data[key]
+                else:
+                    missing.append(key)
+            self.hits += len(keys) - len(missing)
+            self.misses += len(missing)
+        return found, missing
+
+    def _insert(self, computed, found):
+        with self._lock:
+            for key, value in computed.items():
+                found[key] = self._data.setdefault(key, value)
+                self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_many(self, keys, compute):
+        found, missing = self._lookup(keys)
+        if missing:
+            self._insert({key: compute(*key) for key in missing}, found)
+        return [found[key] for key in keys]
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, compute):
+        return self.get_many([key], lambda *_: compute(*key))[0]
+
+    def get_batch(self, keys, compute_many):
+        """與 get_many 相同，但未命中的鍵一次交給 compute_many(鍵串列) 批次計算"""
+        found, missing = self._lookup(keys)
+        if missing:
+            self._insert(dict(zip(missing, compute_many(missing))), found)
+        return [found[key] for key in keys]
+
+@st.cache_resource
+def get_forecast_cache():
+    return LRUCache()
 
 class WeatherService:
     WEATHER_ICONS = {
@@ -95,9 +1333,24 @@ class WeatherService:
     
     @staticmethod
     def get_forecast(location, date_obj):
-        seed_str = f"{location}{date_obj.strftime('%Y%m%d')}"
-        random.seed(seed_str)
-        month = date_obj.month
+        return WeatherService.get_forecasts([(location, date_obj)])[0]
+
+    @staticmethod
+    @PERF.timed("weather.get_forecasts")
+    def get_forecasts(pairs):
+        """一次取得整趟行程的 [(地點, 日期), ...] 預報，結果依序回傳"""
+        return get_weather_provider().get_forecasts(pairs)
+
+    @staticmethod
+    def mock_forecasts(pairs):
+        keys = [(location, date_obj.strftime('%Y%m%d')) for location, date_obj in pairs]
+        return get_forecast_cache().get_many(keys, WeatherService._compute)
+
+    @staticmethod
+    def _compute(location, date_str):
+        # 每個鍵使用獨立的 RNG，不影響全域 random 狀態
+        rng = random.Random(f"{location}{date_str}")
+        month = int(date_str[4:6])
         
         base_temp = 20
         weights = [60, 30, 10]
@@ -111,9 +1364,9 @@ class WeatherService:
             base_temp = 30
             weights = [50, 20, 30]
         
-        high = base_temp + random.randint(0, 5)
-        low = base_temp - random.randint(3, 8)
-        condition = random.choices(conditions, weights=weights)[0]
+        high = base_temp + rng.randint(0, 5)
+        low = base_temp - rng.randint(3, 8)
+        condition = rng.choices(conditions, weights=weights)[0]
         
         return {
             "high": high, "low": low, "condition": condition,
@@ -129,40 +1382,287 @@ class WeatherService:
         if temp < 10: return "寒冷，建議洋蔥穿搭"
         return "氣候宜人"
 
-def get_packing_recommendations(trip_data, start_date):
-    recommendations = set()
-    has_rain = False
-    min_temp = 100
-    max_temp = -100
-    
-    for day, items in trip_data.items():
-        curr_date = start_date + timedelta(days=day-1)
-        loc = items[0]['loc'] if items and items[0]['loc'] else "京都"
-        w = WeatherService.get_forecast(loc, curr_date)
-        if w['condition'] in ["Rainy", "Snowy"]: has_rain = True
-        min_temp = min(min_temp, w['low'])
-        max_temp = max(max_temp, w['high'])
-
-    if has_rain: recommendations.update(["☔ 折疊傘/雨衣", "👞 防水噴霧"])
-    if min_temp < 12: recommendations.update(["🧣 圍巾", "🧥 保暖外套", "🧤 手套"])
-    elif min_temp < 20: recommendations.update(["🧥 薄外套"])
-    if max_temp > 28: recommendations.update(["🕶️ 太陽眼鏡", "🧢 帽子", "🧴 防曬"])
-    
-    return list(recommendations), {"min": min_temp, "max": max_temp, "rain": has_rain}
+# --- 天氣資料來源 (預設為模擬，可切換為 Open-Meteo) ---
+class MockWeatherProvider:
+    def get_forecasts(self, pairs):
+        return WeatherService.mock_forecasts(pairs)
+
+class DiskTTLCache:
+    """以檔案存放的 TTL 快取，同一台主機上的所有 session 共用"""
+    def __init__(self, directory, ttl):
+        self.directory = directory
+        self.ttl = ttl
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json")
 
-def add_expense_callback(item_id, day_num):
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return entry["value"] if entry.get("expires", 0) > time.time() else None
+
+    def set(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"expires": time.time() + self.ttl, "value": value}, f, ensure_ascii=False)
+        os.replace(tmp, self._path(key))
+
+class OpenMeteoProvider:
+    """HTTP 天氣來源：共用連線池，各地點並行抓取，結果存入磁碟 TTL 快取；逾時或超出預報範圍的日期改用模擬資料"""
+    WMO_CONDITIONS = [((0,), "Sunny"), ((1, 2), "Partly Cloudy"), ((3, 45, 48), "Cloudy"),
+                      ((71, 73, 75, 77, 85, 86), "Snowy")]
+    RETRY_AFTER = 60   # 抓取失敗的地點在這段秒數內直接用模擬資料，離線時不必每次 rerun 都等逾時
+
+    def __init__(self, geocode_url, forecast_url, cache, timeout=3.0, max_workers=8):
+        self.geocode_url = geocode_url
+        self.forecast_url = forecast_url
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="weather")
+        self._locks = {}
+        self._failed = {}   # 地點 -> 可重試的時間 (monotonic)
+        self._guard = threading.Lock()   # 保護 _locks / _failed / stats (各地點在執行緒池中並行)
+        self.stats = {"fetches": 0, "failures": 0}
+
+    def get_forecasts(self, pairs):
+        locations = list(dict.fromkeys(loc for loc, _ in pairs))
+        daily = dict(zip(locations, self.pool.map(self._location_daily, locations)))
+        out = []
+        for loc, date_obj in pairs:
+            day = daily[loc].get(date_obj.strftime("%Y-%m-%d"))
+            out.append(day if day else WeatherService.mock_forecasts([(loc, date_obj)])[0])
+        return out
+
+    def _location_daily(self, location):
+        key = f"open-meteo:{location}"
+        cached = self.cache.get(key)
+        if cached is not None: return cached
+        # 同一地點同時只抓一次，其他等待者直接讀快取
+        with self._guard:
+            if self._failed.get(location, 0) > time.monotonic(): return {}
+            lock = self._locks.setdefault(location, threading.Lock())
+        with lock:
+            cached = self.cache.get(key)
+            if cached is not None: return cached
+            with self._guard:
+                if self._failed.get(location, 0) > time.monotonic(): return {}
+            try:
+                daily = self._fetch(location)
+            except (requests.RequestException, KeyError, IndexError, TypeError, ValueError):
+                with self._guard:
+                    self.stats["failures"] += 1
+                    self._failed[location] = time.monotonic() + self.RETRY_AFTER
+                return {}
+            with self._guard:
+                self._failed.pop(location, None)
+            self.cache.set(key, daily)
+            return daily
+
+    @PERF.timed("http.open-meteo")
+    def _fetch(self, location):
+        with self._guard:
+            self.stats["fetches"] += 1
+        geo = self.session.get(self.geocode_url, params={"name": location, "count": 1, "language": "zh"}, timeout=self.timeout)
+        geo.raise_for_status()
+        place = geo.json()["results"][0]
+        resp = self.session.get(self.forecast_url, params={
+            "latitude": place["latitude"], "longitude": place["longitude"], "timezone": "auto", "forecast_days": 16,
+            "daily": "temperature_2m_max,temperature_2m_min,weathercode"}, timeout=self.timeout)
+        resp.raise_for_status()
+        d = resp.json()["daily"]
+        daily = {}
+        for date_str, high, low, code in zip(d["time"], d["temperature_2m_max"], d["temperature_2m_min"], d["weathercode"]):
+            if high is None or low is None: continue   # 預報尾端可能是 null，這幾天改用模擬資料
+            condition = next((c for codes, c in self.WMO_CONDITIONS if code in codes), "Rainy")
+            high, low = round(high), round(low)
+            daily[date_str] = {"high": high, "low": low, "condition": condition,
+                               "icon": WeatherService.WEATHER_ICONS.get(condition, "🌤️"),
+                               "desc": WeatherService.get_desc(condition, high)}
+        return daily
+
+@st.cache_resource
+def _open_meteo_provider(geocode_url, forecast_url, cache_dir, ttl):
+    return OpenMeteoProvider(geocode_url, forecast_url, DiskTTLCache(cache_dir, ttl))
+
+def get_weather_provider():
+    if get_setting("weather_provider", "mock") == "open-meteo":
+        return _open_meteo_provider(
+            get_setting("weather_geocode_url", "https://geocoding-api.open-meteo.com/v1/search"),
+            get_setting("weather_forecast_url", "https://api.open-meteo.com/v1/forecast"),
+            get_setting("weather_cache_dir", os.path.join(tempfile.gettempdir(), "trip_weather_cache")),
+            float(get_setting("weather_ttl", 3 * 3600)))
+    return MockWeatherProvider()
+
+# --- 行李建議：宣告式規則 (條件 -> 建議項目)，規則依條件用到的事實建立索引，事實有變時只重新判斷相關的規則 ---
+PACKING_FACTS = ("temp_low", "temp_high", "precip", "country", "activities", "length")
+PACKING_RULES = [
+    # (圖示, 項目, 加入準備清單的分類, {事實: 符合任一即可的值})；同一項目多條規則命中時只列一次
+    ("☔", "折疊傘", "生活用品", {"precip": {"rain", "snow"}}),
+    ("👞", "防水噴霧", "衣物穿搭", {"precip": {"rain", "snow"}}),
+    ("🥾", "防滑鞋", "衣物穿搭", {"precip": {"snow"}}),
+    ("🧣", "圍巾", "衣物穿搭", {"temp_low": {"cold", "cool"}}),
+    ("🧥", "保暖外套", "衣物穿搭", {"temp_low": {"cold", "cool"}}),
+    ("🧤", "手套", "衣物穿搭", {"temp_low": {"cold", "cool"}}),
+    ("🔥", "暖暖包", "生活用品", {"temp_low": {"cold"}}),
+    ("🧥", "薄外套", "衣物穿搭", {"temp_low": {"mild"}}),
+    ("🕶️", "太陽眼鏡", "衣物穿搭", {"temp_high": {"hot"}}),
+    ("🧢", "帽子", "衣物穿搭", {"temp_high": {"hot"}}),
+    ("🧴", "防曬", "生活用品", {"temp_high": {"hot"}}),
+    ("🪙", "零錢包", "生活用品", {"country": {"日本"}}),
+    ("🔌", "轉接頭", "電子產品", {"country": {"韓國", "泰國"}}),
+    ("🦟", "防蚊液", "生活用品", {"country": {"泰國"}}),
+    ("🛍️", "購物袋", "生活用品", {"activities": {"shop"}}),
+    ("♨️", "溫泉小毛巾", "生活用品", {"activities": {"onsen"}}),
+    ("🩱", "泳衣", "衣物穿搭", {"activities": {"beach"}}),
+    ("🩴", "拖鞋", "衣物穿搭", {"activities": {"beach", "onsen"}}),
+    ("🥾", "登山鞋", "衣物穿搭", {"activities": {"hiking"}}),
+    ("🧦", "乾淨襪子 (參拜脫鞋)", "衣物穿搭", {"activities": {"temple"}, "country": {"日本"}}),
+    ("🔋", "行動電源", "電子產品", {"activities": {"theme_park"}}),
+    ("🧺", "洗衣袋", "生活用品", {"length": {"long"}}),
+    ("🧳", "摺疊行李袋", "生活用品", {"length": {"medium", "long"}, "activities": {"shop"}}),
+]
+# 行程名稱/地點/備註中的關鍵字 -> 活動標籤 (與行程類別一起成為 activities 事實)
+ACTIVITY_KEYWORDS = {
+    "onsen": ["溫泉", "onsen", "湯屋"], "beach": ["海灘", "沙灘", "浮潛", "潛水", "beach"],
+    "hiking": ["登山", "健行", "步道", "hiking"], "temple": ["寺", "神社", "宮"],
+    "theme_park": ["環球影城", "迪士尼", "樂園", "usj"],
+}
+ACTIVITY_PATTERN = re.compile("|".join(f"(?P<{tag}>{'|'.join(map(re.escape, words))})" for tag, words in ACTIVITY_KEYWORDS.items()), re.I)
+
+class PackingRuleSet:
+    """編譯後的規則 (條件值轉成 frozenset) 與 事實 -> 規則序號 的索引；全程序共用"""
+    def __init__(self, rules):
+        self.rules = []
+        self.index = {fact: [] for fact in PACKING_FACTS}
+        for i, (icon, name, category, conditions) in enumerate(rules):
+            unknown = set(conditions) - set(PACKING_FACTS)
+            if unknown: raise ValueError(f"規則「{name}」使用了未知的事實: {unknown}")
+            self.rules.append((icon, name, category, {fact: frozenset(values) for fact, values in conditions.items()}))
+            for fact in conditions:
+                self.index[fact].append(i)
+
+@st.cache_resource
+def get_packing_rules():
+    return PackingRuleSet(PACKING_RULES)
+
+class PackingEngine:
+    """每個 session 一份判斷狀態：記住上次的事實與各規則是否命中，evaluate 只重新判斷受影響的規則"""
+    def __init__(self, ruleset):
+        self.ruleset = ruleset
+        self.facts = {}
+        self.fired = [False] * len(ruleset.rules)
+        self.result = []
+        self.evaluated = 0   # 累計判斷過的規則數
+
+    def evaluate(self, facts):
+        facts = {k: v if isinstance(v, frozenset) else frozenset([v]) for k, v in facts.items()}
+        changed = [fact for fact in PACKING_FACTS if facts.get(fact) != self.facts.get(fact)]
+        if not changed: return self.result
+        self.facts = facts
+        dirty = sorted({i for fact in changed for i in self.ruleset.index[fact]})
+        for i in dirty:
+            conditions = self.ruleset.rules[i][3]
+            self.fired[i] = all(not values.isdisjoint(facts.get(fact, ())) for fact, values in conditions.items())
+        self.evaluated += len(dirty)
+        PERF.count("packing.rules_evaluated", len(dirty))
+        seen = set()
+        self.result = []
+        for fired, (icon, name, category, _) in zip(self.fired, self.ruleset.rules):
+            if fired and name not in seen:
+                seen.add(name)
+                self.result.append((icon, name, category))
+        return self.result
+
+@st.cache_resource
+def get_packing_cache():
+    return LRUCache(maxsize=256)
+
+def temperature_bands(low, high):
+    low_band = "cold" if low < 5 else "cool" if low < 12 else "mild" if low < 20 else "warm"
+    return low_band, "hot" if high > 28 else "normal"
+
+def _packing_weather(date_str, locations, epoch):
+    start_date = datetime.strptime(date_str, "%Y%m%d")
+    forecasts = WeatherService.get_forecasts([(loc, start_date + timedelta(days=i)) for i, loc in enumerate(locations)])
+    precip = frozenset({"Rainy": "rain", "Snowy": "snow"}[w["condition"]] for w in forecasts if w["condition"] in ("Rainy", "Snowy"))
+    return {"min": min(w["low"] for w in forecasts), "max": max(w["high"] for w in forecasts), "rain": bool(precip), "precip": precip}
+
+def packing_weather(start_date, locations):
+    """(出發日, 每天地點) 相同時不再查預報；真實天氣來源每小時換一次快取鍵"""
+    epoch = 0 if get_setting("weather_provider", "mock") == "mock" else int(time.time() // 3600)
+    return get_packing_cache().get((f"{start_date:%Y%m%d}", locations, epoch), _packing_weather)
+
+def packing_activities(trip_store):
+    """行程類別 + 名稱/地點/備註中的關鍵字 (所有文字接起來只掃一次)"""
+    items = [item for day in trip_store.days() for item in trip_store.day_items(day)]
+    tags = {item.cat for item in items}
+    tags.update(m.lastgroup for m in ACTIVITY_PATTERN.finditer("\n".join(f"{item.title} {item.loc} {item.note}" for item in items)))
+    return frozenset(tags)
+
+@PERF.timed("packing.recommendations")
+def get_packing_recommendations(trip_store, start_date, country, engine):
+    """回傳 ([(圖示, 項目, 分類), ...], 天氣摘要)"""
+    days = trip_store.days()
+    locations = tuple((items[0].loc if items and items[0].loc else "京都") for items in map(trip_store.day_items, days))
+    weather = packing_weather(start_date, locations)
+    temp_low, temp_high = temperature_bands(weather["min"], weather["max"])
+    facts = {
+        "temp_low": temp_low, "temp_high": temp_high, "precip": weather["precip"], "country": country,
+        "activities": packing_activities(trip_store),
+        "length": "short" if len(days) <= 3 else "medium" if len(days) <= 7 else "long",
+    }
+    return engine.evaluate(facts), weather
+
+def merge_packing_suggestions(checklist, suggestions):
+    """把建議加入準備清單 (任何分類已有同名項目就略過)；回傳實際加入的數量"""
+    existing = {name.strip() for items in checklist.values() for name in items}
+    added = 0
+    for _, name, category in suggestions:
+        if name not in existing:
+            checklist.setdefault(category, {})[name] = False
+            existing.add(name)
+            added += 1
+    return added
+
+def new_item_id():
+    """不會與其他使用者撞號的項目 id (53 bits 以內，避免前端數字精度問題)"""
+    return uuid.uuid4().int & ((1 << 53) - 1)
+
+def add_expense_callback(item_id):
     name_key = f"new_exp_n_{item_id}"
     price_key = f"new_exp_p_{item_id}"
     name = st.session_state.get(name_key, "")
     price = st.session_state.get(price_key, 0)
     if name and price > 0:
-        target_item = next((x for x in st.session_state.trip_data[day_num] if x['id'] == item_id), None)
+        target_item = st.session_state.trip_store.get(item_id)
         if target_item:
-            if "expenses" not in target_item: target_item["expenses"] = []
-            target_item['expenses'].append({"name": name, "price": price})
-            target_item['cost'] = sum(x['price'] for x in target_item['expenses'])
+            # 記原幣金額與幣別；price 換算成行程幣別，讓各項小計維持同一幣別
+            currency = st.session_state.get(f"new_exp_c_{item_id}") or trip_currency()
+            at = expense_timestamp(target_item, st.session_state.start_date)
+            members = st.session_state.members
+            fields = {"currency": currency, "amount": price, "at": at,
+                      "payer": st.session_state.get(f"new_exp_w_{item_id}") or members[0]}
+            split = st.session_state.get(f"new_exp_s_{item_id}")
+            if split and set(split) != set(members): fields["split"] = list(split)
+            local = round(convert_amount(price, currency, trip_currency(), at[:10]))
+            st.session_state.trip_store.add_expense(item_id, name, local, **fields)
+            st.session_state.trip_store.update(item_id, cost=target_item.actual)
             st.session_state[name_key] = ""
             st.session_state[price_key] = 0
+            # 回呼內不能 st.rerun()：交給卡片片段改重跑整頁，讓每日 / 全程小計跟著更新
+            st.session_state.totals_changed = True
+
+def on_theme_change():
+    # 回呼在腳本執行前套用，新主題當次 rerun 就生效，不需再 st.rerun()
+    st.session_state.selected_theme_name = st.session_state.theme_select
 
 def get_single_map_link(location):
     if not location: return "#"
@@ -170,48 +1670,1137 @@ def get_single_map_link(location):
     return f"https://www.google.com/maps/search/?api=1&query={urllib.parse.quote(location)}"
 
 def generate_google_map_route(items):
-    valid_locs = [item['loc'] for item in items if item.get('loc') and item['loc'].strip()]
+    valid_locs = [item.loc for item in items if item.loc and item.loc.strip()]
     if len(valid_locs) < 1: return "#"
     base_url = "https://www.google.com/maps/dir/"
     encoded_locs = [urllib.parse.quote(loc) for loc in valid_locs]
     return base_url + "/".join(encoded_locs)
 
+# --- 離線地點資料 (日/韓/泰)：名稱|國家|緯度|經度|別名 (假名、羅馬拼音、當地文字、中文) ---
+GAZETTEER_DATA = """
+關西機場|JP|34.4320|135.2304|関西空港,関西国際空港,かんさいくうこう,Kansai Airport,KIX,Kansai International Airport,關西國際機場
+成田機場|JP|35.7720|140.3929|成田空港,なりたくうこう,Narita Airport,NRT
+羽田機場|JP|35.5494|139.7798|羽田空港,はねだくうこう,Haneda Airport,HND
+新千歲機場|JP|42.7752|141.6923|新千歳空港,しんちとせくうこう,New Chitose Airport,CTS
+福岡機場|JP|33.5859|130.4510|福岡空港,ふくおかくうこう,Fukuoka Airport,FUK
+那霸機場|JP|26.2062|127.6465|那覇空港,なはくうこう,Naha Airport,OKA
+京都車站|JP|34.9858|135.7588|京都駅,京都,きょうと,きょうとえき,Kyoto,Kyoto Station
+KOKO HOTEL 京都|JP|34.9874|135.7566|KOKO HOTEL Kyoto,ココホテル京都
+錦市場|JP|35.0050|135.7649|錦市場,にしきいちば,Nishiki Market
+鴨川|JP|35.0087|135.7714|鴨川,かもがわ,Kamogawa,Kamo River
+清水寺|JP|34.9949|135.7850|清水寺,きよみずでら,Kiyomizu-dera,Kiyomizudera
+三年坂|JP|34.9963|135.7809|三寧坂,産寧坂,さんねんざか,Sannenzaka,二三年坂,二年坂,Ninenzaka
+八坂神社|JP|35.0036|135.7785|八坂神社,やさかじんじゃ,Yasaka Shrine
+祇園|JP|35.0037|135.7751|祇園,ぎおん,Gion,花見小路,Hanamikoji
+金閣寺|JP|35.0394|135.7292|金閣寺,きんかくじ,Kinkaku-ji,Kinkakuji,鹿苑寺,Golden Pavilion
+銀閣寺|JP|35.0270|135.7982|銀閣寺,ぎんかくじ,Ginkaku-ji,Ginkakuji,慈照寺
+伏見稻荷大社|JP|34.9671|135.7727|伏見稲荷大社,伏見稻荷,ふしみいなりたいしゃ,Fushimi Inari,Fushimi Inari Taisha,千本鳥居
+嵐山|JP|35.0094|135.6668|嵐山,あらしやま,Arashiyama,竹林小徑,竹林の小径,Bamboo Grove
+渡月橋|JP|35.0129|135.6777|渡月橋,とげつきょう,Togetsukyo Bridge
+二條城|JP|35.0142|135.7481|二条城,にじょうじょう,Nijo Castle
+哲學之道|JP|35.0230|135.7945|哲学の道,てつがくのみち,Philosopher's Path
+大丸京都店|JP|35.0037|135.7608|大丸京都店,だいまるきょうと,Daimaru Kyoto
+京都塔|JP|34.9875|135.7594|京都タワー,きょうとたわー,Kyoto Tower
+奈良公園|JP|34.6851|135.8430|奈良公園,ならこうえん,Nara Park,奈良
+東大寺|JP|34.6890|135.8398|東大寺,とうだいじ,Todai-ji,Todaiji
+春日大社|JP|34.6813|135.8484|春日大社,かすがたいしゃ,Kasuga Taisha
+大阪|JP|34.7025|135.4959|大阪,おおさか,Osaka,梅田,うめだ,Umeda,大阪駅,Osaka Station
+環球影城|JP|34.6654|135.4323|日本環球影城,ユニバーサル・スタジオ・ジャパン,ユニバ,USJ,Universal Studios Japan,環球影城 (USJ)
+道頓堀|JP|34.6687|135.5013|道頓堀,どうとんぼり,Dotonbori,固力果,グリコサイン,Glico Sign
+心齋橋|JP|34.6750|135.5011|心斎橋,しんさいばし,Shinsaibashi
+黑門市場|JP|34.6653|135.5064|黒門市場,くろもんいちば,Kuromon Market
+大阪城|JP|34.6873|135.5262|大阪城,おおさかじょう,Osaka Castle
+通天閣|JP|34.6525|135.5063|通天閣,つうてんかく,Tsutenkaku,新世界,Shinsekai
+梅田藍天大廈|JP|34.7053|135.4906|梅田スカイビル,うめだすかいびる,Umeda Sky Building
+海遊館|JP|34.6545|135.4290|海遊館,かいゆうかん,Osaka Aquarium Kaiyukan
+Rinku Premium Outlets|JP|34.4036|135.2951|りんくうプレミアム・アウトレット,臨空城 Outlet,臨空城,Rinku Outlet
+難波|JP|34.6659|135.5007|なんば,難波,Namba,Nanba
+神戶港|JP|34.6822|135.1867|神戸港,こうべこう,Kobe Port,Kobe Harborland,神戶
+姬路城|JP|34.8394|134.6939|姫路城,ひめじじょう,Himeji Castle
+淺草寺|JP|35.7148|139.7967|浅草寺,せんそうじ,Senso-ji,Sensoji,淺草,浅草,Asakusa,雷門,Kaminarimon
+東京晴空塔|JP|35.7101|139.8107|東京スカイツリー,晴空塔,すかいつりー,Tokyo Skytree,Skytree
+東京鐵塔|JP|35.6586|139.7454|東京タワー,とうきょうたわー,Tokyo Tower
+澀谷|JP|35.6580|139.7016|渋谷,しぶや,Shibuya,澀谷十字路口,Shibuya Crossing
+新宿|JP|35.6909|139.7003|新宿,しんじゅく,Shinjuku
+原宿|JP|35.6702|139.7027|原宿,はらじゅく,Harajuku,竹下通,Takeshita Street
+明治神宮|JP|35.6764|139.6993|明治神宮,めいじじんぐう,Meiji Jingu,Meiji Shrine
+銀座|JP|35.6717|139.7650|銀座,ぎんざ,Ginza
+築地場外市場|JP|35.6654|139.7707|築地場外市場,つきじ,Tsukiji Outer Market,築地
+上野公園|JP|35.7156|139.7745|上野公園,うえのこうえん,Ueno Park,上野,阿美橫町,アメ横,Ameyoko
+秋葉原|JP|35.6984|139.7731|秋葉原,あきはばら,Akihabara
+東京車站|JP|35.6812|139.7671|東京駅,とうきょうえき,Tokyo Station,東京
+東京迪士尼樂園|JP|35.6329|139.8804|東京ディズニーランド,でぃずにーらんど,Tokyo Disneyland,迪士尼
+台場|JP|35.6267|139.7751|お台場,おだいば,Odaiba
+鎌倉大佛|JP|35.3167|139.5358|鎌倉大仏,高徳院,かまくらだいぶつ,Kamakura Great Buddha,鎌倉
+富士山|JP|35.3606|138.7274|富士山,ふじさん,Mount Fuji,Mt Fuji
+河口湖|JP|35.5171|138.7517|河口湖,かわぐちこ,Lake Kawaguchi,Kawaguchiko
+箱根|JP|35.2324|139.1069|箱根,はこね,Hakone
+札幌|JP|43.0687|141.3508|札幌,さっぽろ,Sapporo,札幌駅
+小樽運河|JP|43.1994|141.0022|小樽運河,おたるうんが,Otaru Canal,小樽
+函館山|JP|41.7594|140.7046|函館山,はこだてやま,Mount Hakodate,函館
+福岡|JP|33.5902|130.4017|福岡,ふくおか,Fukuoka,博多,はかた,Hakata
+太宰府天滿宮|JP|33.5215|130.5349|太宰府天満宮,だざいふてんまんぐう,Dazaifu Tenmangu
+沖繩美麗海水族館|JP|26.6943|127.8779|沖縄美ら海水族館,ちゅらうみ,Churaumi Aquarium
+國際通|JP|26.2155|127.6853|国際通り,こくさいどおり,Kokusai Street,那霸,那覇,Naha
+廣島和平紀念公園|JP|34.3955|132.4536|広島平和記念公園,ひろしま,Hiroshima Peace Memorial Park,廣島
+嚴島神社|JP|34.2959|132.3199|厳島神社,いつくしまじんじゃ,Itsukushima Shrine,宮島,Miyajima
+名古屋城|JP|35.1856|136.8991|名古屋城,なごやじょう,Nagoya Castle,名古屋
+金澤兼六園|JP|36.5621|136.6627|兼六園,けんろくえん,Kenrokuen,金沢,金澤
+白川鄉|JP|36.2578|136.9063|白川郷,しらかわごう,Shirakawa-go
+仁川機場|KR|37.4602|126.4407|인천국제공항,인천공항,Incheon Airport,ICN,仁川國際機場
+金浦機場|KR|37.5583|126.7906|김포국제공항,김포공항,Gimpo Airport,GMP
+金海機場|KR|35.1795|128.9382|김해국제공항,김해공항,Gimhae Airport,PUS
+首爾車站|KR|37.5547|126.9707|서울역,首爾站,Seoul Station,首爾,서울,Seoul
+明洞|KR|37.5636|126.9826|명동,Myeongdong,Myeong-dong
+景福宮|KR|37.5796|126.9770|경복궁,Gyeongbokgung,Gyeongbok Palace
+北村韓屋村|KR|37.5826|126.9830|북촌한옥마을,Bukchon Hanok Village,北村
+南山首爾塔|KR|37.5512|126.9882|N서울타워,남산타워,N Seoul Tower,Namsan Tower,南山塔
+東大門設計廣場|KR|37.5665|127.0092|동대문디자인플라자,DDP,Dongdaemun Design Plaza,東大門
+弘大|KR|37.5563|126.9236|홍대,Hongdae,弘益大學
+梨泰院|KR|37.5345|126.9946|이태원,Itaewon
+廣藏市場|KR|37.5700|126.9996|광장시장,Gwangjang Market
+昌德宮|KR|37.5794|126.9910|창덕궁,Changdeokgung
+仁寺洞|KR|37.5740|126.9850|인사동,Insadong
+樂天世界|KR|37.5111|127.0982|롯데월드,Lotte World,樂天世界塔,롯데월드타워,Lotte World Tower
+江南|KR|37.4979|127.0276|강남,Gangnam,江南站
+釜山|KR|35.1151|129.0414|부산,Busan,釜山站,부산역
+海雲台|KR|35.1587|129.1604|해운대,Haeundae,海雲台海水浴場
+甘川洞文化村|KR|35.0975|129.0106|감천문화마을,Gamcheon Culture Village
+札嘎其市場|KR|35.0968|129.0306|자갈치시장,Jagalchi Market,チャガルチ市場
+濟州島|KR|33.4996|126.5312|제주,제주도,Jeju,Jeju Island,濟州
+城山日出峰|KR|33.4581|126.9425|성산일출봉,Seongsan Ilchulbong
+素萬那普機場|TH|13.6900|100.7501|สนามบินสุวรรณภูมิ,Suvarnabhumi Airport,BKK,蘇凡納布機場
+廊曼機場|TH|13.9126|100.6068|ดอนเมือง,Don Mueang Airport,DMK
+曼谷|TH|13.7563|100.5018|กรุงเทพ,Bangkok,Krung Thep
+大皇宮|TH|13.7500|100.4913|พระบรมมหาราชวัง,Grand Palace,大王宮
+臥佛寺|TH|13.7465|100.4927|วัดโพธิ์,Wat Pho,Wat Po
+鄭王廟|TH|13.7437|100.4889|วัดอรุณ,Wat Arun,黎明寺
+考山路|TH|13.7590|100.4974|ถนนข้าวสาร,Khao San Road,Khaosan
+暹羅百麗宮|TH|13.7462|100.5347|สยามพารากอน,Siam Paragon,暹羅,Siam
+洽圖洽週末市集|TH|13.7999|100.5500|ตลาดนัดจตุจักร,Chatuchak Weekend Market,Chatuchak,恰圖恰
+ICONSIAM|TH|13.7267|100.5103|ไอคอนสยาม,Icon Siam,暹羅天地
+喬德夜市|TH|13.7659|100.5690|จ๊อดแฟร์,Jodd Fairs,Jodd Fair
+清邁古城|TH|18.7883|98.9853|เชียงใหม่,Chiang Mai,清邁,Chiang Mai Old City
+素帖寺|TH|18.8048|98.9216|วัดพระธาตุดอยสุเทพ,Doi Suthep,Wat Phra That Doi Suthep,雙龍寺
+清邁夜市|TH|18.7850|99.0000|ไนท์บาซาร์,Chiang Mai Night Bazaar,Night Bazaar
+普吉島|TH|7.8804|98.3923|ภูเก็ต,Phuket,普吉
+芭東海灘|TH|7.8965|98.2965|หาดป่าตอง,Patong Beach,巴東海灘
+芭達雅|TH|12.9236|100.8825|พัทยา,Pattaya
+大城|TH|14.3692|100.5877|อยุธยา,Ayutthaya,大城府
+"""
+COUNTRY_CODES = {"日本": "JP", "韓國": "KR", "泰國": "TH"}
+
+def normalize_place(text):
+    """比對用的正規化：全半形統一、小寫、片假名轉平假名、去除空白與標點"""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = "".join(chr(ord(ch) - 0x60) if "\u30a1" <= ch <= "\u30f6" else ch for ch in text)
+    return re.sub(r"[\s\-_'’·・.,()（）!！]", "", text)
+
+class Gazetteer:
+    """離線地點索引：座標存於 numpy 陣列；別名建成前綴 trie (每個節點預先存好前幾名結果)
+    與 2-gram 倒排索引 (模糊比對)，查詢不需呼叫任何 API"""
+    TOP_K = 6
+
+    def __init__(self, data):
+        self.names, self.countries, coords = [], [], []
+        self.alias_keys = []                 # 正規化後的別名
+        self.alias_poi = array("I")          # 別名 -> 地點索引
+        for line in data.strip().splitlines():
+            name, country, lat, lon, aliases = line.split("|")
+            poi = len(self.names)
+            self.names.append(name)
+            self.countries.append(country)
+            coords.append((float(lat), float(lon)))
+            for alias in dict.fromkeys([name] + aliases.split(",")):
+                key = normalize_place(alias)
+                if key:
+                    self.alias_keys.append(key)
+                    self.alias_poi.append(poi)
+        self.coords = np.array(coords, dtype=np.float64)
+        self._exact = {}
+        for aid, key in enumerate(self.alias_keys):
+            self._exact.setdefault(key, self.alias_poi[aid])
+
+        # 前綴 trie：節點以整數編號，子節點表與各節點的結果清單都放在平行串列
+        self._children = [{}]
+        self._top = [[]]
+        for aid in sorted(range(len(self.alias_keys)), key=lambda i: len(self.alias_keys[i])):
+            node, poi = 0, self.alias_poi[aid]
+            for ch in self.alias_keys[aid]:
+                nxt = self._children[node].get(ch)
+                if nxt is None:
+                    nxt = len(self._children)
+                    self._children[node][ch] = nxt
+                    self._children.append({})
+                    self._top.append([])
+                node = nxt
+                if poi not in self._top[node] and len(self._top[node]) < self.TOP_K:
+                    self._top[node].append(poi)
+        self._top = [tuple(t) for t in self._top]
+
+        # 2-gram 倒排索引
+        grams = {}
+        self.alias_gram_count = array("H")
+        for aid, key in enumerate(self.alias_keys):
+            gs = self._grams(key)
+            self.alias_gram_count.append(len(gs))
+            for g in gs:
+                grams.setdefault(g, array("I")).append(aid)
+        self._postings = grams
+
+    @staticmethod
+    def _grams(key):
+        return {key[i:i + 2] for i in range(len(key) - 1)} if len(key) > 1 else {key}
+
+    def lookup(self, text):
+        """完全符合 (任一別名) 時回傳地點索引"""
+        return self._exact.get(normalize_place(text or ""))
+
+    def prefix(self, text):
+        node = 0
+        for ch in normalize_place(text):
+            node = self._children[node].get(ch)
+            if node is None: return ()
+        return self._top[node] if node else ()
+
+    def fuzzy(self, text, min_score=0.35):
+        """以 Dice 係數比對 2-gram，回傳 [(分數, 地點索引)] 由高到低"""
+        key = normalize_place(text)
+        if len(key) < 2: return []
+        qg = self._grams(key)
+        hits = Counter()
+        for g in qg:
+            hits.update(self._postings.get(g, ()))
+        best = {}
+        for aid, n in hits.items():
+            score = 2 * n / (len(qg) + self.alias_gram_count[aid])
+            poi = self.alias_poi[aid]
+            if score >= min_score and score > best.get(poi, 0):
+                best[poi] = score
+        return sorted(((sc, poi) for poi, sc in best.items()), reverse=True)
+
+    def search(self, text, country=None, limit=6):
+        """自動完成：前綴結果優先，不足時補上模糊比對；目標國家的地點排在前面"""
+        pois = list(self.prefix(text))
+        if len(pois) < limit:
+            pois += [poi for _, poi in self.fuzzy(text) if poi not in pois]
+        pois.sort(key=lambda poi: self.countries[poi] != country)
+        return [self.names[poi] for poi in pois[:limit]]
+
+    def geocode(self, text, min_score=0.6):
+        poi = self.lookup(text)
+        if poi is None:
+            matches = self.fuzzy(text, min_score)
+            poi = matches[0][1] if matches else None
+        return (float(self.coords[poi, 0]), float(self.coords[poi, 1])) if poi is not None else None
+
+@st.cache_resource
+def get_gazetteer():
+    return Gazetteer(GAZETTEER_DATA)
+
+def geocode_location(location):
+    """回傳 (緯度, 經度)；支援 "34.99,135.78" 形式的座標文字，找不到時回傳 None"""
+    if not location: return None
+    loc = location.strip()
+    m = re.match(r"^(-?\d+(?:\.\d+)?)\s*,\s*(-?\d+(?:\.\d+)?)$", loc)
+    if m: return (float(m.group(1)), float(m.group(2)))
+    return get_gazetteer().geocode(loc)
+
+def location_suggestions(widget_key, text, on_pick):
+    """地點輸入框下方的自動完成建議；已是已知地點時不顯示"""
+    if not text or get_gazetteer().lookup(text) is not None: return
+    names = get_gazetteer().search(text, COUNTRY_CODES.get(st.session_state.target_country))
+    if names:
+        st.pills("建議地點", names, key=f"{widget_key}_sugg", label_visibility="collapsed",
+                 on_change=lambda: on_pick(st.session_state[f"{widget_key}_sugg"]))
+
+# --- 路線最佳化：haversine 距離矩陣 + 最近鄰 + 2-opt，固定時間的項目不移動 ---
+def is_pinned_item(item):
+    """抵達、飯店 Check-in 與交通類項目有固定時間，不參與重新排序"""
+    return item.cat in ("trans", "stay") or "抵達" in item.title or "check-in" in item.title.lower()
+
+def haversine_matrix(coords):
+    """coords: (n, 2) 度數陣列，回傳兩兩距離 (公里)；座標缺漏 (NaN) 的距離為 NaN"""
+    lat = np.radians(coords[:, 0])[:, None]
+    lon = np.radians(coords[:, 1])[:, None]
+    a = np.sin((lat - lat.T) / 2) ** 2 + np.cos(lat) * np.cos(lat.T) * np.sin((lon - lon.T) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+@st.cache_resource
+def get_matrix_cache():
+    return LRUCache(maxsize=256)
+
+def distance_matrix(coords):
+    key = tuple(coords)
+    return get_matrix_cache().get(key, lambda *c: haversine_matrix(np.array(c, dtype=float)))
+
+def path_length(dist, order):
+    order = np.asarray(order)
+    return float(dist[order[:-1], order[1:]].sum()) if len(order) > 1 else 0.0
+
+def optimize_stop_order(dist, pinned):
+    """在固定位置不動的前提下，重排其餘位置的停留點。
+    dist 為距離矩陣 (依原順序)，pinned[i] 為第 i 個位置是否固定；回傳新的順序 (原索引串列)"""
+    n = len(pinned)
+    free = [i for i in range(n) if not pinned[i]]
+    # 最近鄰：依序填入空位，每次挑離上一站最近的未排停留點
+    order, remaining = [], set(free)
+    for pos in range(n):
+        if pinned[pos]:
+            order.append(pos)
+            continue
+        if order:
+            prev = order[-1]
+            nxt = min(remaining, key=lambda j: dist[prev, j])
+        else:
+            nxt = min(remaining)
+        remaining.remove(nxt)
+        order.append(nxt)
+
+    improved = True
+    while improved:
+        improved = False
+        # 2-opt：只反轉整段都是可移動位置的區間，一次向量化計算所有 k 的增減
+        for i in range(n):
+            if pinned[i]: continue
+            k_max = i
+            while k_max + 1 < n and not pinned[k_max + 1]: k_max += 1
+            if k_max == i: continue
+            seq = np.array(order)
+            ks = np.arange(i + 1, k_max + 1)
+            b, c = seq[i], seq[ks]
+            delta = np.zeros(len(ks))
+            if i > 0:
+                a = seq[i - 1]
+                delta += dist[a, c] - dist[a, b]
+            has_e = ks + 1 < n
+            e = seq[np.minimum(ks + 1, n - 1)]
+            delta += np.where(has_e, dist[b, e] - dist[c, e], 0.0)
+            best = int(np.argmin(delta))
+            if delta[best] < -1e-9:
+                k = ks[best]
+                order[i:k + 1] = order[i:k + 1][::-1]
+                improved = True
+        # 交換：跨越固定點的兩個可移動位置互換
+        for x in range(len(free)):
+            for y in range(x + 1, len(free)):
+                p, q = free[x], free[y]
+                cand = order[:]
+                cand[p], cand[q] = cand[q], cand[p]
+                if path_length(dist, cand) < path_length(dist, order) - 1e-9:
+                    order = cand
+                    improved = True
+    return order
+
+def propose_day_route(items):
+    """回傳 (建議順序的項目串列, 原距離 km, 新距離 km)；可排序的停留點不足時回傳 None。
+    無法定位的項目留在原位且不計入距離 (只在能定位的停留點之間排序)；有這種項目時距離無從比較，回傳 None"""
+    coords = [geocode_location(item.loc) for item in items]
+    located = [i for i, c in enumerate(coords) if c]
+    pinned = [is_pinned_item(items[i]) for i in located]
+    if sum(not p for p in pinned) < 2: return None
+    dist = distance_matrix([coords[i] for i in located])
+    sub_order = optimize_stop_order(dist, pinned)
+    order = list(range(len(items)))
+    for pos, k in zip(located, sub_order): order[pos] = located[k]
+    if len(located) < len(items): return [items[i] for i in order], None, None
+    return [items[i] for i in order], path_length(dist, range(len(items))), path_length(dist, sub_order)
+
+# --- 行程可行性：依座標與交通方式估算移動時間，標出時間重疊與來不及的銜接 ---
+# 交通方式 -> (平均時速 km/h, 固定耗時 分鐘 (候車/轉乘/報到), 路線繞行係數)
+TRANSPORT_PROFILES = {
+    "🚆 電車": (55.0, 10, 1.3), "🚌 巴士": (18.0, 8, 1.4), "🚶 步行": (4.5, 0, 1.3),
+    "🚕 計程車": (25.0, 3, 1.4), "🚗 自駕": (30.0, 5, 1.4), "🚢 船": (20.0, 20, 1.2), "✈️ 飛機": (600.0, 120, 1.1),
+}
+DEFAULT_TRANSPORT_PROFILE = (25.0, 10, 1.4)   # 📍 移動 等未指定方式
+
+def haversine_pairs(start, end):
+    """start/end: (n, 2) 度數陣列，回傳逐列距離 (公里)；座標缺漏時為 NaN"""
+    lat1, lon1, lat2, lon2 = np.radians(start[:, 0]), np.radians(start[:, 1]), np.radians(end[:, 0]), np.radians(end[:, 1])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371.0 * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _compute_leg_minutes(legs):
+    """legs: [(起點, 終點, 交通方式), ...]，一次向量化估算；無法定位的路段為 None"""
+    unknown = (float("nan"), float("nan"))
+    start = np.array([geocode_location(a) or unknown for a, _, _ in legs], dtype=float)
+    end = np.array([geocode_location(b) or unknown for _, b, _ in legs], dtype=float)
+    speed, overhead, detour = np.array([TRANSPORT_PROFILES.get(m, DEFAULT_TRANSPORT_PROFILE) for _, _, m in legs], dtype=float).T
+    km = haversine_pairs(start, end) * detour
+    minutes = np.where(km < 0.2, 0, np.ceil(km / speed * 60 + overhead))
+    return [None if math.isnan(m) else int(m) for m in minutes]
+
+@st.cache_resource
+def get_leg_cache():
+    return LRUCache(maxsize=4096)
+
+@PERF.timed("schedule.check")
+def check_schedule(trip_store, days=None):
+    """檢查各天相鄰行程的銜接，回傳 (預估交通分鐘 {項目 id: 分}, 問題 {項目 id: [訊息, ...]})。
+    路段估算依 (起點, 終點, 交通方式) 快取，編輯時只有變動的路段需要重新計算"""
+    pairs = []
+    for day in days or trip_store.days():
+        items = trip_store.day_items(day)
+        pairs.extend(zip(items, items[1:]))
+    estimates = get_leg_cache().get_batch([(a.loc, b.loc, a.trans_mode) for a, b in pairs], _compute_leg_minutes)
+    leg_minutes, issues = {}, {}
+    for (a, b), est in zip(pairs, estimates):
+        gap = b.minute - a.minute
+        leg_minutes[a.id] = est
+        if gap <= 0:
+            issues.setdefault(b.id, []).append(f"與「{a.title}」時間重疊 ({b.time})")
+        elif est is not None and est > gap:
+            issues.setdefault(a.id, []).append(f"{a.trans_mode} 前往「{b.title}」預估 {est} 分，但只有 {gap} 分")
+        elif a.trans_min > gap:
+            issues.setdefault(a.id, []).append(f"交通 {a.trans_min} 分超過與「{b.title}」的間隔 {gap} 分")
+    return leg_minutes, issues
+
 def get_category_icon(cat):
     icons = {"trans": "🚃", "food": "🍱", "stay": "🏨", "spot": "⛩️", "shop": "🛍️", "other": "📍"}
     return icons.get(cat, "📍")
 
-def process_excel_upload(uploaded_file):
-    try:
-        df = pd.read_excel(uploaded_file)
-        required_cols = ['Day', 'Time', 'Title']
-        if not all(col in df.columns for col in required_cols):
-            st.error("Excel 格式錯誤：缺少 Day, Time 或 Title 欄位")
+# --- 行程卡片渲染：HTML 片段依內容 + 主題快取，編輯表單以 fragment 隔離 ---
+@st.cache_resource
+def get_render_cache():
+    return LRUCache(maxsize=2048)
+
+def _card_html(time_str, title, loc, note, expenses, final_cost, symbol, theme_name):
+    theme = THEMES[theme_name]
+    map_link = get_single_map_link(loc)
+    map_btn = f'<a href="{map_link}" target="_blank" style="text-decoration:none; margin-left:8px; font-size:0.8rem; background:{theme["secondary"]}; color:white; padding:2px 8px; border-radius:10px; opacity:0.8;">🗺️</a>' if loc else ""
+    
+    cost_display = ""
+    if final_cost > 0:
+        cost_display = f'<div style="background:{theme["primary"]}; color:white; padding:3px 8px; border-radius:12px; font-size:0.75rem; font-weight:bold; white-space:nowrap;">{symbol}{final_cost:,}</div>'
+
+    clean_note = note.replace('\n', '<br>')
+    note_div = f'<div style="font-size:0.85rem; color:{theme["sub"]}; background:{theme["bg"]}; padding:8px; border-radius:8px; margin-top:8px; line-height:1.4;">📝 {clean_note}</div>' if note else ""
+    
+    # 記帳細項顯示
+    expense_details_html = ""
+    if expenses:
+        rows = ""
+        for name, price in expenses:
+             rows += f"<div style='display:flex; justify-content:space-between; font-size:0.8rem; color:#888; margin-top:2px;'><span>{name}</span><span>{symbol}{price:,}</span></div>"
+        expense_details_html = f"<div style='margin-top:8px; padding-top:5px; border-top:1px dashed {theme['secondary']}; opacity:0.8;'>{rows}</div>"
+
+    # 卡片 HTML (壓縮單行)
+    return f"""<div style="display:flex; gap:15px; margin-bottom:0px;"><div style="display:flex; flex-direction:column; align-items:center; width:50px;"><div style="font-weight:700; color:{theme['text']}; font-size:1.1rem;">{time_str}</div><div style="flex-grow:1; width:2px; background:{theme['secondary']}; margin:5px 0; opacity:0.3; border-radius:2px;"></div></div><div style="flex-grow:1;"><div class="apple-card" style="margin-bottom:0px;"><div style="display:flex; justify-content:space-between; align-items:flex-start;"><div class="apple-title" style="margin-top:0;">{title}</div>{cost_display}</div><div class="apple-loc">📍 {loc or '未設定'} {map_btn}</div>{note_div}{expense_details_html}</div></div></div>"""
+
+def _trans_html(t_mode, t_min, estimate, problem, theme_name):
+    theme = THEMES[theme_name]
+    hint = f" · 預估 {estimate} 分" if estimate is not None and abs(estimate - t_min) >= 10 else ""
+    flag = "⚠️ " if problem else ""
+    return f"""<div style="display:flex; gap:15px;"><div style="display:flex; flex-direction:column; align-items:center; width:50px;"><div style="flex-grow:1; width:2px; border-left:2px dashed {theme['secondary']}; margin:0; opacity:0.6;"></div></div><div style="flex-grow:1; padding:10px 0;"><span class="trans-badge">{flag}{t_mode} 約 {t_min} 分{hint}</span></div></div>"""
+
+def card_html(item, theme_name, show_note=True):
+    final_cost = item.actual if item.actual > 0 else item.cost
+    key = ("card", item.time, item.title, item.loc, item.note if show_note else "",
+           tuple((x['name'], x['price']) for x in item.expenses), final_cost, CURRENCY_SYMBOLS.get(trip_currency(), trip_currency()), theme_name)
+    return get_render_cache().get(key, lambda *k: _card_html(*k[1:]))
+
+def trans_html(item, theme_name, estimate=None, problem=False):
+    key = ("trans", item.trans_mode, item.trans_min, estimate, problem, theme_name)
+    return get_render_cache().get(key, lambda *k: _trans_html(*k[1:]))
+
+def day_timeline_html(items, theme_name, leg_minutes=None, issues=None):
+    """瀏覽模式：整天的卡片與交通資訊合成一段 HTML，只呼叫一次 st.markdown"""
+    leg_minutes, issues = leg_minutes or {}, issues or {}
+    parts = []
+    for index, item in enumerate(items):
+        parts.append(card_html(item, theme_name))
+        if index < len(items) - 1:
+            parts.append(trans_html(item, theme_name, leg_minutes.get(item.id), item.id in issues))
+    return "".join(parts)
+
+@st.fragment
+def render_item_editor(item_id, is_last):
+    """編輯模式的單張卡片：只有這張卡片的輸入會觸發這段重跑；時間/預算/刪除等影響排序或小計的操作才重跑整頁"""
+    if st.session_state.pop("totals_changed", False):
+        st.rerun(scope="app")
+    trip_store = st.session_state.trip_store
+    item = trip_store.get(item_id)
+    if item is None: return
+    version = trip_store.version
+    st.markdown(card_html(item, st.session_state.selected_theme_name, show_note=False), unsafe_allow_html=True)
+
+    with st.container(border=True):
+        c1, c2 = st.columns([2, 1])
+        trip_store.edit(item.id, title=c1.text_input("名稱", item.title, key=f"t_{item.id}"))
+        new_time = c2.time_input("時間", dt_time(item.minute // 60, item.minute % 60), key=f"tm_{item.id}")
+        trip_store.edit(item.id, loc=st.text_input("地點", item.loc, key=f"l_{item.id}"))
+        location_suggestions(f"l_{item.id}", item.loc,
+                             lambda name: (trip_store.edit(item.id, loc=name), st.session_state.pop(f"l_{item.id}", None)))
+        currency = trip_currency()
+        new_cost = st.number_input(f"預算 ({CURRENCY_SYMBOLS.get(currency, currency)})", value=item.cost, step=100, key=f"c_{item.id}")
+        trip_store.edit(item.id, note=st.text_area("備註", item.note, key=f"n_{item.id}"))
+        
+        cx1, cx2, cx3, cx4 = st.columns([2, 1, 1, 1])
+        cx1.text_input("支出項目", key=f"new_exp_n_{item.id}", placeholder="項目", label_visibility="collapsed")
+        cx2.number_input("金額", min_value=0, key=f"new_exp_p_{item.id}", label_visibility="collapsed")
+        cx3.selectbox("幣別", list(dict.fromkeys([currency, HOME_CURRENCY, *DEFAULT_RATES])), key=f"new_exp_c_{item.id}", label_visibility="collapsed")
+        cx4.button("➕", key=f"add_{item.id}", on_click=add_expense_callback, args=(item.id,))
+        members = st.session_state.members
+        if len(members) > 1:
+            cy1, cy2 = st.columns([1, 2])
+            cy1.selectbox("付款人", members, key=f"new_exp_w_{item.id}")
+            cy2.multiselect("分攤", members, default=members, key=f"new_exp_s_{item.id}")
+        
+        if item.expenses:
+            with st.expander("管理細項"):
+                 for i_ex, ex in enumerate(item.expenses):
+                     c_d1, c_d2, c_d3 = st.columns([3,1,1])
+                     c_d1.text(("🧾 " if ex.get("receipt") else "") + expense_label(ex, currency))
+                     if c_d2.button("📎", key=f"att_exp_{item.id}_{i_ex}", help="收據照片"):
+                         open_attachment(("exp", item.id, ex.get("id")))
+                     if c_d3.button("刪", key=f"del_exp_{item.id}_{i_ex}"):
+                         trip_store.remove_expense(item.id, i_ex)
+                         st.rerun()
+
+        if st.button("🗑️ 刪除行程", key=f"del_{item.id}"):
+            trip_store.remove(item.id)
+            st.rerun()
+
+    # 交通資訊
+    if not is_last:
+        t_mode = item.trans_mode
+        ct1, ct2 = st.columns([1,1])
+        trip_store.edit(item.id,
+                        trans_mode=ct1.selectbox("交通", TRANSPORT_OPTIONS, index=TRANSPORT_OPTIONS.index(t_mode) if t_mode in TRANSPORT_OPTIONS else 0, key=f"trm_{item.id}"),
+                        trans_min=ct2.number_input("分", value=item.trans_min, step=5, key=f"trmin_{item.id}"))
+
+    # 只重算這張卡片所在的一天；未變動的路段直接取快取
+    leg_minutes, issues = check_schedule(trip_store, [item.day])
+    if leg_minutes.get(item.id) is not None:
+        st.caption(f"🧭 依距離預估約 {leg_minutes[item.id]} 分")
+    for msg in issues.get(item.id, []):
+        st.error(f"⚠️ {msg}")
+
+    if new_time.hour * 60 + new_time.minute != item.minute or new_cost != item.cost:
+        trip_store.update(item.id, minute=new_time.hour * 60 + new_time.minute, cost=new_cost)
+        st.rerun()
+    # 只重跑片段時不會執行到頁尾的自動同步：名稱、地點、備註、交通有改就在這裡送出
+    if trip_store.version != version and st.session_state.get("autosave"):
+        queue_autosave()
+
+# --- 多幣別記帳：支出攤平成欄位式帳本，依支出日期的匯率換算成台幣；退稅估算與分帳以 pandas 整欄計算 ---
+HOME_CURRENCY = "TWD"
+COUNTRY_CURRENCIES = {"日本": "JPY", "韓國": "KRW", "泰國": "THB", "台灣": "TWD"}
+CURRENCY_SYMBOLS = {"JPY": "¥", "KRW": "₩", "THB": "฿", "TWD": "NT$", "USD": "US$"}
+DEFAULT_RATES = {"JPY": 0.215, "KRW": 0.023, "THB": 0.92, "USD": 32.0, "TWD": 1.0}   # 1 外幣 = ? 台幣 (離線或查不到時使用)
+JP_TAX_FREE_MIN = 5000         # 日本免稅門檻：同一店家同一天未稅滿 ¥5,000
+JP_CONSUMPTION_TAX = 0.10
+LEDGER_COLUMNS = ["item_id", "day", "cat", "title", "name", "amount", "currency", "at", "payer", "split"]
+
+def trip_currency():
+    return COUNTRY_CURRENCIES.get(st.session_state.target_country, "JPY")
+
+def format_money(amount, currency):
+    return f"{CURRENCY_SYMBOLS.get(currency, currency + ' ')}{amount:,.0f}"
+
+class FixedRateProvider:
+    """本機替身：每個幣別一個固定匯率，不分日期"""
+    name = "fixed"
+
+    def __init__(self, rates):
+        self.rates = dict(rates)
+
+    def get_rates(self, keys):
+        """keys 為 [(幣別, "YYYY-MM-DD"), ...]，回傳對台幣的匯率 (查不到為 None)"""
+        return [self.rates.get(cur) for cur, _ in keys]
+
+    def cache_key(self):
+        return (self.name, tuple(sorted(self.rates.items())))
+
+class HistoricalRateProvider:
+    """歷史匯率 (每天一張以台幣為基準的匯率表)：各日期並行抓取，寫入磁碟 TTL 快取與記憶體；
+    未來日期用最新匯率，查不到的幣別/日期退回呼叫時傳入的 fallback (各 session 的固定匯率)。
+    程序共用一份 (連線池與執行緒)，各 session 透過 with_fallback 取得自己的檢視"""
+    name = "history"
+
+    def __init__(self, url_template, cache, timeout=3.0, max_workers=8):
+        self.url_template = url_template
+        self.cache = cache
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="rates")
+        self._tables = {}    # 日期 -> {幣別: 對台幣匯率}；失敗的日期不記，下次再試
+        self._lock = threading.Lock()
+        self.stats = {"fetches": 0, "failures": 0}
+
+    def get_rates(self, keys, fallback):
+        today = datetime.now().strftime("%Y-%m-%d")
+        days = [min(date, today) for _, date in keys]
+        with self._lock:
+            missing = [d for d in dict.fromkeys(days) if d not in self._tables]
+        for day, table in zip(missing, self.pool.map(self._table, missing)):
+            if table:
+                with self._lock: self._tables[day] = table
+        fixed = fallback.get_rates(keys)
+        return [self._tables.get(day, {}).get(cur, rate) for (cur, _), day, rate in zip(keys, days, fixed)]
+
+    def _table(self, day):
+        key = f"rates:{HOME_CURRENCY}:{day}"
+        cached = self.cache.get(key)
+        if cached is not None: return cached
+        try:
+            table = self._fetch(day)
+        except (requests.RequestException, KeyError, ValueError, ZeroDivisionError):
+            with self._lock: self.stats["failures"] += 1
+            return None
+        self.cache.set(key, table)
+        return table
+
+    @PERF.timed("http.rates")
+    def _fetch(self, day):
+        with self._lock: self.stats["fetches"] += 1
+        label = "latest" if day == datetime.now().strftime("%Y-%m-%d") else day
+        resp = self.session.get(self.url_template.format(date=label), timeout=self.timeout)
+        resp.raise_for_status()
+        per_home = resp.json()[HOME_CURRENCY.lower()]   # 1 台幣 = ? 外幣
+        return {cur: 1 / per_home[cur.lower()] for cur in DEFAULT_RATES if per_home.get(cur.lower())}
+
+    def with_fallback(self, fallback):
+        return SessionRateProvider(self, fallback)
+
+class SessionRateProvider:
+    """共用的 HistoricalRateProvider 加上這個 session 的固定匯率；每次呼叫時建立，不持有資源"""
+    def __init__(self, history, fallback):
+        self.history = history
+        self.fallback = fallback
+        self.name = history.name
+
+    def get_rates(self, keys):
+        return self.history.get_rates(keys, self.fallback)
+
+    def cache_key(self):
+        return (self.name, self.fallback.cache_key())
+
+@st.cache_resource
+def _historical_rate_provider(url_template, cache_dir, ttl):
+    return HistoricalRateProvider(url_template, DiskTTLCache(cache_dir, ttl))
+
+def get_rate_provider():
+    """預設為固定匯率 (行程幣別採用設定中的匯率)；設定 rate_provider=history 時查歷史匯率"""
+    rates = {**DEFAULT_RATES, trip_currency(): st.session_state.exchange_rate, HOME_CURRENCY: 1.0}
+    if get_setting("rate_provider", "fixed") == "history":
+        return _historical_rate_provider(
+            get_setting("rate_history_url", "https://cdn.jsdelivr.net/npm/@fawazahmed0/currency-api@{date}/v1/currencies/twd.json"),
+            get_setting("rate_cache_dir", os.path.join(tempfile.gettempdir(), "trip_rate_cache")),
+            float(get_setting("rate_ttl", 30 * 86400))).with_fallback(FixedRateProvider(rates))
+    return FixedRateProvider(rates)
+
+def convert_amount(amount, from_cur, to_cur, date_str, provider=None):
+    if from_cur == to_cur: return amount
+    src, dst = (provider or get_rate_provider()).get_rates([(from_cur, date_str), (to_cur, date_str)])
+    return amount * src / dst if src and dst else amount
+
+def expense_timestamp(item, start_date, now=None):
+    """實際花費時間：當天記帳用現在時間，否則用行程排定的時間"""
+    now = now or datetime.now()
+    item_date = start_date + timedelta(days=item.day - 1)
+    if now.strftime("%Y-%m-%d") == f"{item_date:%Y-%m-%d}": return now.strftime("%Y-%m-%dT%H:%M:%S")
+    return f"{item_date:%Y-%m-%d}T{item.time}:00"
+
+def expense_label(exp, currency):
+    """管理細項的一行文字；舊格式 {"name", "price"} 視為行程幣別"""
+    cur = exp.get("currency", currency)
+    text = f"{exp['name']} {format_money(exp.get('amount', exp['price']), cur)}"
+    if cur != currency: text += f" (≈{format_money(exp['price'], currency)})"
+    if exp.get("payer"): text += f" · {exp['payer']} 付"
+    if exp.get("split"): text += f" · {'/'.join(exp['split'])} 分"
+    return text
+
+def build_ledger(trip_store, start_date, currency, members):
+    """所有支出攤平成一張表 (每筆一列)；缺少的欄位：幣別 = 行程幣別、時間 = 行程時間、付款人 = 第一位成員、分攤 = 全部成員"""
+    cols = {c: [] for c in LEDGER_COLUMNS}
+    for day in trip_store.days():
+        item_date = start_date + timedelta(days=day - 1)
+        for item in trip_store.day_items(day):
+            for exp in item.expenses:
+                cols["item_id"].append(item.id)
+                cols["day"].append(day)
+                cols["cat"].append(item.cat)
+                cols["title"].append(item.title)
+                cols["name"].append(exp["name"])
+                cols["amount"].append(exp.get("amount", exp["price"]))
+                cols["currency"].append(exp.get("currency", currency))
+                cols["at"].append(exp.get("at") or f"{item_date:%Y-%m-%d}T{item.time}:00")
+                cols["payer"].append(exp.get("payer") or members[0])
+                cols["split"].append(exp.get("split") or members)
+    df = pd.DataFrame(cols)
+    df["amount"] = df["amount"].astype(float)
+    df["at"] = pd.to_datetime(df["at"])
+    df["date"] = df["at"].dt.strftime("%Y-%m-%d")
+    return df
+
+def convert_ledger(df, provider):
+    """每個 (幣別, 日期) 只查一次匯率，再整欄相乘得到台幣金額"""
+    pairs = df[["currency", "date"]].drop_duplicates()
+    pairs["rate"] = provider.get_rates(list(pairs.itertuples(index=False, name=None)))
+    df = df.merge(pairs, on=["currency", "date"], how="left")
+    df["rate"] = df["rate"].astype(float)
+    df["home"] = df["amount"] * df["rate"]
+    return df
+
+def tax_free_estimate(df):
+    """日本退稅估算 (沿用 金額/1.1 的算法)：購物類、日圓，同一行程 (店家) 同一天合計未稅滿門檻才算"""
+    shop = df[(df["currency"] == "JPY") & (df["cat"] == "shop")]
+    per_store = shop.groupby(["date", "item_id"])["amount"].sum()
+    excl = per_store / (1 + JP_CONSUMPTION_TAX)
+    eligible = excl >= JP_TAX_FREE_MIN
+    refund = (per_store - excl)[eligible]
+    rates = shop.groupby(["date", "item_id"])["rate"].mean()[eligible]
+    return {"stores": int(eligible.sum()), "spend": float(per_store[eligible].sum()),
+            "refund": float(refund.sum()), "refund_home": float((refund * rates).sum())}
+
+def settle(df, members):
+    """分帳：每筆依分攤名單平均分，(已付 - 應付) 為淨額，再以最少筆數的轉帳結清"""
+    shares = df[["home", "split"]].assign(n=df["split"].str.len()).explode("split")
+    owed = (shares["home"] / shares["n"]).groupby(shares["split"]).sum()
+    paid = df.groupby("payer")["home"].sum()
+    people = list(dict.fromkeys(list(members) + list(paid.index) + list(owed.index)))
+    balance = paid.reindex(people, fill_value=0).sub(owed.reindex(people, fill_value=0)).round(2)
+    creditors = [[p, v] for p, v in balance.sort_values(ascending=False).items() if v > 0.5]
+    debtors = [[p, -v] for p, v in balance.sort_values().items() if v < -0.5]
+    transfers = []
+    i = j = 0
+    while i < len(debtors) and j < len(creditors):
+        amount = min(debtors[i][1], creditors[j][1])
+        transfers.append((debtors[i][0], creditors[j][0], amount))
+        debtors[i][1] -= amount
+        creditors[j][1] -= amount
+        if debtors[i][1] <= 0.5: i += 1
+        if creditors[j][1] <= 0.5: j += 1
+    return balance, transfers
+
+@PERF.timed("ledger.summarize")
+def summarize_ledger(trip_store, start_date, currency, members, provider):
+    df = build_ledger(trip_store, start_date, currency, members)
+    if df.empty: return None
+    df = convert_ledger(df, provider)
+    balance, transfers = settle(df, members)
+    return {
+        "ledger": df,
+        "total_home": float(df["home"].sum()),
+        "count": len(df),
+        "by_cat": df.groupby("cat")["home"].sum().sort_values(ascending=False),
+        "by_currency": df.groupby("currency").agg(amount=("amount", "sum"), home=("home", "sum")),
+        "by_payer": df.groupby("payer")["home"].sum(),
+        "balance": balance,
+        "transfers": transfers,
+        "tax_free": tax_free_estimate(df) if currency == "JPY" else None,
+    }
+
+def get_ledger_summary():
+    """依 (行程物件, 版本, 出發日, 成員, 幣別, 匯率來源) 快取；資料沒變時切換頁面不需重算"""
+    trip_store = st.session_state.trip_store
+    provider = get_rate_provider()
+    key = (id(trip_store), trip_store.version, st.session_state.start_date, tuple(st.session_state.members), trip_currency(), provider.cache_key())
+    cache = st.session_state.setdefault("ledger_cache", {})
+    if cache.get("key") != key:
+        cache["summary"] = summarize_ledger(trip_store, st.session_state.start_date, trip_currency(), st.session_state.members, provider)
+        cache["key"] = key
+    return cache["summary"]
+
+# --- 花費分析圖表：背景執行緒繪圖，結果依 (圖表, 資料雜湊) 快取；資料沒變的 rerun 直接取用 ---
+CHART_CATEGORIES = ["trans", "food", "stay", "spot", "shop", "other"]
+CHART_CATEGORY_LABELS = {"trans": "交通", "food": "美食", "stay": "住宿", "spot": "景點", "shop": "購物", "other": "其他"}
+
+class ChartRenderer:
+    """全程序共用的繪圖執行緒池；快取的是 Future，多個 session 同時要同一張圖時只畫一次"""
+    def __init__(self, max_workers=2, maxsize=128):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="charts")
+        self.maxsize = maxsize
+        self._results = OrderedDict()   # (圖表, 資料雜湊) -> Future
+        self._lock = threading.Lock()
+        self._font_lock = threading.Lock()
+        self._font_ready = False
+
+    def submit(self, kind, data, render):
+        key = (kind, _row_hash(json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)))
+        with self._lock:
+            future = self._results.get(key)
+            if future is not None and not (future.done() and future.exception()):
+                self._results.move_to_end(key)
+                PERF.count("charts.cached")
+                return future
+            future = self.pool.submit(render, self, data)
+            self._results[key] = future
+            while len(self._results) > self.maxsize:
+                self._results.popitem(last=False)
+        PERF.count("charts.rendered")
+        return future
+
+    def use_font(self, font_path):
+        """第一次繪圖時註冊中文字型 (找不到時用 matplotlib 預設字型)"""
+        with self._font_lock:
+            if self._font_ready: return
+            import matplotlib
+            from matplotlib import font_manager
+            if font_path and os.path.exists(font_path):
+                font_manager.fontManager.addfont(font_path)
+                name = font_manager.FontProperties(fname=font_path).get_name()
+                matplotlib.rcParams["font.family"] = [name, "DejaVu Sans"]
+            self._font_ready = True
+
+@st.cache_resource
+def get_chart_renderer():
+    return ChartRenderer()
+
+def _figure_png(fig):
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", dpi=144, bbox_inches="tight")
+    return buf.getvalue()
+
+def chart_data(trip_store, theme, currency):
+    """圖表用的資料 (純 list，可直接雜湊)：每天每類別的花費 (有支出用實際，否則用預算)，以及每天的預算/實際；
+    金額為行程幣別 currency"""
+    days = trip_store.days()
+    spend = np.zeros((len(days), len(CHART_CATEGORIES)), dtype=np.int64)
+    col = {cat: i for i, cat in enumerate(CHART_CATEGORIES)}
+    for row, day in enumerate(days):
+        for item in trip_store.day_items(day):
+            spend[row, col.get(item.cat, col["other"])] += item.actual if item.actual > 0 else item.cost
+    totals = [trip_store.day_totals(day) for day in days]
+    return {
+        "days": days, "spend": spend.tolist(),
+        "budget": [c for c, _ in totals], "actual": [a for _, a in totals],
+        "colors": [theme["primary"], theme["secondary"], theme["sub"]],
+        "symbol": CURRENCY_SYMBOLS.get(currency, currency),
+        "font": get_setting("cjk_font_path", "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc"),
+    }
+
+def render_spend_chart(renderer, data):
+    from matplotlib.figure import Figure   # 在背景執行緒才載入 (第一次約 0.3 s)
+    from matplotlib import colormaps
+    renderer.use_font(data["font"])
+    spend = np.array(data["spend"]).reshape(len(data["days"]), len(CHART_CATEGORIES))
+    fig = Figure(figsize=(7, 3.2))
+    ax = fig.subplots()
+    x = np.arange(len(data["days"]))
+    bottom = np.zeros(len(x))
+    colors = colormaps["Set2"].colors
+    for i, cat in enumerate(CHART_CATEGORIES):
+        if spend[:, i].any():
+            ax.bar(x, spend[:, i], bottom=bottom, label=CHART_CATEGORY_LABELS[cat], color=colors[i % len(colors)])
+            bottom += spend[:, i]
+    ax.set_xticks(x, [f"D{d}" for d in data["days"]])
+    ax.set_ylabel(data["symbol"])
+    ax.set_title("每日花費 (依類別)")
+    ax.legend(ncols=3, fontsize=8, frameon=False)
+    ax.spines[["top", "right"]].set_visible(False)
+    return _figure_png(fig)
+
+def render_budget_chart(renderer, data):
+    from matplotlib.figure import Figure
+    renderer.use_font(data["font"])
+    fig = Figure(figsize=(7, 3.2))
+    ax = fig.subplots()
+    x = np.arange(len(data["days"]))
+    ax.bar(x - 0.2, data["budget"], width=0.4, label="預算", color=data["colors"][1])
+    ax.bar(x + 0.2, data["actual"], width=0.4, label="實際", color=data["colors"][0])
+    ax.set_xticks(x, [f"D{d}" for d in data["days"]])
+    sym = data["symbol"]
+    ax.set_ylabel(sym)
+    ax.set_title(f"預算 vs 實際 (全程 {sym}{sum(data['budget']):,} / {sym}{sum(data['actual']):,})")
+    ax.legend(frameon=False)
+    ax.spines[["top", "right"]].set_visible(False)
+    return _figure_png(fig)
+
+def route_graph_data(trip_store, day, leg_minutes, theme):
+    return {
+        "day": day, "colors": [theme["primary"], theme["secondary"], theme["text"]],
+        "stops": [[item.id, item.time, item.title, item.loc, item.trans_mode, item.trans_min, leg_minutes.get(item.id)]
+                  for item in trip_store.day_items(day)],
+    }
+
+def render_route_graph(renderer, data):
+    """回傳 DOT 原始碼 (由前端的 st.graphviz_chart 排版，不需要主機上的 dot 執行檔)"""
+    import graphviz
+    primary, secondary, text = data["colors"]
+    g = graphviz.Digraph(graph_attr={"rankdir": "TB", "bgcolor": "transparent", "label": f"Day {data['day']}", "fontcolor": text},
+                         node_attr={"shape": "box", "style": "rounded,filled", "fillcolor": "white", "color": primary, "fontcolor": text},
+                         edge_attr={"color": secondary, "fontcolor": text, "fontsize": "10"})
+    stops = data["stops"]
+    for stop_id, time_str, title, loc, _, _, _ in stops:
+        g.node(str(stop_id), f"{time_str}  {title}" + (f"\n📍 {loc}" if loc else ""))
+    for (a, *_, mode, minutes, estimate), (b, *_) in zip(stops, stops[1:]):
+        g.edge(str(a), str(b), label=f"{mode} {minutes} 分" + (f" (估 {estimate} 分)" if estimate is not None else ""))
+    return g.source
+
+# --- 附件 (收據 / 願望照片)：裁切後在背景執行緒縮小並重新編碼，以內容雜湊為檔名存到磁碟；session 只記附件 id ---
+ATTACHMENT_ID_RE = re.compile(r"^[0-9a-f]{32}\.(webp|jpg)$")
+ATTACHMENT_MAX_UPLOAD = 25 * 2 ** 20   # 上傳檔上限
+
+class AttachmentStore:
+    """內容定址的附件檔：<目錄>/<雜湊前 2 碼>/<id> 為原圖 (長邊最多 MAX_SIDE)，<目錄>/thumbs/<id> 為縮圖。
+    縮圖位元組放在程序共用、有上限的 LRU；原圖只在要看的時候才讀檔。
+    儲存在按下「儲存」的那次執行中同步完成 (呼叫端需要附件 id 才能寫回紀錄)"""
+    MAX_SIDE = 1600
+    THUMB_SIDE = 320
+    QUALITY = 80
+
+    def __init__(self, directory, thumb_cache=512):
+        self.directory = directory
+        self.thumbs = LRUCache(maxsize=thumb_cache)   # 每張縮圖約 10–30 KB
+        self.format, self.ext = ("WEBP", "webp") if PIL_features.check("webp") else ("JPEG", "jpg")
+        self.stats = {"stored": 0, "deduped": 0}
+
+    def path(self, att_id, thumb=False):
+        if not ATTACHMENT_ID_RE.match(att_id or ""): raise ValueError(f"無效的附件 id: {att_id!r}")
+        return os.path.join(self.directory, "thumbs" if thumb else att_id[:2], att_id)
+
+    def put(self, image):
+        """回傳附件 id"""
+        return self._store(image)
+
+    def _encode(self, image):
+        buf = io.BytesIO()
+        image.save(buf, self.format, quality=self.QUALITY, **({"method": 4} if self.format == "WEBP" else {"optimize": True}))
+        return buf.getvalue()
+
+    def _write(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    @PERF.timed("attachments.store")
+    def _store(self, image):
+        image = image.convert("RGB")
+        image.thumbnail((self.MAX_SIDE, self.MAX_SIDE), PIL_Image.Resampling.LANCZOS)
+        data = self._encode(image)
+        att_id = f"{hashlib.sha256(data).hexdigest()[:32]}.{self.ext}"
+        if os.path.exists(self.path(att_id)):
+            self.stats["deduped"] += 1
+            return att_id
+        self._write(self.path(att_id), data)
+        image.thumbnail((self.THUMB_SIDE, self.THUMB_SIDE), PIL_Image.Resampling.LANCZOS)
+        self._write(self.path(att_id, thumb=True), self._encode(image))
+        self.stats["stored"] += 1
+        return att_id
+
+    def _read_thumbnail(self, att_id):
+        try:
+            with open(self.path(att_id, thumb=True), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None   # 附件檔不在這台主機 (例如從其他裝置同步來的行程)
+
+    def thumbnail(self, att_id):
+        return self.thumbs.get((att_id,), self._read_thumbnail)
+
+    def full(self, att_id):
+        try:
+            with open(self.path(att_id), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+@st.cache_resource
+def _attachment_store(directory):
+    return AttachmentStore(directory)
+
+def get_attachment_store():
+    return _attachment_store(get_setting("attachment_dir", "trip_attachments"))
+
+def open_upload_image(uploaded_file):
+    """讀入上傳的照片並先縮到 AttachmentStore.MAX_SIDE (JPEG 以 draft 直接低解析度解碼)，裁切時只保留這一張"""
+    image = PIL_Image.open(uploaded_file)
+    image.draft("RGB", (AttachmentStore.MAX_SIDE, AttachmentStore.MAX_SIDE))
+    image = PIL_ImageOps.exif_transpose(image)
+    image.thumbnail((AttachmentStore.MAX_SIDE, AttachmentStore.MAX_SIDE))
+    return image
+
+def attachment_target_record(target):
+    """target 為 ("exp", 行程 id, 支出 id) 或 ("wish", 願望 id)；回傳存放附件 id 的 dict 與欄位名"""
+    if target[0] == "exp":
+        item = st.session_state.trip_store.get(target[1])
+        exp = next((x for x in item.expenses if x.get("id") == target[2]), None) if item else None
+        if exp: return exp, "receipt"
+    elif target[0] == "wish":
+        wish = next((w for w in st.session_state.wishlist if w["id"] == target[1]), None)
+        if wish: return wish, "photo"
+    return None, None
+
+def set_attachment(target, att_id):
+    """寫回 (att_id 為 None 時移除) 附件 id；支出透過 TripStore 修改，version 才會遞增"""
+    if target[0] == "exp":
+        st.session_state.trip_store.edit_expense(target[1], target[2], receipt=att_id)
+        return
+    record, field = attachment_target_record(target)
+    if record is None: return
+    if att_id: record[field] = att_id
+    else: record.pop(field, None)
+
+def open_attachment(target):
+    """在 fragment 或回呼中呼叫：記下目標後整頁重跑，由主程式開啟附件視窗"""
+    st.session_state.attachment_target = target
+    st.rerun()
+
+@st.dialog("📎 附件", width="large")
+def attachment_dialog(target):
+    record, field = attachment_target_record(target)
+    if record is None:
+        st.warning("找不到這筆資料 (可能已被刪除)")
+        return
+    store = get_attachment_store()
+    st.caption(record.get("name") or record.get("title", ""))
+    current = record.get(field)
+    if current:
+        thumb = store.thumbnail(current)
+        if thumb: st.image(thumb, width=AttachmentStore.THUMB_SIDE)
+        else: st.caption("附件檔不在這台主機上")
+        c_a1, c_a2 = st.columns(2)
+        if thumb and c_a1.toggle("查看原圖", key="attach_full"):
+            st.image(store.full(current), use_container_width=True)
+        if c_a2.button("🗑️ 移除附件"):
+            set_attachment(target, None)
+            st.rerun()
+
+    uploaded = st.file_uploader("上傳照片" if not current else "更換照片", type=["jpg", "jpeg", "png", "webp"], key="attach_upload")
+    if uploaded is None: return
+    if uploaded.size > ATTACHMENT_MAX_UPLOAD:
+        st.error(f"檔案太大 (上限 {ATTACHMENT_MAX_UPLOAD // 2 ** 20} MB)")
+        return
+    cached = st.session_state.get("attach_image")
+    if not cached or cached[0] != uploaded.file_id:
+        try:
+            cached = (uploaded.file_id, open_upload_image(uploaded))
+        except (OSError, ValueError) as e:
+            st.error(f"無法讀取圖片：{e}")
             return
-        new_trip_data = {}
-        for _, row in df.iterrows():
-            day = int(row['Day'])
-            if day not in new_trip_data: new_trip_data[day] = []
-            time_str = row['Time'].strftime("%H:%M") if isinstance(row['Time'], (datetime, pd.Timestamp)) else str(row['Time'])
-            item = {
-                "id": int(time.time() * 1000) + _, 
-                "time": time_str,
-                "title": str(row['Title']),
-                "loc": str(row.get('Location', '')),
-                "cost": int(row.get('Cost', 0)) if pd.notnull(row.get('Cost')) else 0,
-                "cat": "other",
-                "note": str(row.get('Note', '')),
-                "expenses": [],
-                "trans_mode": "📍 移動",
-                "trans_min": 30
-            }
-            new_trip_data[day].append(item)
-        st.session_state.trip_data = new_trip_data
-        st.session_state.trip_days_count = max(new_trip_data.keys())
-        st.toast("✅ 行程匯入成功！")
-        time.sleep(1)
+        st.session_state.attach_image = cached
+    image = cached[1]
+    if CROPPER_AVAILABLE:
+        image = streamlit_cropper.st_cropper(image, realtime_update=True, box_color=current_theme["primary"], key="attach_crop")
+    if st.button("💾 儲存", type="primary", use_container_width=True):
+        with st.spinner("處理中…"):
+            set_attachment(target, store.put(image))
+        st.session_state.pop("attach_image", None)
         st.rerun()
+
+# --- 行程匯入 (Excel / CSV)：整欄向量化處理，回傳錯誤列報告 ---
+IMPORT_COLUMNS = {
+    "day": ["day", "天數", "日"], "time": ["time", "時間"], "title": ["title", "名稱", "標題"],
+    "loc": ["location", "loc", "地點"], "cost": ["cost", "預算", "費用"], "note": ["note", "備註"],
+    "cat": ["category", "cat", "類別"], "trans_mode": ["transport", "交通"], "trans_min": ["transport min", "trans_min", "交通時間"]
+}
+CATEGORY_ALIASES = {
+    "trans": ["trans", "交通", "🚃"], "food": ["food", "美食", "餐廳", "🍱"], "stay": ["stay", "住宿", "飯店", "🏨"],
+    "spot": ["spot", "景點", "⛩️"], "shop": ["shop", "購物", "🛍️"], "other": ["other", "其他", "📍"]
+}
+
+def _read_upload_frames(uploaded_file):
+    """CSV 直接讀取；Excel 以 openpyxl 唯讀模式逐列串流，每個工作表一個 DataFrame"""
+    if getattr(uploaded_file, "name", "").lower().endswith(".csv"):
+        return [("CSV", pd.read_csv(uploaded_file, dtype=str, keep_default_na=False))]
+    import openpyxl
+    wb = openpyxl.load_workbook(uploaded_file, read_only=True, data_only=True)
+    try:
+        frames = []
+        for ws in wb.worksheets:
+            rows = ws.iter_rows(values_only=True)
+            header = next(rows, None)
+            if not header: continue
+            columns = [str(h).strip() if h is not None else f"_col{i}" for i, h in enumerate(header)]
+            frames.append((ws.title, pd.DataFrame.from_records(rows, columns=columns)))
+        return frames
+    finally:
+        wb.close()
+
+def _normalize_import_frame(sheet_name, sheet_index, raw):
+    """將單一工作表轉成行程欄位，回傳 (有效資料, 錯誤列)"""
+    lookup = {alias: field for field, aliases in IMPORT_COLUMNS.items() for alias in aliases}
+    rename = {c: lookup[c.strip().lower()] for c in raw.columns if c.strip().lower() in lookup}
+    df = raw.rename(columns=rename).loc[:, lambda x: ~x.columns.duplicated()]
+    df = df.replace("", pd.NA)
+    df["_row"] = range(2, len(df) + 2)
+    df = df.dropna(how="all", subset=[c for c in df.columns if c in IMPORT_COLUMNS])
+    if "title" not in df or "time" not in df:
+        return None, pd.DataFrame([{"工作表": sheet_name, "列": 1, "原因": "缺少 Time 或 Title 欄位"}])
+
+    # 沒有 Day 欄時，一個工作表代表一天 (工作表名稱中的數字優先)
+    if "day" in df:
+        day = pd.to_numeric(df["day"], errors="coerce")
+    else:
+        digits = re.search(r"\d+", sheet_name)
+        day = pd.Series(int(digits.group()) if digits else sheet_index + 1, index=df.index)
+
+    # 時間：接受 datetime/time 物件、"9:00" 字串或 Excel 的日內小數
+    time_text = df["time"].astype(str).str.extract(r"(\d{1,2}):(\d{2})")
+    minutes = pd.to_numeric(time_text[0], errors="coerce") * 60 + pd.to_numeric(time_text[1], errors="coerce")
+    fraction = pd.to_numeric(df["time"], errors="coerce")
+    minutes = minutes.fillna((fraction.where((fraction >= 0) & (fraction < 1)) * 1440).round())
+
+    cost = pd.to_numeric(df["cost"], errors="coerce") if "cost" in df else pd.Series(0, index=df.index)
+    trans_min = pd.to_numeric(df["trans_min"], errors="coerce") if "trans_min" in df else pd.Series(30, index=df.index)
+    title = df["title"]
+
+    reasons = np.select(
+        [title.isna(), day.isna() | (day < 1) | (day > 30), minutes.isna() | (minutes >= 1440),
+         cost.isna() & df.get("cost", pd.Series(pd.NA, index=df.index)).notna()],
+        ["缺少 Title", "Day 無效 (需為 1-30)", "Time 格式錯誤", "Cost 不是數字"], default="")
+    bad = reasons != ""
+    report = pd.DataFrame({"工作表": sheet_name, "列": df["_row"][bad], "原因": reasons[bad]})
+
+    ok = ~bad
+    if not ok.any():   # 只有標題列或全部無效：空欄位無法做下面的字串運算
+        return None, report
+    cat_lookup = {alias.lower(): code for code, aliases in CATEGORY_ALIASES.items() for alias in aliases}
+    trans_lookup = {opt: opt for opt in TRANSPORT_OPTIONS} | {opt.split(" ", 1)[1]: opt for opt in TRANSPORT_OPTIONS}
+    text = lambda col: df[col][ok].fillna("").astype(str).str.strip() if col in df else pd.Series("", index=df.index[ok])
+    mins = minutes[ok].astype(int)
+    out = pd.DataFrame({
+        "day": day[ok].astype(int),
+        "time": (mins // 60).map("{:02d}".format) + ":" + (mins % 60).map("{:02d}".format),
+        "title": title[ok].astype(str).str.strip(),
+        "loc": text("loc"),
+        "cost": cost[ok].fillna(0).astype(int),
+        "cat": text("cat").str.lower().map(cat_lookup).fillna("other"),
+        "note": text("note"),
+        "trans_mode": text("trans_mode").map(trans_lookup).fillna("📍 移動"),
+        "trans_min": trans_min[ok].fillna(30).astype(int),
+    })
+    return out, report
+
+@PERF.timed("import.parse")
+def parse_itinerary_upload(uploaded_file):
+    """回傳 (trip_data, 錯誤報告 DataFrame)"""
+    parts, reports = [], []
+    for i, (sheet_name, raw) in enumerate(_read_upload_frames(uploaded_file)):
+        out, report = _normalize_import_frame(sheet_name, i, raw)
+        if out is not None: parts.append(out)
+        reports.append(report)
+    report = pd.concat(reports, ignore_index=True) if reports else pd.DataFrame(columns=["工作表", "列", "原因"])
+    trip_data = {}
+    if parts:
+        items = pd.concat(parts, ignore_index=True)
+        items.insert(0, "id", [new_item_id() for _ in range(len(items))])
+        for day, group in items.groupby("day", sort=True):
+            records = group.drop(columns="day").to_dict("records")
+            for rec in records: rec["expenses"] = []
+            trip_data[int(day)] = records
+    return trip_data, report
+
+def process_excel_upload(uploaded_file):
+    try:
+        new_trip_data, report = parse_itinerary_upload(uploaded_file)
     except Exception as e:
         st.error(f"匯入失敗: {e}")
+        return
+    st.session_state.import_report = report
+    if not new_trip_data:
+        st.error("沒有可匯入的行程，請查看下方錯誤報告")
+        return
+    st.session_state.trip_store = TripStore.from_dict(new_trip_data)
+    st.session_state.trip_days_count = max(new_trip_data.keys())
+    st.toast(f"✅ 行程匯入成功！共 {sum(len(v) for v in new_trip_data.values())} 項")
+    st.rerun()
+
+startup_mark("函數 & 資料表")
 
 # -------------------------------------
 # 3. 初始化 & 資料
@@ -222,6 +2811,18 @@ if "trip_days_count" not in st.session_state: st.session_state.trip_days_count =
 if "target_country" not in st.session_state: st.session_state.target_country = "日本"
 if "selected_theme_name" not in st.session_state: st.session_state.selected_theme_name = "⛩️ 京都緋紅 (預設)"
 if "start_date" not in st.session_state: st.session_state.start_date = datetime(2026, 1, 17)
+if "session_uid" not in st.session_state: st.session_state.session_uid = uuid.uuid4().hex
+if "autosave" not in st.session_state: st.session_state.autosave = False
+if "trip_id" not in st.session_state: st.session_state.trip_id = "default"
+if "members" not in st.session_state: st.session_state.members = ["我"]
+
+# 頁面路由：只執行目前頁面的程式碼
+VIEWS = ["📅 行程", "✨ 願望", "🗺️ 路線", "🎒 清單", "ℹ️ 資訊", "🧰 工具", "📊 分析"]
+if st.session_state.get("active_view") not in VIEWS: st.session_state.active_view = VIEWS[0]
+# 沒顯示的頁面，其 widget 狀態會在該次執行結束時被清除；每次執行開頭重新指定一次即可保留
+VIEW_STATE_KEYS = ["day_select", "edit_mode", "map_day_select", "checklist_edit", "autosave", "trip_id", "chart_day_select"]
+for key in VIEW_STATE_KEYS:
+    if key in st.session_state: st.session_state[key] = st.session_state[key]
 
 # 願望清單
 if "wishlist" not in st.session_state:
@@ -232,12 +2833,12 @@ if "wishlist" not in st.session_state:
 
 # 購物清單
 if "shopping_list" not in st.session_state:
-    st.session_state.shopping_list = pd.DataFrame(columns=["對象", "商品名稱", "預算(¥)", "已購買"])
+    st.session_state.shopping_list = ShoppingList()
 
 current_theme = THEMES[st.session_state.selected_theme_name]
 
-if "trip_data" not in st.session_state:
-    st.session_state.trip_data = {
+if "trip_store" not in st.session_state:
+    st.session_state.trip_store = TripStore.from_dict({
         1: [
             {"id": 101, "time": "10:00", "title": "抵達關西機場", "loc": "關西機場", "cost": 0, "cat": "trans", "note": "入境審查、領取周遊券", "expenses": [], "trans_mode": "🚆 電車", "trans_min": 75},
             {"id": 102, "time": "13:00", "title": "京都車站 Check-in", "loc": "KOKO HOTEL 京都", "cost": 0, "cat": "stay", "note": "寄放行李", "expenses": [], "trans_mode": "🚌 巴士", "trans_min": 20},
@@ -265,7 +2866,7 @@ if "trip_data" not in st.session_state:
             {"id": 502, "time": "13:00", "title": "臨空城 Outlet", "loc": "Rinku Premium Outlets", "cost": 10000, "cat": "shop", "note": "最後採買", "expenses": [], "trans_mode": "🚆 電車", "trans_min": 20},
             {"id": 503, "time": "16:00", "title": "前往機場", "loc": "關西機場", "cost": 0, "cat": "trans", "note": "搭機返台", "expenses": [], "trans_mode": "✈️ 飛機", "trans_min": 0}
         ]
-    }
+    })
 
 if "flight_info" not in st.session_state:
     st.session_state.flight_info = {
@@ -315,17 +2916,17 @@ SURVIVAL_PHRASES = {
     }
 }
 
+startup_mark("session 初始化")
+
 # -------------------------------------
 # 4. CSS 樣式
 # -------------------------------------
-st.markdown(f"""
-    <style>
-    @import url('https://fonts.googleapis.com/css2?family=Noto+Serif+JP:wght@400;700;900&family=Inter:wght@400;600&display=swap');
-    
+# 樣式模板：以 str.format 帶入主題色，啟動時一次編譯所有主題 (不再每次 rerun 重組，也不再 @import 外部字型)
+THEME_CSS_TEMPLATE = """
     .stApp {{ 
-        background-color: {current_theme['bg']} !important;
-        color: {current_theme['text']} !important; 
-        font-family: 'Inter', 'Noto Serif JP', sans-serif !important;
+        background-color: {bg} !important;
+        color: {text} !important; 
+        font-family: 'Inter', 'TripCJK', 'Noto Serif JP', sans-serif !important;
     }}
 
     [data-testid="stSidebarCollapsedControl"], section[data-testid="stSidebar"], 
@@ -340,13 +2941,13 @@ st.markdown(f"""
         border: 1px solid rgba(255, 255, 255, 0.6);
         box-shadow: 0 4px 15px rgba(0, 0, 0, 0.04);
     }}
-    .apple-time {{ font-weight: 700; font-size: 1.1rem; color: {current_theme['text']}; }}
+    .apple-time {{ font-weight: 700; font-size: 1.1rem; color: {text}; }}
     .apple-title {{ font-size: 1.1rem; font-weight: 700; margin-bottom: 2px; line-height: 1.4; }}
-    .apple-loc {{ font-size: 0.9rem; color: {current_theme['sub']}; display:flex; align-items:center; gap:5px; margin-top:5px; }}
+    .apple-loc {{ font-size: 0.9rem; color: {sub}; display:flex; align-items:center; gap:5px; margin-top:5px; }}
     
     /* Weather Widget */
     .apple-weather-widget {{
-        background: linear-gradient(135deg, {current_theme['primary']} 0%, {current_theme['text']} 150%);
+        background: linear-gradient(135deg, {primary} 0%, {text} 150%);
         color: white; padding: 15px 20px; border-radius: 20px;
         margin-bottom: 25px; box-shadow: 0 8px 20px rgba(0,0,0,0.15);
         display: flex; align-items: center; justify-content: space-between;
@@ -354,14 +2955,14 @@ st.markdown(f"""
 
     /* Transport Badge */
     .trans-badge {{
-        font-size: 0.75rem; color: {current_theme['sub']};
-        background: {current_theme['bg']}; border: 1px solid {current_theme['secondary']};
+        font-size: 0.75rem; color: {sub};
+        background: {bg}; border: 1px solid {secondary};
         padding: 4px 12px; border-radius: 20px; display: inline-block;
     }}
 
     /* Day Segmented Control */
     div[data-testid="stRadio"] > div {{
-        background-color: {current_theme['secondary']} !important;
+        background-color: {secondary} !important;
         padding: 4px !important; border-radius: 12px !important; gap: 0px !important; border: none !important;
     }}
     div[data-testid="stRadio"] label {{
@@ -370,45 +2971,124 @@ st.markdown(f"""
         border-radius: 9px !important; height: auto !important; min-width: 50px !important;
     }}
     div[data-testid="stRadio"] label[data-checked="true"] {{
-        background-color: {current_theme['card']} !important;
-        color: {current_theme['text']} !important;
+        background-color: {card} !important;
+        color: {text} !important;
         box-shadow: 0 2px 5px rgba(0,0,0,0.1) !important; font-weight: bold !important;
     }}
 
     /* Info Cards */
     .info-card {{
-        background-color: {current_theme['card']}; border-radius: 12px; padding: 20px; margin-bottom: 15px;
+        background-color: {card}; border-radius: 12px; padding: 20px; margin-bottom: 15px;
         box-shadow: 0 4px 12px rgba(0,0,0,0.05); border: 1px solid #F0F0F0;
     }}
-    .info-header {{ display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; color: {current_theme['sub']}; font-size: 0.85rem; font-weight: bold; }}
-    .info-time {{ font-size: 1.8rem; font-weight: 900; color: {current_theme['text']}; margin-bottom: 5px; font-family: 'Times New Roman', serif; }}
-    .info-loc {{ color: {current_theme['sub']}; font-size: 0.9rem; display: flex; align-items: center; gap: 5px; }}
-    .info-tag {{ background: {current_theme['bg']}; color: {current_theme['sub']}; padding: 2px 8px; border-radius: 4px; font-size: 0.75rem; }}
+    .info-header {{ display: flex; justify-content: space-between; align-items: center; margin-bottom: 10px; color: {sub}; font-size: 0.85rem; font-weight: bold; }}
+    .info-time {{ font-size: 1.8rem; font-weight: 900; color: {text}; margin-bottom: 5px; font-family: 'Times New Roman', serif; }}
+    .info-loc {{ color: {sub}; font-size: 0.9rem; display: flex; align-items: center; gap: 5px; }}
+    .info-tag {{ background: {bg}; color: {sub}; padding: 2px 8px; border-radius: 4px; font-size: 0.75rem; }}
 
     /* Map Route Animation */
     .map-tl-container {{ position: relative; max-width: 100%; margin: 20px auto; padding-left: 30px; }}
     .map-tl-container::before {{
         content: ''; position: absolute; top: 0; bottom: 0; left: 14px; width: 2px;
-        background-image: linear-gradient({current_theme['primary']} 40%, rgba(255,255,255,0) 0%);
+        background-image: linear-gradient({primary} 40%, rgba(255,255,255,0) 0%);
         background-position: right; background-size: 2px 12px; background-repeat: repeat-y;
     }}
     .map-tl-item {{ position: relative; margin-bottom: 25px; }}
     .map-tl-icon {{
         position: absolute; left: -31px; top: 0px; width: 32px; height: 32px;
-        background: {current_theme['card']}; border: 2px solid {current_theme['primary']}; border-radius: 50%;
+        background: {card}; border: 2px solid {primary}; border-radius: 50%;
         text-align: center; line-height: 28px; font-size: 16px; z-index: 2;
     }}
     .map-tl-content {{
-        background: {current_theme['card']}; border: 1px solid #E0E0E0; border-left: 4px solid {current_theme['primary']};
+        background: {card}; border: 1px solid #E0E0E0; border-left: 4px solid {primary};
         padding: 12px 15px; border-radius: 4px; box-shadow: 0 3px 6px rgba(0,0,0,0.05);
     }}
 
     /* UI Tweaks */
     button[data-baseweb="tab"] {{ border-radius: 20px !important; margin-right:5px !important; }}
-    div[data-baseweb="input"], div[data-baseweb="base-input"] {{ border: none !important; border-bottom: 1px solid {current_theme['secondary']} !important; background: transparent !important; }}
-    input {{ color: {current_theme['text']} !important; }}
-    </style>
-""", unsafe_allow_html=True)
+    div[data-baseweb="input"], div[data-baseweb="base-input"] {{ border: none !important; border-bottom: 1px solid {secondary} !important; background: transparent !important; }}
+    input {{ color: {text} !important; }}
+"""
+
+# 自架中文字型子集：只保留程式內實際用到的字，放在 static/ 由瀏覽器快取 (需啟用 server.enableStaticServing)
+FONT_STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "fonts")
+CSS_STATIC_DIR = os.path.join(os.path.dirname(FONT_STATIC_DIR), "css")
+
+def _app_glyphs():
+    with open(os.path.abspath(__file__), encoding="utf-8") as f:
+        source = f.read()
+    # CJK 標點、假名、漢字與全形符號；emoji 交給系統字型
+    return "".join(sorted({ch for ch in source if 0x2E80 <= ord(ch) <= 0xFFEF}))
+
+def _build_font_subset(font_path, glyphs, out_path):
+    from fontTools import subset
+    from fontTools.ttLib import TTFont
+    font = TTFont(font_path, fontNumber=0)
+    subsetter = subset.Subsetter(subset.Options())
+    subsetter.populate(text=glyphs)
+    subsetter.subset(font)
+    font.flavor = "woff"
+    tmp = out_path + ".tmp"
+    font.save(tmp)
+    os.replace(tmp, out_path)
+
+@st.cache_resource
+def start_font_subset_build():
+    """背景建立字型子集 (只在程序第一次啟動時執行，不阻塞首次渲染)；回傳完成後的檔名 holder"""
+    holder = {"file": None}
+    font_path = get_setting("cjk_font_path", "/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc")
+    if not os.path.exists(font_path): return holder
+    glyphs = _app_glyphs()
+    name = f"trip-cjk-{hashlib.sha1((font_path + glyphs).encode('utf-8')).hexdigest()[:10]}.woff"
+    out_path = os.path.join(FONT_STATIC_DIR, name)
+    if os.path.exists(out_path):
+        holder["file"] = name
+        return holder
+
+    def build():
+        try:
+            os.makedirs(FONT_STATIC_DIR, exist_ok=True)
+            _build_font_subset(font_path, glyphs, out_path)
+            holder["file"] = name
+        except Exception:
+            pass  # 沒有 fontTools 或目錄無法寫入時沿用系統字型
+    threading.Thread(target=build, name="font-subset", daemon=True).start()
+    return holder
+
+def minify_css(css):
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    return re.sub(r"\s*([{};:,>])\s*", r"\1", css).replace(";}", "}").strip()
+
+def _write_static_css(css):
+    """寫入 static/css，檔名含內容雜湊 (內容不同就是新網址，瀏覽器可長期快取)；回傳檔名"""
+    name = f"theme-{hashlib.sha1(css.encode('utf-8')).hexdigest()[:10]}.css"
+    path = os.path.join(CSS_STATIC_DIR, name)
+    if not os.path.exists(path):
+        os.makedirs(CSS_STATIC_DIR, exist_ok=True)
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            f.write(css)
+        os.replace(path + ".tmp", path)
+    return name
+
+@st.cache_resource
+def compile_theme_stylesheets(font_file):
+    """所有主題一次編譯成壓縮後的 CSS 檔放在 static/css，每次 rerun 只送出一行 <link>，以主題名稱取用；
+    目錄無法寫入時退回內嵌 <style>"""
+    font_face = lambda base: f"@font-face {{ font-family: 'TripCJK'; src: url('{base}{font_file}') format('woff'); font-display: swap; }}" if font_file else ""
+    sheets = {}
+    for name, theme in THEMES.items():
+        body = THEME_CSS_TEMPLATE.format(**theme)
+        try:
+            # 字型網址相對於 CSS 檔本身
+            sheets[name] = f'<link rel="stylesheet" href="app/static/css/{_write_static_css(minify_css(font_face("../fonts/") + body))}">'
+        except OSError:
+            sheets[name] = f"<style>{minify_css(font_face('app/static/fonts/') + body)}</style>"
+    return sheets
+
+st.markdown(compile_theme_stylesheets(start_font_subset_build()["file"])[st.session_state.selected_theme_name], unsafe_allow_html=True)
+
+startup_mark("CSS")
 
 # -------------------------------------
 # 5. 主畫面
@@ -418,145 +3098,119 @@ st.markdown(f'<div style="text-align:center; color:{current_theme["sub"]}; font-
 
 with st.expander("⚙️ 設定"):
     st.session_state.trip_title = st.text_input("標題", value=st.session_state.trip_title)
-    theme_name = st.selectbox("主題", list(THEMES.keys()), index=list(THEMES.keys()).index(st.session_state.selected_theme_name))
-    if theme_name != st.session_state.selected_theme_name:
-        st.session_state.selected_theme_name = theme_name
-        st.rerun()
+    st.selectbox("主題", list(THEMES.keys()), index=list(THEMES.keys()).index(st.session_state.selected_theme_name), key="theme_select", on_change=on_theme_change)
     c1, c2 = st.columns(2)
     st.session_state.start_date = c1.date_input("日期", value=st.session_state.start_date)
     st.session_state.trip_days_count = c2.number_input("天數", 1, 30, st.session_state.trip_days_count)
     st.session_state.target_country = st.selectbox("地區", ["日本", "韓國", "泰國", "台灣"])
-    st.session_state.exchange_rate = st.number_input("匯率 (外幣 -> 台幣)", value=st.session_state.exchange_rate, step=0.01)
-    uf = st.file_uploader("匯入 Excel", type=["xlsx"])
+    st.session_state.exchange_rate = st.number_input(f"匯率 (1 {trip_currency()} -> 台幣)", value=st.session_state.exchange_rate, step=0.01)
+    uf = st.file_uploader("匯入 Excel / CSV", type=["xlsx", "csv"])
     if uf and st.button("匯入"): process_excel_upload(uf)
+    if st.session_state.get("import_report") is not None and not st.session_state.import_report.empty:
+        st.warning(f"有 {len(st.session_state.import_report)} 列未匯入")
+        st.dataframe(st.session_state.import_report, hide_index=True, use_container_width=True)
 
 # Init Days
+trip_store = st.session_state.trip_store
 for d in range(1, st.session_state.trip_days_count + 1):
-    if d not in st.session_state.trip_data: st.session_state.trip_data[d] = []
+    trip_store.ensure_day(d)
 
-# 定義 Tabs
-tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["📅 行程", "✨ 願望", "🗺️ 路線", "🎒 清單", "ℹ️ 資訊", "🧰 工具"])
+# 頁面切換 (取代 st.tabs：tabs 每次都會執行全部六頁)
+current_view = st.segmented_control("頁面", VIEWS, key="active_view", required=True, label_visibility="collapsed")
+
+# 附件視窗：取出目標後就清掉，關閉視窗 (X) 時不會在下次 rerun 又打開
+attachment_target = st.session_state.pop("attachment_target", None)
+if attachment_target:
+    st.session_state.pop("attach_image", None)
+    attachment_dialog(attachment_target)
+
+startup_mark("標題 & 設定")
 
 # ==========================================
 # 1. 行程規劃
 # ==========================================
-with tab1:
+if current_view == VIEWS[0]:
     selected_day_num = st.radio("DaySelect", list(range(1, st.session_state.trip_days_count + 1)), 
                                 index=0, horizontal=True, label_visibility="collapsed", 
-                                format_func=lambda x: f"Day {x}")
+                                format_func=lambda x: f"Day {x}", key="day_select")
     
     current_date = st.session_state.start_date + timedelta(days=selected_day_num - 1)
-    current_items = st.session_state.trip_data[selected_day_num]
-    current_items.sort(key=lambda x: x['time'])
+    current_items = list(trip_store.day_items(selected_day_num))
+    leg_minutes, schedule_issues = check_schedule(trip_store)
+    conflict_days = sorted({trip_store.get(i).day for i in schedule_issues} - {selected_day_num})
+    if conflict_days:
+        st.caption("⚠️ 其他天的時間衝突：" + "、".join(f"Day {d}" for d in conflict_days))
     
     # --- 📊 預算儀表板 ---
-    all_cost = sum([item.get('cost', 0) for item in current_items])
-    all_actual = sum([sum(x['price'] for x in item.get('expenses', [])) for item in current_items])
+    all_cost, all_actual = trip_store.day_totals(selected_day_num)
+    currency = trip_currency()   # 金額皆以行程幣別顯示
+    money = lambda amount: format_money(amount, currency)
     
     c_bud1, c_bud2 = st.columns(2)
-    c_bud1.metric("今日預算", f"¥{all_cost:,}")
-    c_bud2.metric("實際支出", f"¥{all_actual:,}", delta=f"{all_cost - all_actual:,}" if all_actual > 0 else None)
+    c_bud1.metric("今日預算", money(all_cost))
+    c_bud2.metric("實際支出", money(all_actual), delta=f"{all_cost - all_actual:,}" if all_actual > 0 else None)
     
     if all_cost > 0 and all_actual > 0:
         prog = min(all_actual / all_cost, 1.0)
         st.progress(prog, text=f"支出進度 {int(prog*100)}%")
 
+    with st.expander("📊 全程預算總覽"):
+        trip_cost, trip_actual = trip_store.trip_totals()
+        c_trip1, c_trip2 = st.columns(2)
+        c_trip1.metric("全程預算", money(trip_cost))
+        c_trip2.metric("全程支出", money(trip_actual), delta=f"{trip_cost - trip_actual:,}" if trip_actual > 0 else None)
+        st.caption(f"約合台幣 NT$ {int(trip_actual * st.session_state.exchange_rate):,} (已支出)")
+        c_tab1, c_tab2 = st.columns(2)
+        # 小表格直接用 Markdown，不需要為此載入 pandas
+        c_tab1.markdown("| 天 | 預算 | 實際 |\n|---|---:|---:|\n" + "".join(f"| Day {d} | {money(c)} | {money(a)} |\n" for d in trip_store.days() for c, a in [trip_store.day_totals(d)]))
+        c_tab2.markdown("| 類別 | 預算 | 實際 |\n|---|---:|---:|\n" + "".join(f"| {get_category_icon(k)} {k} | {money(c)} | {money(a)} |\n" for k, (c, a) in trip_store.cat_totals().items()))
+
     st.markdown("---")
 
     # Weather Widget
-    first_loc = current_items[0]['loc'] if current_items and current_items[0]['loc'] else (st.session_state.target_country if st.session_state.target_country != "日本" else "京都")
+    first_loc = current_items[0].loc if current_items and current_items[0].loc else (st.session_state.target_country if st.session_state.target_country != "日本" else "京都")
     weather = WeatherService.get_forecast(first_loc, current_date)
     
     # 壓縮 HTML 避免縮排問題
     weather_html = f"""<div class="apple-weather-widget"><div style="display:flex; align-items:center; gap:15px;"><div style="font-size:2.5rem;">{weather['icon']}</div><div><div style="font-size:2rem; font-weight:700; line-height:1;">{weather['high']}°</div><div style="font-size:0.9rem; opacity:0.9;">L:{weather['low']}°</div></div></div><div style="text-align:right;"><div style="font-weight:700;">{current_date.strftime('%m/%d %a')}</div><div style="font-size:0.9rem; opacity:0.9;">📍 {first_loc}</div><div style="font-size:0.8rem; opacity:0.8; margin-top:2px;">{weather['desc']}</div></div></div>"""
     st.markdown(weather_html, unsafe_allow_html=True)
 
-    is_edit_mode = st.toggle("編輯模式", value=False)
+    is_edit_mode = st.toggle("編輯模式", value=False, key="edit_mode")
     if is_edit_mode and st.button("➕ 新增行程", use_container_width=True):
-        st.session_state.trip_data[selected_day_num].append({"id": int(datetime.now().timestamp()), "time": "09:00", "title": "新行程", "loc": "", "cost": 0, "cat": "other", "note": "", "expenses": [], "trans_mode": "📍 移動", "trans_min": 30})
+        trip_store.add(TripItem(new_item_id(), selected_day_num, 9 * 60))
         st.rerun()
 
     if not current_items:
         st.info("🍵 點擊「編輯模式」開始安排今日行程")
 
-    for index, item in enumerate(current_items):
-        map_link = get_single_map_link(item['loc'])
-        map_btn = f'<a href="{map_link}" target="_blank" style="text-decoration:none; margin-left:8px; font-size:0.8rem; background:{current_theme["secondary"]}; color:white; padding:2px 8px; border-radius:10px; opacity:0.8;">🗺️</a>' if item['loc'] else ""
-        
-        cost_display = ""
-        total_exp = sum(x['price'] for x in item.get('expenses', []))
-        final_cost = total_exp if total_exp > 0 else item.get('cost', 0)
-        if final_cost > 0:
-            cost_display = f'<div style="background:{current_theme["primary"]}; color:white; padding:3px 8px; border-radius:12px; font-size:0.75rem; font-weight:bold; white-space:nowrap;">¥{final_cost:,}</div>'
-
-        clean_note = item["note"].replace('\n', '<br>')
-        note_div = f'<div style="font-size:0.85rem; color:{current_theme["sub"]}; background:{current_theme["bg"]}; padding:8px; border-radius:8px; margin-top:8px; line-height:1.4;">📝 {clean_note}</div>' if item['note'] and not is_edit_mode else ""
-        
-        # 記帳細項顯示
-        expense_details_html = ""
-        if item.get('expenses'):
-            rows = ""
-            for exp in item['expenses']:
-                 rows += f"<div style='display:flex; justify-content:space-between; font-size:0.8rem; color:#888; margin-top:2px;'><span>{exp['name']}</span><span>¥{exp['price']:,}</span></div>"
-            expense_details_html = f"<div style='margin-top:8px; padding-top:5px; border-top:1px dashed {current_theme['secondary']}; opacity:0.8;'>{rows}</div>"
-
-        # 卡片 HTML (壓縮單行)
-        card_content = f"""<div style="display:flex; gap:15px; margin-bottom:0px;"><div style="display:flex; flex-direction:column; align-items:center; width:50px;"><div style="font-weight:700; color:{current_theme['text']}; font-size:1.1rem;">{item['time']}</div><div style="flex-grow:1; width:2px; background:{current_theme['secondary']}; margin:5px 0; opacity:0.3; border-radius:2px;"></div></div><div style="flex-grow:1;"><div class="apple-card" style="margin-bottom:0px;"><div style="display:flex; justify-content:space-between; align-items:flex-start;"><div class="apple-title" style="margin-top:0;">{item['title']}</div>{cost_display}</div><div class="apple-loc">📍 {item['loc'] or '未設定'} {map_btn}</div>{note_div}{expense_details_html}</div></div></div>"""
-        st.markdown(card_content, unsafe_allow_html=True)
+    day_issues = [f"{item.time} {item.title}：{msg}" for item in current_items for msg in schedule_issues.get(item.id, [])]
+    if day_issues and not is_edit_mode:
+        st.warning("**⚠️ 行程銜接檢查**\n\n" + "\n".join(f"- {msg}" for msg in day_issues))
 
+    with PERF.timer("tab1.cards"):
         if is_edit_mode:
-            with st.container(border=True):
-                c1, c2 = st.columns([2, 1])
-                item['title'] = c1.text_input("名稱", item['title'], key=f"t_{item['id']}")
-                item['time'] = c2.time_input("時間", datetime.strptime(item['time'], "%H:%M").time(), key=f"tm_{item['id']}").strftime("%H:%M")
-                item['loc'] = st.text_input("地點", item['loc'], key=f"l_{item['id']}")
-                item['cost'] = st.number_input("預算 (¥)", value=item['cost'], step=100, key=f"c_{item['id']}")
-                item['note'] = st.text_area("備註", item['note'], key=f"n_{item['id']}")
-                
-                cx1, cx2, cx3 = st.columns([2, 1, 1])
-                cx1.text_input("支出項目", key=f"new_exp_n_{item['id']}", placeholder="項目", label_visibility="collapsed")
-                cx2.number_input("金額", min_value=0, key=f"new_exp_p_{item['id']}", label_visibility="collapsed")
-                cx3.button("➕", key=f"add_{item['id']}", on_click=add_expense_callback, args=(item['id'], selected_day_num))
-                
-                if item.get('expenses'):
-                    with st.expander("管理細項"):
-                         for i_ex, ex in enumerate(item['expenses']):
-                             c_d1, c_d2 = st.columns([3,1])
-                             c_d1.text(f"{ex['name']} ¥{ex['price']}")
-                             if c_d2.button("刪", key=f"del_exp_{item['id']}_{i_ex}"):
-                                 item['expenses'].pop(i_ex)
-                                 st.rerun()
-
-                if st.button("🗑️ 刪除行程", key=f"del_{item['id']}"):
-                    st.session_state.trip_data[selected_day_num].pop(index)
-                    st.rerun()
-        
-        # 交通資訊
-        if index < len(current_items) - 1:
-            t_mode = item.get('trans_mode', '📍 移動')
-            t_min = item.get('trans_min', 30)
-            
-            if is_edit_mode:
-                 ct1, ct2 = st.columns([1,1])
-                 item['trans_mode'] = ct1.selectbox("交通", TRANSPORT_OPTIONS, key=f"trm_{item['id']}")
-                 item['trans_min'] = ct2.number_input("分", value=t_min, step=5, key=f"trmin_{item['id']}")
-            else:
-                 trans_html = f"""<div style="display:flex; gap:15px;"><div style="display:flex; flex-direction:column; align-items:center; width:50px;"><div style="flex-grow:1; width:2px; border-left:2px dashed {current_theme['secondary']}; margin:0; opacity:0.6;"></div></div><div style="flex-grow:1; padding:10px 0;"><span class="trans-badge">{t_mode} 約 {t_min} 分</span></div></div>"""
-                 st.markdown(trans_html, unsafe_allow_html=True)
+            st.session_state.pop("totals_changed", None)   # 整頁重跑時小計已是最新
+            for index, item in enumerate(current_items):
+                render_item_editor(item.id, index == len(current_items) - 1)
+        elif current_items:
+            st.markdown(day_timeline_html(current_items, st.session_state.selected_theme_name, leg_minutes, schedule_issues), unsafe_allow_html=True)
+
+startup_mark("tab 行程")
 
 # ==========================================
 # 2. 願望清單
 # ==========================================
-with tab2:
+if current_view == VIEWS[1]:
     st.markdown(f'<div style="text-align:center; color:{current_theme["sub"]}; font-weight:bold; margin-bottom:15px;">MY WISHLIST</div>', unsafe_allow_html=True)
     
     with st.expander("➕ 新增願望景點", expanded=False):
         w_title = st.text_input("景點名稱", placeholder="例如: 晴空塔")
-        w_loc = st.text_input("地點/區域", placeholder="例如: 淺草")
+        w_loc = st.text_input("地點/區域", placeholder="例如: 淺草", key="w_loc")
+        location_suggestions("w_loc", w_loc, lambda name: st.session_state.update(w_loc=name))
         w_note = st.text_input("備註", placeholder="想去吃...")
         if st.button("加入清單") and w_title:
             st.session_state.wishlist.append({
-                "id": int(time.time()), "title": w_title, "loc": w_loc, "note": w_note
+                "id": new_item_id(), "title": w_title, "loc": w_loc, "note": w_note
             })
             st.rerun()
 
@@ -566,38 +3220,36 @@ with tab2:
     for i, wish in enumerate(st.session_state.wishlist):
         with st.container():
             st.markdown(f"""<div class="apple-card" style="padding:15px; margin-bottom:10px; border-left:4px solid {current_theme['primary']};"><div style="font-weight:bold; font-size:1.1rem;">{wish['title']}</div><div style="font-size:0.9rem; color:{current_theme['sub']};">📍 {wish['loc']}｜📝 {wish['note']}</div></div>""", unsafe_allow_html=True)
+            if wish.get("photo"):
+                thumb = get_attachment_store().thumbnail(wish["photo"])
+                if thumb: st.image(thumb, width=160)
             
-            c1, c2, c3 = st.columns([2, 1, 1])
+            c1, c2, c3, c4 = st.columns([2, 1, 1, 1])
             target_day = c1.selectbox("排入哪天?", list(range(1, st.session_state.trip_days_count + 1)), key=f"wd_{wish['id']}")
             
             if c2.button("排程", key=f"wm_{wish['id']}"):
-                new_item = {
-                    "id": int(time.time()), 
-                    "time": "09:00", 
-                    "title": wish['title'], 
-                    "loc": wish['loc'], 
-                    "cost": 0, "cat": "spot", 
-                    "note": wish['note'], 
-                    "expenses": [], 
-                    "trans_mode": "📍 移動", "trans_min": 30
-                }
-                st.session_state.trip_data[target_day].append(new_item)
+                trip_store.add(TripItem(new_item_id(), target_day, 9 * 60, title=wish['title'], loc=wish['loc'], cat="spot", note=wish['note']))
                 st.session_state.wishlist.pop(i)
                 st.toast(f"已將 {wish['title']} 排入 Day {target_day}！")
                 time.sleep(1)
                 st.rerun()
             
-            if c3.button("刪除", key=f"wdl_{wish['id']}"):
+            if c3.button("📷", key=f"wph_{wish['id']}", help="照片"):
+                open_attachment(("wish", wish["id"]))
+
+            if c4.button("刪除", key=f"wdl_{wish['id']}"):
                 st.session_state.wishlist.pop(i)
                 st.rerun()
 
+startup_mark("tab 願望")
+
 # ==========================================
 # 3. 路線全覽
 # ==========================================
-with tab3:
+if current_view == VIEWS[2]:
     st.markdown(f'<div style="text-align:center; color:{current_theme["sub"]}; font-weight:bold; margin-bottom:15px;">VISUAL ROUTE MAP</div>', unsafe_allow_html=True)
     map_day = st.selectbox("選擇天數", list(range(1, st.session_state.trip_days_count + 1)), format_func=lambda x: f"Day {x}", key="map_day_select")
-    map_items = sorted(st.session_state.trip_data[map_day], key=lambda x: x['time'])
+    map_items = trip_store.day_items(map_day)
     
     if map_items:
         # Google Maps 按鈕 (Moved)
@@ -606,23 +3258,63 @@ with tab3:
 
         t_html = ['<div class="map-tl-container">']
         for item in map_items:
-            icon = get_category_icon(item.get('cat', 'other'))
-            t_html.append(f"""<div class='map-tl-item'><div class='map-tl-icon'>{icon}</div><div class='map-tl-content'><div style='color:{current_theme['primary']}; font-weight:bold;'>{item['time']}</div><div style='font-weight:900; font-size:1.1rem; color:{current_theme['text']};'>{item['title']}</div><div style='font-size:0.85rem; color:{current_theme['sub']};'>📍 {item['loc']}</div></div></div>""")
+            icon = get_category_icon(item.cat)
+            t_html.append(f"""<div class='map-tl-item'><div class='map-tl-icon'>{icon}</div><div class='map-tl-content'><div style='color:{current_theme['primary']}; font-weight:bold;'>{item.time}</div><div style='font-weight:900; font-size:1.1rem; color:{current_theme['text']};'>{item.title}</div><div style='font-size:0.85rem; color:{current_theme['sub']};'>📍 {item.loc}</div></div></div>""")
         t_html.append('</div>')
         st.markdown("".join(t_html), unsafe_allow_html=True)
+
+        # 路線最佳化建議
+        proposal = propose_day_route(map_items)
+        if proposal:
+            new_items, old_km, new_km = proposal
+            reordered = [it.id for it in new_items] != [it.id for it in map_items]
+            if reordered and (old_km is None or old_km - new_km > 0.05):
+                st.markdown("#### 🧭 順路建議")
+                if old_km is None:
+                    st.caption("部分地點無法定位，維持原位且不估算距離；抵達、住宿與交通項目維持原時間")
+                else:
+                    st.caption(f"目前路線約 {old_km:.1f} km → 建議路線約 {new_km:.1f} km (省下 {old_km - new_km:.1f} km)，抵達、住宿與交通項目維持原時間")
+                st.markdown(" → ".join(f"{'📌' if is_pinned_item(it) else ''}{it.title}" for it in new_items))
+                if st.button("套用建議順序", key=f"apply_route_{map_day}"):
+                    # 時段不變，依新順序把原本的時間依序分給各項目
+                    slots = [it.minute for it in map_items]
+                    for it, minute in list(zip(new_items, slots)):
+                        if it.minute != minute: trip_store.update(it.id, minute=minute)
+                    st.rerun()
+            elif old_km is not None:
+                st.caption(f"🧭 目前路線約 {old_km:.1f} km，已是順路的安排")
+            else:
+                st.caption("🧭 已是順路的安排")
     else:
         st.info("🌸 本日尚無行程")
 
+startup_mark("tab 路線")
+
 # ==========================================
 # 4. 準備清單
 # ==========================================
-with tab4:
-    recs, weather_summary = get_packing_recommendations(st.session_state.trip_data, st.session_state.start_date)
-    st.info(f"**🌤️ 智能穿搭推薦**\n\n預測氣溫：{weather_summary['min']}°C ~ {weather_summary['max']}°C\n\n建議攜帶：" + "、".join(recs))
+if current_view == VIEWS[3]:
+    if "packing_engine" not in st.session_state: st.session_state.packing_engine = PackingEngine(get_packing_rules())
+    recs, weather_summary = get_packing_recommendations(trip_store, st.session_state.start_date, st.session_state.target_country, st.session_state.packing_engine)
+    st.info(f"**🌤️ 智能穿搭推薦**\n\n預測氣溫：{weather_summary['min']}°C ~ {weather_summary['max']}°C\n\n建議攜帶：" + "、".join(f"{icon} {name}" for icon, name, _ in recs))
+    # 還不在準備清單裡的建議，可勾選後加入 (併入對應分類)
+    listed = {name for items in st.session_state.checklist.values() for name in items}
+    pending = [rec for rec in recs if rec[1] not in listed]
+    if pending:
+        pending_labels = {f"{icon} {name}": (icon, name, category) for icon, name, category in pending}
+        picked = st.pills("加入準備清單", list(pending_labels), selection_mode="multi",
+                          key=f"packing_pick_{_row_hash('|'.join(pending_labels))}")
+        c_pk1, c_pk2 = st.columns(2)
+        if c_pk1.button("➕ 加入選取", disabled=not picked, use_container_width=True):
+            merge_packing_suggestions(st.session_state.checklist, [pending_labels[p] for p in picked])
+            st.rerun()
+        if c_pk2.button("全部加入", use_container_width=True):
+            merge_packing_suggestions(st.session_state.checklist, pending)
+            st.rerun()
 
     c_list_head, c_list_edit = st.columns([3, 1])
     c_list_head.subheader("🎒 準備清單")
-    edit_list_mode = c_list_edit.toggle("編輯")
+    edit_list_mode = c_list_edit.toggle("編輯", key="checklist_edit")
 
     for category, items in st.session_state.checklist.items():
         st.markdown(f"**{category}**")
@@ -656,10 +3348,12 @@ with tab4:
         st.warning(f"**🚑 緊急電話**\n\n警察 110 / 救護 119。")
         st.error(f"**💴 小費**\n\n日本無小費文化。")
 
+startup_mark("tab 清單")
+
 # ==========================================
 # 5. 重要資訊
 # ==========================================
-with tab5:
+if current_view == VIEWS[4]:
     col_info_1, col_info_2 = st.columns([3, 1])
     col_info_1.subheader("✈️ 航班")
     edit_info_mode = col_info_2.toggle("✏️ 編輯資訊")
@@ -686,7 +3380,7 @@ with tab5:
     
     if edit_info_mode:
         if st.button("➕ 新增住宿"):
-            st.session_state.hotel_info.append({"id": int(time.time()), "name": "新飯店", "range": "D1-D2", "date": "", "addr": "", "link": ""})
+            st.session_state.hotel_info.append({"id": new_item_id(), "name": "新飯店", "range": "D1-D2", "date": "", "addr": "", "link": ""})
             st.rerun()
 
     for i, hotel in enumerate(st.session_state.hotel_info):
@@ -706,130 +3400,177 @@ with tab5:
         hotel_html = f"""<div class="info-card" style="border-left: 5px solid {current_theme['primary']};"><div class="info-header"><span class="info-tag" style="background:{current_theme['primary']}; color:white;">{hotel['range']}</span><span>{hotel['date']}</span></div><div style="font-size:1.3rem; font-weight:900; color:{current_theme['text']}; margin: 10px 0;">{hotel['name']}</div><div class="info-loc" style="margin-bottom:10px;">📍 {hotel['addr']}</div><a href="{map_url}" target="_blank" style="text-decoration:none; color:{current_theme['primary']}; font-size:0.9rem; font-weight:bold; border:1px solid {current_theme['primary']}; padding:4px 12px; border-radius:20px;">🗺️ 地圖</a></div>"""
         st.markdown(hotel_html, unsafe_allow_html=True)
 
+startup_mark("tab 資訊")
+
 # ==========================================
 # 6. 實用工具
 # ==========================================
-with tab6:
+if current_view == VIEWS[5]:
     st.header("🧰 實用工具")
     
-    # 1. 雲端同步
-    st.subheader("☁️ 雲端共同編輯 (Google Sheets)")
+    # 1. 行程儲存 / 共同編輯
+    storage = get_storage()
+    st.subheader("☁️ 行程儲存與共同編輯")
     with st.expander("設定說明", expanded=False):
-        st.caption("需在 GitHub 設定 secrets 才能使用。")
-    
-    col_cloud1, col_cloud2 = st.columns(2)
+        st.caption("預設存於伺服器上的 SQLite (secrets 或環境變數 sqlite_path 可指定路徑)；"
+                   "設定 storage_backend = \"sheets\" 並在 GitHub 設定 Google secrets 可改用 Google Sheets。")
+
+    if storage is None:
+        st.error("雲端模組未安裝或連線失敗 (請檢查 requirements.txt 與 Secrets 設定)")
+    else:
+        trips = {t["id"]: t["title"] for t in storage.list_trips()}
+        trips.setdefault(st.session_state.trip_id, st.session_state.trip_title)
+        c_trip_sel, c_trip_new = st.columns([3, 1])
+        c_trip_sel.selectbox(f"行程 ({storage.label})", list(trips), key="trip_id", format_func=lambda tid: trips.get(tid) or tid,
+                             on_change=switch_trip, disabled=not storage.multi_trip)
+        # 新 id 尚無同步紀錄：下次上傳 / 自動同步把目前內容完整寫入新行程
+        c_trip_new.button("➕ 另存新行程", use_container_width=True, disabled=not storage.multi_trip,
+                          on_click=lambda: st.session_state.update(trip_id=uuid.uuid4().hex[:12]))
+
+    col_cloud1, col_cloud2, col_cloud3 = st.columns(3)
     
-    if col_cloud1.button("☁️ 上傳進度", use_container_width=True):
-        if CLOUD_AVAILABLE:
-            with st.spinner("連線中..."):
-                export_data = {
-                    "trip_data": st.session_state.trip_data,
-                    "checklist": st.session_state.checklist,
-                    "wishlist": st.session_state.wishlist,
-                    "hotel_info": st.session_state.hotel_info,
-                    "flight_info": st.session_state.flight_info,
-                    "shopping_list": st.session_state.shopping_list.to_dict()
-                }
-                json_str = json.dumps(export_data, default=str)
-                success, msg = save_to_cloud(json_str)
-                if success:
-                    st.toast(f"✅ {msg}")
+    if col_cloud1.button("☁️ 上傳進度", use_container_width=True, disabled=storage is None):
+        with st.spinner("連線中..."):
+            success, msg = storage.save_rows(st.session_state.trip_id, trip_to_rows(collect_trip_payload()), get_cloud_sync_state(), st.session_state.session_uid)
+            if success:
+                st.toast(f"✅ {msg}")
+            else:
+                st.error(msg)
+
+    if col_cloud2.button("📥 下載進度", use_container_width=True, disabled=storage is None):
+        with st.spinner("讀取中..."):
+            data = storage.load(st.session_state.trip_id, get_cloud_sync_state())
+            if data:
+                errors = apply_trip_payload(data)
+                if errors:
+                    st.error("資料解析失敗: " + "；".join(f"{name} {msg}" for name, msg in errors.items()))
                 else:
-                    st.error(msg)
-        else:
-            st.error("雲端模組未安裝 (請檢查 requirements.txt)")
+                    st.toast("✅ 同步成功！")
+                    time.sleep(1)
+                    st.rerun()
+            else:
+                st.error("讀取失敗或無資料")
 
-    if col_cloud2.button("📥 下載進度", use_container_width=True):
-        if CLOUD_AVAILABLE:
-            with st.spinner("讀取中..."):
-                cloud_data_str = load_from_cloud()
-                if cloud_data_str:
-                    try:
-                        data = json.loads(cloud_data_str)
-                        if "trip_data" in data:
-                            st.session_state.trip_data = {int(k): v for k, v in data["trip_data"].items()}
-                        if "checklist" in data: st.session_state.checklist = data["checklist"]
-                        if "wishlist" in data: st.session_state.wishlist = data["wishlist"]
-                        if "hotel_info" in data: st.session_state.hotel_info = data["hotel_info"]
-                        if "flight_info" in data: st.session_state.flight_info = data["flight_info"]
-                        if "shopping_list" in data: st.session_state.shopping_list = pd.DataFrame.from_dict(data["shopping_list"])
-                        st.toast("✅ 同步成功！")
-                        time.sleep(1)
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"資料解析失敗: {e}")
-                else:
-                    st.error("讀取失敗或無資料")
+    if col_cloud3.button("🔄 取得更新", use_container_width=True, disabled=storage is None):
+        if "rev" not in get_cloud_sync_state():
+            st.warning("請先「上傳」或「下載進度」一次，之後即可只取得新的變更")
         else:
-            st.error("雲端模組未安裝")
+            with st.spinner("同步中..."):
+                data, applied, conflicts = storage.pull(st.session_state.trip_id, get_cloud_sync_state(), collect_trip_payload(), st.session_state.session_uid)
+            if data is None:
+                st.error("讀取失敗")
+            elif applied:
+                apply_trip_payload(data)
+                st.toast(f"✅ 已合併 {applied} 項變更" + (f"，{conflicts} 項衝突保留本機版本" if conflicts else ""))
+                st.rerun()
+            else:
+                st.toast("已是最新版本" + (f" ({conflicts} 項衝突保留本機版本)" if conflicts else ""))
+
+    st.toggle("🔄 自動同步 (背景寫入)", key="autosave", disabled=storage is None)
+    if st.session_state.autosave and storage:
+        sync_status = get_cloud_autosaver().status(st.session_state.session_uid)
+        sync_at = sync_status["at"].strftime("%H:%M:%S") if sync_status["at"] else "--"
+        st.caption(f"同步狀態：{sync_status['msg']} ({sync_at})")
+
+    if storage and storage.describe():
+        st.caption(f"🔌 {storage.describe()}")
 
     st.divider()
 
     # 2. 檔案備份
     with st.expander("📂 本機檔案備份 (JSON)", expanded=False):
-        export_data = {
-            "trip_data": st.session_state.trip_data,
-            "checklist": st.session_state.checklist,
-            "wishlist": st.session_state.wishlist,
-            "hotel_info": st.session_state.hotel_info,
-            "flight_info": st.session_state.flight_info
-        }
-        json_str = json.dumps(export_data, default=str, indent=4)
-        st.download_button("⬇️ 下載檔案", json_str, "my_trip.json", "application/json")
+        # 只記下物件參照；內容在按下下載時才產生
+        backup_state = {k: st.session_state[k] for k in TRIP_STATE_KEYS}
+        backup_cache = st.session_state.setdefault("backup_cache", {})
+        c_bk1, c_bk2 = st.columns(2)
+        c_bk1.download_button("⬇️ 下載 (壓縮)", lambda: export_backup(backup_state, "gz", backup_cache),
+                              "my_trip.json.gz", "application/gzip", use_container_width=True)
+        c_bk2.download_button("⬇️ 下載 (JSON)", lambda: export_backup(backup_state, "json", backup_cache),
+                              "my_trip.json", "application/json", use_container_width=True)
         
-        up_file = st.file_uploader("⬆️ 上傳檔案", type=["json"])
-        if up_file:
-            try:
-                data = json.load(up_file)
-                if "trip_data" in data:
-                    st.session_state.trip_data = {int(k): v for k, v in data["trip_data"].items()}
-                if "checklist" in data: st.session_state.checklist = data["checklist"]
-                if "wishlist" in data: st.session_state.wishlist = data["wishlist"]
-                if "hotel_info" in data: st.session_state.hotel_info = data["hotel_info"]
-                if "flight_info" in data: st.session_state.flight_info = data["flight_info"]
-                st.toast("✅ 匯入成功")
-                time.sleep(1)
+        up_file = st.file_uploader("⬆️ 上傳檔案", type=["json", "gz"])
+        if up_file and st.session_state.get("backup_imported") != up_file.file_id:
+            st.session_state.backup_imported = up_file.file_id   # 同一個檔案只匯入一次
+            sections, errors = parse_backup(up_file)
+            if sections:
+                errors.update(apply_trip_payload(sections))
+            st.session_state.backup_report = ([name for name in sections if name not in errors], errors)
+            if sections:
                 st.rerun()
-            except:
-                st.error("格式錯誤")
+        if "backup_report" in st.session_state:
+            imported, errors = st.session_state.pop("backup_report")
+            if imported:
+                st.success("✅ 已匯入：" + "、".join(imported))
+            for name, msg in errors.items():
+                st.error(f"{'檔案' if name == '_file' else name} 格式錯誤：{msg}")
 
     st.divider()
 
     # 3. 匯率計算
     st.subheader("💴 匯率與退稅計算")
-    c_calc1, c_calc2 = st.columns(2)
+    c_calc0, c_calc1, c_calc2 = st.columns([1, 1, 1])
+    calc_cur = c_calc0.selectbox("幣別", list(dict.fromkeys([trip_currency(), *DEFAULT_RATES])))
     amt = c_calc1.number_input("外幣金額", min_value=0, step=100)
-    twd = amt * st.session_state.exchange_rate
+    twd = convert_amount(amt, calc_cur, HOME_CURRENCY, datetime.now().strftime("%Y-%m-%d"))
     c_calc2.metric("約合台幣", f"NT$ {int(twd):,}")
-    if amt > 0:
+    if amt > 0 and calc_cur == "JPY":
         st.caption(f"稅拔價(未稅)約: {int(amt/1.1):,} | 退稅額約: {int(amt - amt/1.1):,}")
 
+    # 記帳：所有行程的支出換算成台幣，分類/幣別/付款人小計與分帳
+    with st.expander("🧾 記帳與分帳", expanded=False):
+        members_text = st.text_input("同行成員", value="、".join(st.session_state.members), help="以逗號或頓號分隔；第一位為預設付款人")
+        members = [m for m in re.split(r"[,，、\s]+", members_text) if m]
+        if members and members != st.session_state.members:
+            st.session_state.members = members
+        summary = get_ledger_summary()
+        if summary is None:
+            st.info("還沒有支出紀錄 (在行程的編輯模式中新增)")
+        else:
+            c_l1, c_l2 = st.columns(2)
+            c_l1.metric("總支出", f"NT$ {summary['total_home']:,.0f}")
+            c_l2.metric("筆數", summary["count"])
+            c_l3, c_l4 = st.columns(2)
+            c_l3.markdown("| 類別 | 台幣 |\n|---|---:|\n" + "".join(f"| {get_category_icon(k)} {k} | {v:,.0f} |\n" for k, v in summary["by_cat"].items()))
+            c_l4.markdown("| 幣別 | 原幣 | 台幣 |\n|---|---:|---:|\n" + "".join(f"| {cur} | {format_money(r.amount, cur)} | {r.home:,.0f} |\n" for cur, r in summary["by_currency"].iterrows()))
+            tax_free = summary["tax_free"]
+            if tax_free and tax_free["stores"]:
+                st.caption(f"🛍️ 可退稅 {tax_free['stores']} 筆 (¥{tax_free['spend']:,.0f})，退稅額約 ¥{tax_free['refund']:,.0f} ≈ NT$ {tax_free['refund_home']:,.0f}")
+            if len(summary["balance"]) > 1:
+                st.markdown("**分帳**")
+                st.markdown("| 成員 | 已付 | 淨額 |\n|---|---:|---:|\n" + "".join(
+                    f"| {p} | {summary['by_payer'].get(p, 0):,.0f} | {v:+,.0f} |\n" for p, v in summary["balance"].items()))
+                for debtor, creditor, amount in summary["transfers"]:
+                    st.markdown(f"- {debtor} → {creditor}：NT$ {amount:,.0f}")
+                if not summary["transfers"]:
+                    st.caption("已結清")
+            ledger = summary["ledger"]
+            st.download_button("⬇️ 下載帳本 (CSV)", lambda: ledger.drop(columns=["split"]).assign(split=ledger["split"].str.join("/")).to_csv(index=False).encode("utf-8-sig"),
+                               "ledger.csv", "text/csv", use_container_width=True)
+
     st.divider()
 
     # 4. 購物清單
     st.subheader("🛍️ 購物清單")
-    if "shopping_list" not in st.session_state:
-        st.session_state.shopping_list = pd.DataFrame(columns=["對象", "商品", "預算", "已買"])
-    
-    edited_df = st.data_editor(
-        st.session_state.shopping_list,
+    shop = st.session_state.shopping_list
+    if shop.dirty and shop.editor_key not in st.session_state:
+        shop.compact()   # 編輯器狀態已被清除，先把變更併入 base，避免顯示舊資料
+    # 變更在 on_change 回呼中套用 (script 執行前)，不需要再 rerun 一次
+    st.data_editor(
+        shop.frame(),
         num_rows="dynamic",
         column_config={
-            "已買": st.column_config.CheckboxColumn(default=False),
-            "預算": st.column_config.NumberColumn(format="¥%d")
+            "商品名稱": st.column_config.TextColumn(required=True),
+            "已購買": st.column_config.CheckboxColumn(default=False),
+            "預算(¥)": st.column_config.NumberColumn(min_value=0, step=100, default=0, format="¥%d")
         },
         use_container_width=True,
-        key="shop_editor"
+        key=shop.editor_key,
+        on_change=apply_shop_edits,
+        args=(shop.editor_key,)
     )
     
-    if not edited_df.equals(st.session_state.shopping_list):
-        st.session_state.shopping_list = edited_df
-        st.rerun()
-    
-    if not edited_df.empty:
-        total_shop_budget = edited_df["預算"].sum()
-        bought_count = edited_df["已買"].sum()
-        st.caption(f"購物總預算: ¥{total_shop_budget:,} ｜ 進度: {bought_count}/{len(edited_df)}")
+    if shop.count:
+        st.caption(f"購物總預算: ¥{shop.budget:,} ｜ 進度: {shop.bought}/{shop.count}")
 
     st.divider()
 
@@ -859,3 +3600,112 @@ with tab6:
         cat = st.selectbox("情境", list(phrases.keys()))
         for p in phrases[cat]:
             st.markdown(f"""<div class="apple-card" style="padding:15px; margin-bottom:10px;"><div style="font-size:0.9rem; color:{current_theme['sub']};">{p[0]}</div><div style="font-size:1.2rem; font-weight:bold; color:{current_theme['text']};">{p[1]}</div></div>""", unsafe_allow_html=True)
+
+startup_mark("tab 工具")
+
+# ==========================================
+# 7. 花費分析
+# ==========================================
+if current_view == VIEWS[6]:
+    renderer = get_chart_renderer()
+    data = chart_data(trip_store, current_theme, trip_currency())
+    if not any(map(any, data["spend"])):
+        st.info("還沒有預算或支出，在行程的編輯模式中填入後就會出現圖表")
+    else:
+        # 兩張圖同時送到背景執行緒繪製；資料沒變時直接取回快取的圖
+        spend_future = renderer.submit("spend", data, render_spend_chart)
+        budget_future = renderer.submit("budget", data, render_budget_chart)
+        with st.spinner("繪製圖表中…"):
+            st.image(spend_future.result(), use_container_width=True)
+            st.image(budget_future.result(), use_container_width=True)
+
+    st.markdown("#### 🗺️ 每日路線")
+    graph_day = st.selectbox("選擇天數", trip_store.days(), format_func=lambda x: f"Day {x}", key="chart_day_select")
+    if trip_store.day_items(graph_day):
+        leg_minutes, _ = check_schedule(trip_store, [graph_day])
+        st.graphviz_chart(renderer.submit("route", route_graph_data(trip_store, graph_day, leg_minutes, current_theme), render_route_graph).result(),
+                          use_container_width=True)
+    else:
+        st.info("🌸 本日尚無行程")
+
+startup_mark("tab 分析")
+
+# ==========================================
+# 自動同步 (背景寫入，不阻塞 rerun)
+# ==========================================
+if st.session_state.autosave:
+    queue_autosave()
+startup_mark("自動同步")
+
+# ==========================================
+# 啟動剖析報告
+# ==========================================
+if STARTUP_PROFILE["cold_start"] is None:
+    STARTUP_PROFILE["cold_start"] = list(STARTUP_MARKS)
+if str(get_setting("startup_profile", "")).lower() in ("1", "true", "yes") or st.query_params.get("profile") == "startup":
+    st.session_state.startup_report = {
+        "run": dict(STARTUP_MARKS), "cold_start": dict(STARTUP_PROFILE["cold_start"]), "imports": dict(STARTUP_PROFILE["imports"]),
+    }
+    with st.expander("⏱️ 啟動剖析", expanded=False):
+        rows = "".join(f"| {phase} | {ms:.1f} | {dict(STARTUP_PROFILE['cold_start']).get(phase, 0):.1f} |\n" for phase, ms in STARTUP_MARKS)
+        st.markdown(f"| 階段 | 本次 ms | 冷啟動 ms |\n|---|---:|---:|\n{rows}"
+                    f"| **合計** | **{sum(ms for _, ms in STARTUP_MARKS):.1f}** | **{sum(ms for _, ms in STARTUP_PROFILE['cold_start']):.1f}** |")
+        if STARTUP_PROFILE["imports"]:
+            st.caption("延後載入：" + "、".join(f"{name} {ms:.0f} ms" for name, ms in STARTUP_PROFILE["imports"].items()))
+
+# ==========================================
+# 效能面板 (隱藏：設定 perf_metrics=1 且網址加 ?debug=perf 才顯示)
+# ==========================================
+def collect_perf_snapshot():
+    gauges = {}
+    for name, cache in (("forecast_cache", get_forecast_cache()), ("leg_cache", get_leg_cache()), ("render_cache", get_render_cache())):
+        gauges.update({f"{name}.hits": cache.hits, f"{name}.misses": cache.misses, f"{name}.size": len(cache)})
+    storage = get_storage()   # sheets 後端無法連線時為 None
+    stats = storage.conn.stats if isinstance(storage, SheetsStorage) else getattr(storage, "stats", {})
+    prefix = storage.name if storage else "none"
+    gauges.update({f"{prefix}.{k}": v for k, v in stats.items() if isinstance(v, (int, float))})
+    session = {"id": st.session_state.session_uid, "reruns": st.session_state.perf_reruns,
+               "state_bytes": session_state_sizes(st.session_state)}
+    return PERF.snapshot(gauges, session)
+
+def write_perf_textfile(path, text):
+    """給 node_exporter textfile collector 之類的工具讀取；先寫暫存檔再替換，避免讀到一半的內容"""
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+if PERF.enabled:
+    st.session_state.perf_reruns = st.session_state.get("perf_reruns", 0) + 1
+    PERF.count("reruns")
+    for phase, ms in STARTUP_MARKS:
+        PERF.observe(f"section.{phase}", ms)
+    rerun_ms = (time.perf_counter() - SCRIPT_START) * 1000
+    PERF.observe("rerun", rerun_ms)
+    textfile = get_setting("perf_textfile")
+    if textfile:
+        write_perf_textfile(textfile, PerfMetrics.to_prometheus(PERF.snapshot()))
+
+if st.query_params.get("debug") == "perf":
+    with st.expander("🐞 效能面板", expanded=True):
+        if not PERF.enabled:
+            st.caption("效能量測未啟用：設定 perf_metrics=1 (環境變數 PERF_METRICS 或 Secrets) 後重新啟動")
+        else:
+            snap = collect_perf_snapshot()
+            state_bytes = snap["session"]["state_bytes"]
+            c_p1, c_p2, c_p3 = st.columns(3)
+            c_p1.metric("本 session rerun", snap["session"]["reruns"])
+            c_p2.metric("本次 rerun", f"{rerun_ms:.0f} ms")
+            c_p3.metric("session_state 估計", f"{sum(state_bytes.values()) / 1024:,.0f} KB")
+            timers = sorted(snap["timers"].items(), key=lambda kv: -kv[1]["total_ms"])
+            st.markdown("| 計時 | 次數 | 平均 ms | 最大 ms | 合計 ms |\n|---|---:|---:|---:|---:|\n"
+                        + "".join(f"| {name} | {t['count']} | {t['avg_ms']:.1f} | {t['max_ms']:.1f} | {t['total_ms']:.0f} |\n" for name, t in timers))
+            if snap["counters"]:
+                st.caption("計數：" + "、".join(f"{name} {n}" for name, n in sorted(snap["counters"].items())))
+            st.caption("快取/連線：" + "、".join(f"{name} {v:g}" for name, v in snap["gauges"].items()))
+            st.markdown("| session_state 鍵 | 估計 KB |\n|---|---:|\n"
+                        + "".join(f"| {key} | {size / 1024:,.1f} |\n" for key, size in list(state_bytes.items())[:15]))
+            c_p4, c_p5, c_p6 = st.columns(3)
+            c_p4.download_button("⬇️ JSON", lambda: json.dumps(snap, ensure_ascii=False, indent=2), file_name="perf_metrics.json", mime="application/json")
+            c_p5.download_button("⬇️ Prometheus", lambda: PerfMetrics.to_prometheus(snap), file_name="perf_metrics.prom", mime="text/plain")
+            c_p6.button("🔄 重設統計", on_click=PERF.reset)
@@ -0,0 +1,213 @@
+"""Rerun 延遲基準測試：以 Streamlit AppTest (headless) 執行 App，載入合成的行程資料，
+量測常見操作觸發的完整 rerun 延遲與記憶體峰值，結果輸出為 JSON，並可與門檻/上次結果比較。
+
+    python bench_reruns.py                                  # 全部情境，與 bench_thresholds.json 比較
+    python bench_reruns.py -s large -r 10 --json bench_output.json
+    python bench_reruns.py --baseline last.json --tolerance 0.3
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(ROOT, "ai_studio_code (36).py")
+THRESHOLDS_FILE = os.path.join(ROOT, "bench_thresholds.json")
+
+# 情境：天數 (上限同 App 的 number_input 30)、每天行程數、每項支出數、願望清單、購物清單列數
+SCENARIOS = {
+    "small": {"days": 5, "items": 5, "expenses": 1, "wishes": 10, "shop_rows": 20},
+    "medium": {"days": 14, "items": 10, "expenses": 3, "wishes": 50, "shop_rows": 100},
+    "large": {"days": 30, "items": 20, "expenses": 5, "wishes": 200, "shop_rows": 500},
+}
+LOCATIONS = ["清水寺", "三年坂", "八坂神社", "金閣寺", "伏見稻荷大社", "奈良公園", "東大寺", "錦市場", "鴨川",
+             "道頓堀", "黑門市場", "環球影城", "關西機場", "大阪", "嵐山", ""]
+CATEGORIES = ["trans", "food", "stay", "spot", "shop", "other"]
+TRANSPORT = ["🚆 電車", "🚌 巴士", "🚶 步行", "🚕 計程車", "📍 移動"]
+
+
+def generate_trip(days, items, expenses, wishes, shop_rows, seed=0):
+    """產生與 JSON 備份相同結構的合成資料 (固定 seed，結果可重現)"""
+    rng = random.Random(seed)
+    trip_data = {}
+    for day in range(1, days + 1):
+        trip_data[day] = [{
+            "id": day * 10000 + i,
+            "time": f"{8 + i * 14 // max(items, 1) % 16:02d}:{rng.choice([0, 15, 30, 45]):02d}",
+            "title": f"行程 {day}-{i}",
+            "loc": rng.choice(LOCATIONS),
+            "cost": rng.randrange(0, 10000, 100),
+            "cat": rng.choice(CATEGORIES),
+            "note": "備註 " * rng.randint(0, 10),
+            "expenses": [{"name": f"支出{k}", "price": rng.randrange(100, 5000, 10)} for k in range(expenses)],
+            "trans_mode": rng.choice(TRANSPORT),
+            "trans_min": rng.choice([10, 15, 20, 30, 45]),
+        } for i in range(items)]
+    return {
+        "trip_data": trip_data,
+        "wishlist": [{"id": 900000 + i, "title": f"願望 {i}", "loc": rng.choice(LOCATIONS), "note": ""} for i in range(wishes)],
+        "shopping_list": {
+            "對象": [rng.choice(["自己", "家人", "同事"]) for _ in range(shop_rows)],
+            "商品名稱": [f"商品 {i}" for i in range(shop_rows)],
+            "預算(¥)": [rng.randrange(100, 20000, 100) for _ in range(shop_rows)],
+            "已購買": [rng.random() < 0.3 for _ in range(shop_rows)],
+        },
+    }
+
+
+def load_scenario(at, data, days):
+    """用 App 自己的類別建立資料並放進 session (第一次 run 之後類別才存在)"""
+    ss = at.session_state
+    ss.trip_store = type(ss.trip_store).from_dict(data["trip_data"])
+    ss.shopping_list = type(ss.shopping_list).from_dict(data["shopping_list"])
+    ss.wishlist = data["wishlist"]
+    ss.trip_days_count = days
+
+
+def switch_view(at, view):
+    [w for w in at.get("button_group") if w.key == "active_view"][0].set_value(view)
+
+
+def interactions(at, days, first_item_id):
+    """回傳 [(名稱, 準備動作)]；每個動作只設定 widget，量測的是隨後的 at.run()"""
+    state = {"day": 1, "edit": False, "exp": 0, "shop": 0}
+
+    def switch_day():
+        state["day"] = state["day"] % days + 1
+        at.radio(key="day_select").set_value(state["day"])
+
+    def toggle_edit():
+        state["edit"] = not state["edit"]
+        at.toggle(key="edit_mode").set_value(state["edit"])
+
+    def add_expense():
+        if not at.toggle(key="edit_mode").value or at.radio(key="day_select").value != 1:
+            at.radio(key="day_select").set_value(1)
+            at.toggle(key="edit_mode").set_value(True)
+            at.run()
+        state["exp"] += 1
+        at.text_input(key=f"new_exp_n_{first_item_id}").set_value(f"bench {state['exp']}")
+        at.number_input(key=f"new_exp_p_{first_item_id}").set_value(100)
+        at.run()   # 輸入本身各觸發一次 rerun，不列入量測
+        at.button(key=f"add_{first_item_id}").click()
+
+    def edit_shopping():
+        # AppTest 無法操作 data_editor：直接把編輯器會送出的變更交給 App 的回呼，量測隨後的 rerun
+        if at.session_state.active_view != "🧰 工具":
+            switch_view(at, "🧰 工具")
+            at.run()
+        shop = at.session_state.shopping_list
+        state["shop"] += 1
+        editor_state = {"edited_rows": {0: {"預算(¥)": 100 * state["shop"]}}, "added_rows": [], "deleted_rows": []}
+        at.session_state[shop.editor_key] = editor_state
+        shop.apply_editor_state(editor_state)
+
+    return [("switch_day", switch_day), ("toggle_edit", toggle_edit), ("add_expense", add_expense), ("edit_shopping", edit_shopping)]
+
+
+def run_scenario(name, spec, repeat, seed):
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_FILE, default_timeout=300)
+    at.run()
+    data = generate_trip(seed=seed, **spec)
+    load_scenario(at, data, spec["days"])
+    at.run()
+    first_item_id = data["trip_data"][1][0]["id"]
+
+    results = {}
+    for label, prepare in interactions(at, spec["days"], first_item_id):
+        prepare(); at.run()   # 暖身 (填快取)
+        samples, script = [], []
+        for _ in range(repeat):
+            prepare()
+            t0 = time.perf_counter()
+            at.run()
+            samples.append((time.perf_counter() - t0) * 1000)
+            # App 腳本本身的執行時間 (啟動剖析的各階段合計)，其餘為 AppTest 的額外負擔
+            script.append(sum(at.session_state.startup_report["run"].values()))
+        tracemalloc.start()
+        prepare()
+        at.run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        errors = [str(e.value) for e in at.exception]
+        results[label] = {
+            "median_ms": statistics.median(samples), "script_median_ms": statistics.median(script), "p90_ms": sorted(samples)[int(0.9 * (len(samples) - 1))],
+            "max_ms": max(samples), "peak_alloc_mb": peak / 2 ** 20, "errors": errors,
+        }
+        print(f"  {label:<14} 中位數 {results[label]['median_ms']:7.1f} ms (腳本 {results[label]['script_median_ms']:6.1f} ms)  "
+              f"p90 {results[label]['p90_ms']:7.1f} ms  "
+              f"峰值配置 {results[label]['peak_alloc_mb']:6.1f} MB" + (f"  錯誤: {errors}" if errors else ""))
+        if label == "toggle_edit" and at.toggle(key="edit_mode").value:
+            at.toggle(key="edit_mode").set_value(False)
+            at.run()
+    return {"spec": spec, "interactions": results}
+
+
+def check(results, thresholds, baseline, tolerance):
+    """回傳違規訊息串列：超過門檻 (ms)，或比上次結果慢超過 tolerance 比例"""
+    failures = []
+    for scenario, res in results.items():
+        for label, r in res["interactions"].items():
+            limit = thresholds.get(scenario, {}).get(label)
+            if r["errors"]:
+                failures.append(f"{scenario}/{label}: 執行錯誤 {r['errors']}")
+            if limit is not None and r["median_ms"] > limit:
+                failures.append(f"{scenario}/{label}: {r['median_ms']:.0f} ms > 門檻 {limit} ms")
+            prev = baseline.get(scenario, {}).get("interactions", {}).get(label)
+            if prev and r["median_ms"] > prev["median_ms"] * (1 + tolerance):
+                failures.append(f"{scenario}/{label}: {r['median_ms']:.0f} ms，比上次 {prev['median_ms']:.0f} ms 慢超過 {tolerance:.0%}")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rerun 延遲基準測試")
+    parser.add_argument("-s", "--scenario", action="append", choices=list(SCENARIOS), help="可重複指定；預設全部")
+    parser.add_argument("-r", "--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果輸出檔")
+    parser.add_argument("--thresholds", default=THRESHOLDS_FILE, help="門檻檔 {情境: {操作: 毫秒}}")
+    parser.add_argument("--baseline", help="上次的結果 JSON，用來比較退步幅度")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    # 不寫入專案目錄的資料庫；開啟啟動剖析以取得腳本本身的耗時
+    os.environ.setdefault("SQLITE_PATH", os.path.join(tempfile.mkdtemp(), "bench.db"))
+    os.environ["STARTUP_PROFILE"] = "1"
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        print(f"[{name}] {SCENARIOS[name]}")
+        results[name] = run_scenario(name, SCENARIOS[name], args.repeat, args.seed)
+    results_doc = {"generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                   "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "scenarios": results}
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results_doc, f, ensure_ascii=False, indent=2)
+
+    thresholds = {}
+    if args.thresholds and os.path.exists(args.thresholds):
+        with open(args.thresholds, encoding="utf-8") as f:
+            thresholds = json.load(f)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["scenarios"]
+    failures = check(results, thresholds, baseline, args.tolerance)
+    print(f"\n程序最大 RSS {results_doc['max_rss_mb']:.0f} MB")
+    for msg in failures:
+        print(f"❌ {msg}")
+    if failures:
+        sys.exit(1)
+    print("✅ 全部在門檻內")
+
+
+if __name__ == "__main__":
+    main()
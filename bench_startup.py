@@ -0,0 +1,82 @@
+"""冷啟動基準測試：每輪開一個全新的 Python 程序，以 Streamlit AppTest 跑第一次畫面，
+記錄 streamlit import、首次渲染總時間、各初始化階段 (啟動剖析) 與已載入的重量級套件。
+
+    python bench_startup.py               # 5 輪，輸出摘要
+    python bench_startup.py -n 10 --json bench_output.json --budget-ms 2500
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ai_studio_code (36).py")
+HEAVY_MODULES = ["pandas", "gspread", "oauth2client", "requests", "openpyxl", "fontTools"]
+
+
+def run_child():
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    t_import = time.perf_counter() - t0
+
+    at = AppTest.from_file(APP_FILE, default_timeout=120)
+    t1 = time.perf_counter()
+    at.run()
+    t_render = time.perf_counter() - t1
+
+    report = at.session_state["startup_report"] if "startup_report" in at.session_state else {}
+    print(json.dumps({
+        "streamlit_import_ms": t_import * 1000,
+        "first_render_ms": t_render * 1000,
+        "errors": [str(e.value) for e in at.exception],
+        "phases": report.get("cold_start", {}),
+        "lazy_imports": report.get("imports", {}),
+        "loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+    }, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷啟動基準測試")
+    parser.add_argument("-n", "--runs", type=int, default=5)
+    parser.add_argument("--json", help="把每輪結果與摘要寫入檔案")
+    parser.add_argument("--budget-ms", type=float, help="首次渲染中位數超過此值時以非 0 結束")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, STARTUP_PROFILE="1", SQLITE_PATH=os.path.join(tmp, "bench.db"))
+        for i in range(args.runs):
+            out = subprocess.run([sys.executable, __file__, "--child"], env=env, capture_output=True, text=True, check=True)
+            result = json.loads(out.stdout.strip().splitlines()[-1])
+            results.append(result)
+            print(f"#{i + 1}: 首次渲染 {result['first_render_ms']:.0f} ms (streamlit import {result['streamlit_import_ms']:.0f} ms)"
+                  + (f"  錯誤: {result['errors']}" if result["errors"] else ""))
+
+    renders = [r["first_render_ms"] for r in results]
+    summary = {"runs": len(results), "median_ms": statistics.median(renders), "max_ms": max(renders), "min_ms": min(renders)}
+    print(f"\n首次渲染：中位數 {summary['median_ms']:.0f} ms / 最快 {summary['min_ms']:.0f} ms / 最慢 {summary['max_ms']:.0f} ms")
+
+    phases = {}
+    for r in results:
+        for phase, ms in r["phases"].items():
+            phases.setdefault(phase, []).append(ms)
+    for phase, values in phases.items():
+        print(f"  {phase:<16} {statistics.median(values):8.1f} ms")
+    print("首次渲染時已載入：" + (", ".join(results[-1]["loaded"]) or "(無)"))
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"summary": summary, "results": results}, f, ensure_ascii=False, indent=2)
+    if args.budget_ms is not None and summary["median_ms"] > args.budget_ms:
+        print(f"❌ 超過預算 {args.budget_ms:.0f} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        run_child()
+    else:
+        main()
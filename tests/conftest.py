@@ -0,0 +1,29 @@
+"""測試共用：在 bare mode 執行 App 腳本 (不啟動 Streamlit 伺服器)，取得其中的函式與類別"""
+import logging
+import os
+import runpy
+import warnings
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_FILE = os.path.join(ROOT, "ai_studio_code (36).py")
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    """App 腳本的全域命名空間；資料庫與附件放在暫存目錄"""
+    tmp = tmp_path_factory.mktemp("app")
+    env = {"SQLITE_PATH": str(tmp / "trip_data.db"), "ATTACHMENT_DIR": str(tmp / "attachments")}
+    old = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    logging.disable(logging.WARNING)   # bare mode 下 Streamlit 會對每個元件警告缺少 ScriptRunContext
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            yield runpy.run_path(APP_FILE)
+    finally:
+        logging.disable(logging.NOTSET)
+        for k, v in old.items():
+            if v is None: os.environ.pop(k, None)
+            else: os.environ[k] = v
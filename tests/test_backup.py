@@ -0,0 +1,42 @@
+"""JSON 備份的匯入驗證"""
+import io
+import json
+
+
+def upload(data):
+    return io.BytesIO(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+
+def test_non_numeric_amounts_are_reported_per_section(app):
+    backup = {
+        "schema_version": 2,
+        "trip_title": "東京",
+        "trip_data": {"1": [{"id": 1, "time": "09:00", "title": "淺草寺", "cost": "1000", "expenses": []}]},
+        "members": ["我"],
+    }
+    sections, errors = app["parse_backup"](upload(backup))
+    assert set(sections) == {"trip_title", "members"}
+    assert "cost" in errors["trip_data"]
+
+    backup["trip_data"]["1"][0].update(cost=1000, expenses=[{"name": "門票", "price": "300"}])
+    sections, errors = app["parse_backup"](upload(backup))
+    assert "trip_data" in errors and "trip_data" not in sections
+
+
+def test_valid_backup_round_trip(app):
+    backup = {
+        "schema_version": 2,
+        "trip_data": {"1": [{"id": 1, "time": "09:00", "title": "淺草寺", "cost": 1000, "trans_min": 15,
+                             "expenses": [{"id": 0, "name": "門票", "price": 300}]}]},
+        "shopping_list": {"商品": {"0": "抹茶"}, "預算": {"0": 1200}},
+    }
+    sections, errors = app["parse_backup"](upload(backup))
+    assert errors == {} and set(sections) == {"trip_data", "shopping_list"}
+    store = app["TripStore"].from_dict(sections["trip_data"])
+    assert store.trip_totals() == (1000, 300)
+
+
+def test_apply_skips_sections_that_fail(app):
+    errors = app["apply_trip_payload"]({"trip_data": {"1": [{"id": 1, "cost": "x"}]}, "trip_title": "大阪"})
+    assert list(errors) == ["trip_data"]
+    assert app["st"].session_state.trip_title == "大阪"
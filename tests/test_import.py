@@ -0,0 +1,29 @@
+"""行程匯入 (CSV / Excel)"""
+import io
+
+
+def upload(text, name="trip.csv"):
+    f = io.BytesIO(text.encode("utf-8"))
+    f.name = name
+    return f
+
+
+def test_valid_rows_are_imported(app):
+    trip_data, report = app["parse_itinerary_upload"](upload("Day,Time,Title,Cost\n1,9:00,清水寺,400\n2,0.5,金閣寺,\n"))
+    assert sorted(trip_data) == [1, 2]
+    assert trip_data[1][0]["time"] == "09:00" and trip_data[1][0]["cost"] == 400
+    assert trip_data[2][0]["time"] == "12:00"
+    assert report.empty
+
+
+def test_header_only_csv(app):
+    trip_data, report = app["parse_itinerary_upload"](upload("Day,Time,Title\n"))
+    assert trip_data == {}
+    assert report.empty
+
+
+def test_all_rows_invalid(app):
+    trip_data, report = app["parse_itinerary_upload"](upload("Day,Time,Title\n99,9:00,A\n1,25:99,B\n1,9:00,\n"))
+    assert trip_data == {}
+    assert list(report["列"]) == [2, 3, 4]
+    assert list(report["原因"]) == ["Day 無效 (需為 1-30)", "Time 格式錯誤", "缺少 Title"]
@@ -0,0 +1,21 @@
+"""購物清單的載入與小計"""
+
+
+def test_list_columns(app):
+    shop = app["ShoppingList"].from_dict({"對象": ["我", "媽"], "商品名稱": ["A", "B"], "預算(¥)": [100, 250], "已購買": [True, False]})
+    assert shop.to_dict()["商品名稱"] == ["A", "B"]
+    assert (shop.count, shop.budget, shop.bought) == (2, 350, 1)
+
+
+def test_legacy_blob_with_index_dicts(app):
+    # 舊版 A1 整包存檔：DataFrame.to_dict() 經 JSON 後索引變成字串，且用舊欄位名稱
+    legacy = {
+        "商品": {"0": "藥妝", "1": "零食", "2": "清酒", "10": "抹茶"},
+        "預算": {"0": 3000, "1": 500, "2": 2000, "10": 1200},
+        "已買": {"0": True, "1": False, "2": False, "10": True},
+    }
+    shop = app["ShoppingList"].from_dict(legacy)
+    data = shop.to_dict()
+    assert data["商品名稱"] == ["藥妝", "零食", "清酒", "抹茶"]
+    assert data["預算(¥)"] == [3000, 500, 2000, 1200]
+    assert (shop.count, shop.budget, shop.bought) == (4, 6700, 2)